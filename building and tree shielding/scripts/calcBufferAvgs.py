@@ -14,32 +14,32 @@
 ############### Setup: import libraries and define constants ##############
 import os
 from multiprocessing import Pool
-sucessfulImport = False
 import time
 import numpy as np
 import pandas as ps
 import sys
 import gConst as const
 
-
-# needed when using the ArcGIS license for a large # of parallel threads
-while(sucessfulImport == False):
-    try:
-        #print("try again")
-        import arcpy
-        from arcpy.ia import * 
-        from arcpy import env
-        from arcpy.sa import *
-        arcpy.env.overwriteOutput = True
-        arcpy.CheckOutExtension("Spatial")
-        sucessfulImport = True
-    except Exception as e:
-        print("couldn't import arcgis: %s" %(str(e)))
-        time.sleep(1)
+arcpy = None # imported on first use by loadArcpy
+YEAR = None # birth year, read from the command line in the main function
 
 
-YEAR = sys.argv[1]
-
+# import arcpy and check out the spatial analyst extension once per process.  Retries are
+# needed when using the ArcGIS license for a large # of parallel threads
+# OUTPUTS:
+#    arcpy module
+def loadArcpy():
+    global arcpy
+    while arcpy is None:
+        try:
+            import arcpy as arcpyModule
+            arcpyModule.env.overwriteOutput = True
+            arcpyModule.CheckOutExtension("Spatial")
+            arcpy = arcpyModule
+        except Exception as e:
+            print("couldn't import arcgis: %s" %(str(e)))
+            time.sleep(1)
+    return(arcpy)
 
 
 # given one shapefile containing exposure metrics for a single materal residence,
@@ -51,6 +51,7 @@ def processShp(shpFilepath,birthData):
     outputFile = const.WIND_FOLDER + "bufferAvgs/" + str(YEAR) + "/" + shpFilepath[:-4] + ".csv"
     print(outputFile)
     if os.path.exists(outputFile): return
+    loadArcpy()
     arcpy.management.CalculateGeometryAttributes(const.WIND_FOLDER + "shpFile/" + str(YEAR) + "/" + shpFilepath, "rdsSplit_4 LENGTH_GEODESIC", "METERS", '', None, "SAME_AS_INPUT")
     # todo: Update filepath to work with maternal resiences rather than air monitors
     curRecord = (birthData[birthData['uniqueid'] == shpFilepath[:-4]]).iloc[0]
@@ -359,6 +360,7 @@ def calcAvgs(folder):
 ####################### MAIN FUNCTION ##################
 
 if __name__ == '__main__':
+    YEAR = sys.argv[1]
     birthData = ps.read_csv(const.WIND_FOLDER + "Birth_Addresses_Wind/births_by_year/csvs/births_" + str(YEAR) + ".csv")
     # update filepaths for maternal residences rather than air monitors
     convertShpsToCSV(const.WIND_FOLDER + "shpFile/" + str(YEAR) + "/",birthData)
@@ -0,0 +1,114 @@
+############### footprintIndex.py #############
+# Developed for HEI Transit Study
+# Summary: percent building cover of every wind sector within every 10m buffer of a maternal residence,
+#          from building footprints held in memory with a spatial index (shapely STRtree).  Replaces
+#          clipping the yearly footprints for each residence and one TabulateIntersection per buffer
+#          in shieldingScript.py
+# Steps include:
+# 1) reading the yearly footprints once per process and indexing them with an STRtree
+# 2) querying the footprints within 500m of the residence, projecting them to the local plane used by
+#    polarBinning.py, and dissolving them so overlapping footprints are counted once
+# 3) creating the 360 x 50 (sector, ring) cells around the residence.  Sector edges point at the wind rose
+#    triangle vertices, as in polarBinning.py
+# 4) intersecting footprints with the cells they touch in one vectorized call, summing the overlap by
+#    cell, and accumulating rings into the buffer percentages reported by TabulateIntersection
+
+
+############### Setup: import libraries and define constants ##############
+import numpy as np
+import polarBinning
+
+# shapely 2 is required for the vectorized geometry functions
+try:
+    import shapely
+    SHAPELY_AVAILABLE = True
+except ImportError:
+    SHAPELY_AVAILABLE = False
+
+
+
+################ Footprint index ##############
+
+# read building footprints as shapely polygons in WGS84 coordinates
+# INPUTS:
+#    featureClass (str) - filepath of the footprint feature class
+# OUTPUTS:
+#    numpy array of shapely polygons
+def readFootprints(featureClass):
+    import arcpy
+    wgs84 = arcpy.SpatialReference(4326)
+    with arcpy.da.SearchCursor(featureClass,['SHAPE@WKB'],spatial_reference=wgs84) as cursor:
+        wkbs = [bytes(row[0]) for row in cursor if row[0] is not None]
+    return(shapely.from_wkb(np.array(wkbs,dtype=object)))
+
+# create a spatial index over building footprints
+# INPUTS:
+#    footprints (numpy array) - shapely polygons in WGS84 coordinates, created by readFootprints
+# OUTPUTS:
+#    footprintIndex (dict) - 'footprints' and their 'tree' (shapely STRtree)
+def createFootprintIndex(footprints):
+    if not SHAPELY_AVAILABLE:
+        raise RuntimeError("building shielding requires shapely 2")
+    footprints = np.asarray(footprints,dtype=object)
+    return({'footprints':footprints,'tree':shapely.STRtree(footprints)})
+
+# get the footprints within a distance of a residence, in local meters east and north of the residence.
+# Invalid footprints are repaired and overlapping footprints are dissolved
+# INPUTS:
+#    footprintIndex (dict) - created by createFootprintIndex
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+# OUTPUTS:
+#    numpy array of shapely polygons
+def getLocalFootprints(footprintIndex,lat,lon,radius=polarBinning.MAX_DIST):
+    metersPerLat, metersPerLon = polarBinning.getLocalScale(lat)
+    searchBox = shapely.box(lon - radius/metersPerLon,lat - radius/metersPerLat,lon + radius/metersPerLon,lat + radius/metersPerLat)
+    nearby = footprintIndex['footprints'][footprintIndex['tree'].query(searchBox)]
+    if len(nearby) == 0:
+        return(nearby)
+    local = shapely.transform(nearby,lambda coords: (coords - [lon,lat])*[metersPerLon,metersPerLat])
+    isValid = shapely.is_valid(local)
+    local[~isValid] = shapely.make_valid(local[~isValid])
+    return(shapely.get_parts(shapely.union_all(local)))
+
+
+
+################ Sector and buffer cover ##############
+
+# create the (sector, ring) cells around a residence in local meters.  Arcs are drawn as chords, less
+# than 2cm from the circle at 500m
+# INPUTS:
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+#    ringWidth (float) - ring spacing in meters
+# OUTPUTS:
+#    numpy array of shapely polygons, ordered by sector and then ring
+def createSectorCells(lat,lon,radius=polarBinning.MAX_DIST,ringWidth=polarBinning.RING_WIDTH):
+    edges = polarBinning.calcSectorEdges(lat,lon)
+    nextEdges = edges[(np.arange(polarBinning.N_SECTORS) + 1) % polarBinning.N_SECTORS]
+    ringDists = np.arange(0,radius + ringWidth/2,ringWidth)
+    inner, outer = ringDists[np.newaxis,:-1,np.newaxis], ringDists[np.newaxis,1:,np.newaxis]
+    edges, nextEdges = edges[:,np.newaxis,:], nextEdges[:,np.newaxis,:]
+    coords = np.stack([inner*edges,outer*edges,outer*nextEdges,inner*nextEdges,inner*edges],axis=2) # (sector, ring, vertex, east/north)
+    return(shapely.polygons(coords.reshape(-1,5,2)))
+
+# calculate the percent building cover of every wind sector within every buffer distance of a residence
+# INPUTS:
+#    footprintIndex (dict) - created by createFootprintIndex
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+#    ringWidth (float) - ring spacing in meters
+# OUTPUTS:
+#    numpy array organized by (sector, buffer), where buffer b covers distances up to (b+1) ring widths
+def calcBuildingCover(footprintIndex,lat,lon,radius=polarBinning.MAX_DIST,ringWidth=polarBinning.RING_WIDTH):
+    cells = createSectorCells(lat,lon,radius,ringWidth)
+    nRings = int(round(radius/ringWidth))
+    buildings = getLocalFootprints(footprintIndex,lat,lon,radius)
+    overlap = np.zeros(len(cells))
+    if len(buildings) > 0:
+        buildingIndex, cellIndex = shapely.STRtree(cells).query(buildings,predicate='intersects')
+        areas = shapely.area(shapely.intersection(buildings[buildingIndex],cells[cellIndex]))
+        overlap = np.bincount(cellIndex,weights=areas,minlength=len(cells))
+    overlap = np.cumsum(overlap.reshape(-1,nRings),axis=1)
+    cellAreas = np.cumsum(shapely.area(cells).reshape(-1,nRings),axis=1)
+    return(100.0*overlap/cellAreas)
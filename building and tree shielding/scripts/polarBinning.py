@@ -0,0 +1,228 @@
+############### polarBinning.py #############
+# Developed for HEI Transit Study
+# Summary: split the roads around a maternal residence into pieces by wind sector and 10m distance ring
+#          with numpy, replacing the per-residence buffers, wind buffer clips, 360 sector clips, and near
+#          analysis that shieldingScript.py used to assign roads to sectors and buffer distances
+# Steps include:
+# 1) selecting road segments whose bounding box is within 500m of the residence
+# 2) projecting them to a local plane around the residence, scaled by the WGS84 radii of curvature at the
+#    residence, so planar distances and lengths match geodesic ones to well under a centimeter within 500m
+# 3) finding where each segment crosses the 10m ring circles and the sector edges of the wind rose.  Sector
+#    edges point at the outer vertices of the wind rose triangles (see wind metrics/scripts/roseGeometry.py)
+#    rather than at exact bearings, so pieces match clips by the wind rose shapefile
+# 4) cutting all segments at their crossings in one pass, and labelling each piece with the sector and ring
+#    containing its midpoint.  Pieces outside 500m are dropped
+# Each piece lies in one sector and ring, so its nearest distance to the residence falls in its ring, as
+# the NEAR_DIST of the sector clips did
+
+
+############### Setup: import libraries and define constants ##############
+import numpy as np
+import pandas as ps
+
+N_SECTORS = 360
+RING_WIDTH = 10.0 # meters, spacing of the shielding buffers
+MAX_DIST = 500.0 # meters, largest buffer used in the shielding analysis
+WGS84_A = 6378137.0
+WGS84_E2 = 0.00669437999014
+ROSE_DISTANCE = 55000.0/6378140.0 # angular distance to the outer edge of the wind rose triangles
+DEG_TO_RAD = 0.0174533 # same conversion as the wind rose triangles
+MIN_PIECE = 1e-9 # fraction of a segment.  Shorter pieces are crossings counted twice
+
+
+
+################ Reading roads ##############
+
+# read road files as straight line segments in WGS84 coordinates.  The road class of each segment is the
+# index of its file in roadFiles
+# INPUTS:
+#    roadFiles (list) - filepaths of the road shapefiles
+# OUTPUTS:
+#    segments (dict) - 'x1', 'y1', 'x2', 'y2' (lon/lat) and 'roadClass' arrays
+def readRoadSegments(roadFiles):
+    import arcpy
+    wgs84 = arcpy.SpatialReference(4326)
+    starts, ends, roadClasses = [], [], []
+    for roadClass, roadFile in enumerate(roadFiles):
+        with arcpy.da.SearchCursor(roadFile,['SHAPE@'],spatial_reference=wgs84) as cursor:
+            for row in cursor:
+                if row[0] is None:
+                    continue
+                for part in row[0]:
+                    line = np.array([(point.X,point.Y) for point in part if point is not None],np.float64).reshape(-1,2)
+                    starts.append(line[:-1])
+                    ends.append(line[1:])
+                    roadClasses.append(np.full(max(len(line)-1,0),roadClass,np.uint8))
+    starts = np.concatenate(starts) if len(starts) > 0 else np.zeros((0,2))
+    ends = np.concatenate(ends) if len(ends) > 0 else np.zeros((0,2))
+    roadClasses = np.concatenate(roadClasses) if len(roadClasses) > 0 else np.zeros(0,np.uint8)
+    return({'x1':starts[:,0],'y1':starts[:,1],'x2':ends[:,0],'y2':ends[:,1],'roadClass':roadClasses})
+
+# find the segments whose bounding box comes within a distance of a residence
+# INPUTS:
+#    segments (dict) - created by readRoadSegments
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+# OUTPUTS:
+#    numpy array of segment indeces
+def getNearbySegments(segments,lat,lon,radius=MAX_DIST):
+    metersPerLat, metersPerLon = getLocalScale(lat)
+    latMargin, lonMargin = radius/metersPerLat, radius/metersPerLon
+    isNear = (
+        (np.minimum(segments['y1'],segments['y2']) <= lat + latMargin) &
+        (np.maximum(segments['y1'],segments['y2']) >= lat - latMargin) &
+        (np.minimum(segments['x1'],segments['x2']) <= lon + lonMargin) &
+        (np.maximum(segments['x1'],segments['x2']) >= lon - lonMargin)
+    )
+    return(np.nonzero(isNear)[0])
+
+
+
+################ Local projection ##############
+
+# get the length of a degree of latitude and longitude at a latitude (WGS84 radii of curvature)
+# INPUTS:
+#    lat (float) - latitude in degrees
+# OUTPUTS:
+#    metersPerLat, metersPerLon (float)
+def getLocalScale(lat):
+    sinLat = np.sin(np.radians(lat))
+    denominator = 1 - WGS84_E2*sinLat**2
+    metersPerLat = np.radians(WGS84_A*(1 - WGS84_E2)/denominator**1.5)
+    metersPerLon = np.radians(WGS84_A/np.sqrt(denominator))*np.cos(np.radians(lat))
+    return(metersPerLat,metersPerLon)
+
+# get unit vectors along the sector edges of a wind rose.  Edge a points from the residence to the outer
+# vertex at bearing a, so sector a lies between edges a and a+1
+# INPUTS:
+#    lat, lon (float) - residence coordinates in degrees
+# OUTPUTS:
+#    numpy array organized by (edge, east/north)
+def calcSectorEdges(lat,lon):
+    latRadians, lonRadians = lat*DEG_TO_RAD, lon*DEG_TO_RAD
+    bearings = np.arange(N_SECTORS,dtype=np.float64)*DEG_TO_RAD
+    edgeLats = np.arcsin(np.sin(latRadians)*np.cos(ROSE_DISTANCE) + np.cos(latRadians)*np.sin(ROSE_DISTANCE)*np.cos(bearings))
+    edgeLons = lonRadians + np.arctan2(np.sin(bearings)*np.sin(ROSE_DISTANCE)*np.cos(latRadians),
+        np.cos(ROSE_DISTANCE) - np.sin(latRadians)*np.sin(edgeLats))
+    metersPerLat, metersPerLon = getLocalScale(lat)
+    edges = np.stack([(edgeLons/DEG_TO_RAD - lon)*metersPerLon,(edgeLats/DEG_TO_RAD - lat)*metersPerLat],axis=1)
+    return(edges/np.linalg.norm(edges,axis=1,keepdims=True))
+
+# get the sector containing each point
+# INPUTS:
+#    east, north (numpy arrays) - local coordinates in meters
+#    edges (numpy array) - created by calcSectorEdges
+# OUTPUTS:
+#    int numpy array of sectors
+def calcSectors(east,north,edges):
+    sectors = np.floor(np.degrees(np.arctan2(east,north))).astype(np.int64) % N_SECTORS
+    # edges are within a fraction of a degree of their bearing, so the estimate is off by at most one
+    for step in range(2):
+        lower, upper = edges[sectors], edges[(sectors+1) % N_SECTORS]
+        isBefore = lower[:,0]*north - lower[:,1]*east > 0 # counterclockwise of the lower edge
+        isAfter = upper[:,0]*north - upper[:,1]*east <= 0 # on or clockwise of the upper edge
+        sectors = (sectors - isBefore + isAfter) % N_SECTORS
+    return(sectors)
+
+
+
+################ Binning ##############
+
+# get where segments cross the ring circles and sector edges, as fractions of each segment
+# INPUTS:
+#    east1, north1 (numpy arrays) - segment starts in local meters
+#    dEast, dNorth (numpy arrays) - segment start to end in local meters
+#    edges (numpy array) - created by calcSectorEdges
+#    ringDists (numpy array) - ring boundary distances in meters, including the outer radius
+# OUTPUTS:
+#    numpy array organized by (segment, crossing), nan where there is no crossing inside the segment
+def calcCrossings(east1,north1,dEast,dNorth,edges,ringDists):
+    east1, north1, dEast, dNorth = [value[:,np.newaxis] for value in [east1,north1,dEast,dNorth]]
+
+    # sector edges: the cross product of the edge and the point is 0, and the point is on the edge side
+    with np.errstate(divide='ignore',invalid='ignore'):
+        denominator = edges[:,0]*dNorth - edges[:,1]*dEast
+        edgeT = -(edges[:,0]*north1 - edges[:,1]*east1)/denominator
+        isFront = edges[:,0]*(east1 + edgeT*dEast) + edges[:,1]*(north1 + edgeT*dNorth) > 0
+    edgeT = np.where(isFront & (denominator != 0),edgeT,np.nan)
+
+    # ring circles: |start + t*delta|^2 = r^2
+    a = dEast**2 + dNorth**2
+    b = 2*(east1*dEast + north1*dNorth)
+    discriminant = b**2 - 4*a*(east1**2 + north1**2 - ringDists**2)
+    root = np.sqrt(np.maximum(discriminant,0))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ringT = np.concatenate([(-b - root)/(2*a),(-b + root)/(2*a)],axis=1)
+    ringT[np.tile(discriminant <= 0,2) | np.isnan(ringT)] = np.nan
+
+    crossings = np.concatenate([edgeT,ringT],axis=1)
+    crossings[~((crossings > 0) & (crossings < 1))] = np.nan
+    return(crossings)
+
+# split the road segments around a residence into pieces by wind sector and distance ring
+# INPUTS:
+#    segments (dict) - created by readRoadSegments
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - pieces farther than radius meters are dropped
+#    ringWidth (float) - ring spacing in meters
+# OUTPUTS:
+#    pieces (dict) - numpy arrays with one value per piece:
+#        'sector' - wind rose sector (0-359), 'ring' - inner distance of the ring in meters,
+#        'roadClass', 'length' - geodesic length in meters, 'nearDist' - distance in meters from the
+#        residence to the nearest point of the piece, 'segment' - index of the source segment, and
+#        'x1', 'y1', 'x2', 'y2' - piece end points (lon/lat)
+def binSegments(segments,lat,lon,radius=MAX_DIST,ringWidth=RING_WIDTH):
+    segmentIndex = getNearbySegments(segments,lat,lon,radius)
+    metersPerLat, metersPerLon = getLocalScale(lat)
+    east1 = (segments['x1'][segmentIndex] - lon)*metersPerLon
+    north1 = (segments['y1'][segmentIndex] - lat)*metersPerLat
+    dEast = (segments['x2'][segmentIndex] - lon)*metersPerLon - east1
+    dNorth = (segments['y2'][segmentIndex] - lat)*metersPerLat - north1
+    edges = calcSectorEdges(lat,lon)
+    ringDists = np.arange(ringWidth,radius + ringWidth/2,ringWidth)
+
+    # cut every segment at its sorted crossings.  Missing crossings sort to the end as nan
+    crossings = calcCrossings(east1,north1,dEast,dNorth,edges,ringDists)
+    cuts = np.concatenate([np.zeros((len(segmentIndex),1)),crossings,np.ones((len(segmentIndex),1))],axis=1)
+    cuts = np.sort(cuts,axis=1)
+    cuts = np.where(np.isnan(cuts),1.0,cuts)
+    startT, endT = cuts[:,:-1], cuts[:,1:]
+    rows, cols = np.nonzero(endT - startT > MIN_PIECE)
+    startT, endT = startT[rows,cols], endT[rows,cols]
+    midT = (startT + endT)/2
+    midEast, midNorth = east1[rows] + midT*dEast[rows], north1[rows] + midT*dNorth[rows]
+    midDist = np.sqrt(midEast**2 + midNorth**2)
+    isInside = midDist < radius
+    rows, startT, endT = rows[isInside], startT[isInside], endT[isInside]
+    midEast, midNorth, midDist = midEast[isInside], midNorth[isInside], midDist[isInside]
+
+    # nearest point of each piece to the residence
+    segmentLength = np.sqrt(dEast[rows]**2 + dNorth[rows]**2)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        nearT = -(east1[rows]*dEast[rows] + north1[rows]*dNorth[rows])/segmentLength**2
+    nearT = np.clip(np.nan_to_num(nearT),startT,endT)
+    nearDist = np.sqrt((east1[rows] + nearT*dEast[rows])**2 + (north1[rows] + nearT*dNorth[rows])**2)
+
+    source = segmentIndex[rows]
+    x1, y1 = segments['x1'][source], segments['y1'][source]
+    xDelta, yDelta = segments['x2'][source] - x1, segments['y2'][source] - y1
+    pieces = {
+        'sector':calcSectors(midEast,midNorth,edges).astype(np.int16),
+        'ring':(np.floor(midDist/ringWidth)*ringWidth).astype(np.int16),
+        'roadClass':segments['roadClass'][source],
+        'length':(endT - startT)*segmentLength,
+        'nearDist':nearDist,
+        'segment':source,
+        'x1':x1 + startT*xDelta,'y1':y1 + startT*yDelta,
+        'x2':x1 + endT*xDelta,'y2':y1 + endT*yDelta
+    }
+    return(pieces)
+
+# get the road length in each (sector, ring, road class) bin
+# INPUTS:
+#    pieces (dict) - created by binSegments
+# OUTPUTS:
+#    pandas dataframe with sector, ring, roadClass, and length columns
+def summarizeBins(pieces):
+    binData = ps.DataFrame({key:pieces[key] for key in ['sector','ring','roadClass','length']})
+    return(binData.groupby(['sector','ring','roadClass'],as_index=False)['length'].sum())
@@ -0,0 +1,187 @@
+############### polarSampling.py #############
+# Developed for HEI Transit Study
+# Summary: mean tree cover of every wind sector within every 10m buffer of a maternal residence, from one
+#          windowed read of the statewide tree raster.  Replaces the per-residence ExtractByMask, BILINEAR
+#          Resample to ~3m, and one ZonalStatisticsAsTable per buffer in shieldingScript.py
+# Steps include:
+# 1) creating a template of sample offsets on a ~3m grid within 500m, with the ring of each sample.  The
+#    template is created once per process and reused for every residence
+# 2) reading the window of the tree raster covering 500m around the residence into a numpy array
+# 3) placing the template at the residence, assigning each sample to a wind sector (see polarBinning.py),
+#    and gathering bilinear tree cover values at the samples, as the resampled raster did
+# 4) summing values by (sector, ring) and accumulating rings, giving the mean within each buffer distance
+#    for all 360 sectors and 50 buffers at once
+# Samples on NoData cells are ignored, and sectors without valid samples take the value of the nearest
+# sector in the same buffer, as missing zonal statistics were filled
+
+
+############### Setup: import libraries and define constants ##############
+import numpy as np
+import polarBinning
+
+SAMPLE_SPACING = 3.0 # meters, about the 0.000026949456 degree cells the tree raster was resampled to
+templateCache = {} # sample templates, created once per process by getTemplate
+
+
+
+################ Template ##############
+
+# create sample offsets on a square grid within a radius of the residence
+# INPUTS:
+#    radius (float) - distance in meters
+#    ringWidth (float) - ring spacing in meters
+#    spacing (float) - sample spacing in meters
+# OUTPUTS:
+#    template (dict) - 'east' and 'north' offsets in meters, the 'ring' index of each sample (0 for the
+#                      first ringWidth meters), and 'nRings'
+def createTemplate(radius=polarBinning.MAX_DIST,ringWidth=polarBinning.RING_WIDTH,spacing=SAMPLE_SPACING):
+    steps = (np.arange(-np.floor(radius/spacing),np.floor(radius/spacing)+1))*spacing
+    east, north = np.meshgrid(steps,steps)
+    east, north = east.ravel(), north.ravel()
+    dist = np.sqrt(east**2 + north**2)
+    isInside = (dist <= radius) & (dist > 0) # the residence itself has no sector
+    template = {
+        'east':east[isInside],
+        'north':north[isInside],
+        'ring':np.minimum(np.floor(dist[isInside]/ringWidth),radius/ringWidth - 1).astype(np.int64),
+        'nRings':int(round(radius/ringWidth))
+    }
+    return(template)
+
+# get a sample template, creating it the first time it is needed in a process
+# INPUTS:
+#    radius, ringWidth, spacing (float) - see createTemplate
+# OUTPUTS:
+#    template (dict)
+def getTemplate(radius=polarBinning.MAX_DIST,ringWidth=polarBinning.RING_WIDTH,spacing=SAMPLE_SPACING):
+    key = (radius,ringWidth,spacing)
+    if key not in templateCache:
+        templateCache[key] = createTemplate(radius,ringWidth,spacing)
+    return(templateCache[key])
+
+
+
+################ Raster windows ##############
+
+# get the rows and columns of a raster covering a distance around a residence, with one extra cell on
+# each side so bilinear neighbours of edge samples are included
+# INPUTS:
+#    grid (dict) - 'west', 'north', 'cellWidth', 'cellHeight' in degrees, and 'nRows', 'nCols' of the raster
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+# OUTPUTS:
+#    firstRow, lastRow, firstCol, lastCol (int) - pixel range, last row and column excluded
+def getPixelWindow(grid,lat,lon,radius=polarBinning.MAX_DIST):
+    metersPerLat, metersPerLon = polarBinning.getLocalScale(lat)
+    firstCol = max(int(np.floor((lon - radius/metersPerLon - grid['west'])/grid['cellWidth'])) - 1,0)
+    lastCol = min(int(np.ceil((lon + radius/metersPerLon - grid['west'])/grid['cellWidth'])) + 1,grid['nCols'])
+    firstRow = max(int(np.floor((grid['north'] - lat - radius/metersPerLat)/grid['cellHeight'])) - 1,0)
+    lastRow = min(int(np.ceil((grid['north'] - lat + radius/metersPerLat)/grid['cellHeight'])) + 1,grid['nRows'])
+    return(firstRow,max(lastRow,firstRow),firstCol,max(lastCol,firstCol))
+
+# get the grid geometry of a raster.  The raster must be in a geographic (lon/lat) coordinate system
+# INPUTS:
+#    raster (arcpy Raster)
+# OUTPUTS:
+#    grid (dict) - see getPixelWindow
+def getRasterGrid(raster):
+    grid = {
+        'west':raster.extent.XMin,
+        'north':raster.extent.YMax,
+        'cellWidth':raster.meanCellWidth,
+        'cellHeight':raster.meanCellHeight,
+        'nRows':raster.height,
+        'nCols':raster.width
+    }
+    return(grid)
+
+# read the window of a raster covering a distance around a residence.  The raster must be in a
+# geographic (lon/lat) coordinate system
+# INPUTS:
+#    rasterFile (str) - filepath of the raster
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+# OUTPUTS:
+#    window (dict) - 'values' (float64 array, nan for NoData), 'west' and 'north' edges of the window,
+#                    and 'cellWidth', 'cellHeight' in degrees
+def readRasterWindow(rasterFile,lat,lon,radius=polarBinning.MAX_DIST):
+    import arcpy
+    raster = arcpy.Raster(rasterFile)
+    grid = getRasterGrid(raster)
+    firstRow, lastRow, firstCol, lastCol = getPixelWindow(grid,lat,lon,radius)
+    west = grid['west'] + firstCol*grid['cellWidth']
+    south = grid['north'] - lastRow*grid['cellHeight']
+    values = arcpy.RasterToNumPyArray(raster,arcpy.Point(west,south),lastCol - firstCol,lastRow - firstRow).astype(np.float64)
+    if raster.noDataValue is not None:
+        values[values == raster.noDataValue] = np.nan
+    window = {
+        'values':values,
+        'west':west,
+        'north':grid['north'] - firstRow*grid['cellHeight'],
+        'cellWidth':grid['cellWidth'],
+        'cellHeight':grid['cellHeight']
+    }
+    return(window)
+
+# bilinear interpolation of a raster window at a set of coordinates.  Cell values are at cell centers,
+# and coordinates with a NoData neighbour or outside the window are nan
+# INPUTS:
+#    window (dict) - created by readRasterWindow
+#    lats, lons (numpy arrays) - coordinates in degrees
+# OUTPUTS:
+#    float64 numpy array
+def gatherBilinear(window,lats,lons):
+    values = window['values']
+    colPosition = (lons - window['west'])/window['cellWidth'] - 0.5
+    rowPosition = (window['north'] - lats)/window['cellHeight'] - 0.5
+    col0, row0 = np.floor(colPosition).astype(np.int64), np.floor(rowPosition).astype(np.int64)
+    colWeight, rowWeight = colPosition - col0, rowPosition - row0
+    isInside = (col0 >= 0) & (row0 >= 0) & (col0 + 1 < values.shape[1]) & (row0 + 1 < values.shape[0])
+    col0, row0 = np.where(isInside,col0,0), np.where(isInside,row0,0)
+    col1, row1 = np.minimum(col0 + 1,values.shape[1] - 1), np.minimum(row0 + 1,values.shape[0] - 1)
+    top = values[row0,col0]*(1 - colWeight) + values[row0,col1]*colWeight
+    bottom = values[row1,col0]*(1 - colWeight) + values[row1,col1]*colWeight
+    return(np.where(isInside,top*(1 - rowWeight) + bottom*rowWeight,np.nan))
+
+
+
+################ Sector and buffer means ##############
+
+# calculate the mean raster value of every wind sector within every buffer distance of a residence
+# INPUTS:
+#    window (dict) - created by readRasterWindow
+#    lat, lon (float) - residence coordinates in degrees
+#    template (dict) - created by getTemplate
+# OUTPUTS:
+#    numpy array organized by (sector, buffer), where buffer b covers distances up to (b+1) ring widths.
+#    nan for sectors without valid samples
+def calcSectorMeans(window,lat,lon,template):
+    metersPerLat, metersPerLon = polarBinning.getLocalScale(lat)
+    sectors = polarBinning.calcSectors(template['east'],template['north'],polarBinning.calcSectorEdges(lat,lon))
+    values = gatherBilinear(window,lat + template['north']/metersPerLat,lon + template['east']/metersPerLon)
+    isValid = ~np.isnan(values)
+    binIndex = sectors[isValid]*template['nRings'] + template['ring'][isValid]
+    nBins = polarBinning.N_SECTORS*template['nRings']
+    sums = np.bincount(binIndex,weights=values[isValid],minlength=nBins).reshape(-1,template['nRings'])
+    counts = np.bincount(binIndex,minlength=nBins).reshape(-1,template['nRings'])
+    with np.errstate(divide='ignore',invalid='ignore'):
+        means = np.cumsum(sums,axis=1)/np.cumsum(counts,axis=1)
+    return(means)
+
+# fill sectors without a value with the value of the nearest sector (circular) in the same buffer
+# INPUTS:
+#    means (numpy array) - created by calcSectorMeans
+# OUTPUTS:
+#    numpy array, nan only for buffers without any valid sector
+def fillMissingSectors(means):
+    filled = means.copy()
+    sectors = np.arange(polarBinning.N_SECTORS)
+    for buffer in range(means.shape[1]):
+        isValid = ~np.isnan(means[:,buffer])
+        if isValid.all() or not isValid.any():
+            continue
+        validSectors = sectors[isValid]
+        gap = np.abs(sectors[:,np.newaxis] - validSectors[np.newaxis,:])
+        gap = np.minimum(gap,polarBinning.N_SECTORS - gap)
+        filled[:,buffer] = means[validSectors[np.argmin(gap,axis=1)],buffer]
+    return(filled)
@@ -15,34 +15,28 @@
 
 
 ############### Setup: import libraries and define constants ##############
-sucessfulImport = False
 import time
 import os
+import sys
 from multiprocessing import Pool
 import numpy as np
 import pandas as ps
-import random
 import gConst as const
-
-# needed when using the ArcGIS license for a large # of parallel threads
-while(sucessfulImport == False):
-    try:
-        #print("try again")
-        import arcpy
-        from arcpy.ia import * 
-        from arcpy import env
-        from arcpy.sa import *
-        arcpy.env.overwriteOutput = True
-        arcpy.CheckOutExtension("Spatial")
-        sucessfulImport = True
-    except Exception as e:
-        print("couldn't import arcgis: %s" %(str(e)))
-        time.sleep(1)
-
+import polarBinning
+import polarSampling
+import footprintIndex
+import tileCache
+# wind roses are read with roseGeometry.py from the wind metrics scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","..","wind metrics","scripts"))
+import roseGeometry
+
+arcpy = None # imported once per process by loadArcpy, so importing this module has no side effects
+workerRoses = {} # GeoParquet wind rose dataset, opened once per process by getRoseDataset
+workerTiles = {} # tile caches of the roads, footprints, and tree raster, opened once per process by getTileCache
 
 YEAR = 2009
 
-# needed to create geometry points for each maternal residence lat/lon
+# spatial reference of the road pieces saved for each maternal residence
 GCS = "GEOGCS['GCS_WGS_1984',DATUM['D_WGS_1984',SPHEROID['WGS_1984',6378137.0,298.257223563]],PRIMEM['Greenwich',0.0],UNIT['Degree',0.0174532925199433]]" 
 
 # read c_date, b_date from birth records file
@@ -51,183 +45,91 @@ BIRTH_META = const.WIND_FOLDER + "Birth_Addresses_Wind/births_by_year/csvs/birth
 SMALLEST_BUFFER, BIGGEST_BUFFER = 10, 500 # analysis is restricted to 0.5km
 PARENT_FOLDER = const.WIND_FOLDER
 
-# given point of maternal residence, create buffers from 10 to 500 m at 10m increments
-# INPUTS:
-#    geometryPoint (arcpy geometry object) - point cenetered at the maternal residence
-#    paths (dictionary) - set of input and output filepaths
-def createBuffers(geometryPoint,paths):
-    if not os.path.exists(paths['bufferFolder']):
-        os.mkdir(paths['bufferFolder'])
-    curBuffer = SMALLEST_BUFFER
-    while (curBuffer <= BIGGEST_BUFFER):
-        outputShapefilepath = paths['bufferFolder'] + "/b" + str(curBuffer) + paths['uniqueid'] + ".shp"
-        if not(os.path.exists(outputShapefilepath)):
-            arcpy.Buffer_analysis(
-                geometryPoint, outputShapefilepath, str(curBuffer) + " Meters", "FULL", "ROUND", method="GEODESIC"
-            )
-        curBuffer +=10
-
-
-# given point of maternal residence, create buffers from 10 to 500 m at 10m increments
-# INPUTS:
-#    geometryPoint (arcpy geometry object) - point cenetered at the maternal residence
-#    paths (dictionary) - set of input and output filepaths
-def deleteBuffers(paths):
-    curBuffer = SMALLEST_BUFFER
-    while (curBuffer <= BIGGEST_BUFFER):
-        outputShapefilepath = paths['bufferFolder'] + "/b" + str(curBuffer) + paths['uniqueid'] + ".shp"
-        if (os.path.exists(outputShapefilepath)):
-            arcpy.Delete_management(outputShapefilepath)
-        curBuffer +=10
-
-# given list of input and output filepaths, create clips of the wind shapefile at increments of 10m
-# INPUTS:
-#     paths (dictionary) - set of input and output filepaths
-def createWindBuffers(paths):
-    if not os.path.exists(paths['windBufferFolder']):
-        os.mkdir(paths['windBufferFolder'])
-    curBuffer = SMALLEST_BUFFER
-    while (curBuffer <= BIGGEST_BUFFER):
-        outputShapefilepath = paths['windBufferFolder'] + "/bw" + str(curBuffer) + paths['uniqueid'] + ".shp"
-        bufferShapefile = paths['bufferFolder'] + "/b" + str(curBuffer) + paths['uniqueid'] + ".shp"
-        arcpy.Clip_analysis(paths['windShp'], bufferShapefile, outputShapefilepath)
-        curBuffer +=10
-
-
-# given list of input and output filepaths, create clips of the wind shapefile at increments of 10m
-# INPUTS:
-#     paths (dictionary) - set of input and output filepaths
-def deleteWindBuffers(paths):
-    curBuffer = SMALLEST_BUFFER
-    while (curBuffer <= BIGGEST_BUFFER):
-        outputShapefilepath = paths['windBufferFolder'] + "/bw" + str(curBuffer) + paths['uniqueid'] + ".shp"
-        if(os.path.exists(outputShapefilepath)):
-            arcpy.Delete_management(outputShapefilepath)
-        
-        curBuffer +=10
-
-
-# in case of missing buffer values, find the nearest buffer with a valid value
-# INPUTS:
-#    num1 (int) - buffer distance where the value is missing
-#    numList (int list) - list of distances with valid values
-# OUTPUT:
-#    closest distance with a valid value
-def findNearestIndex(num1,numList):
-    diffs = np.abs(np.subtract(numList,num1))
-    return(np.argmin(diffs))
-
-# fill in missing values for analyses where the tree rasters have missing values
-# INPUTS:
-#    intable (filepath) - absolute filepath of shapefile with an attribute table
-#    bufferDist (int) - buffer distance that is missing a value
-# OUTPUTS: 
-#    pandas dataframe representation of the intable, updated with missing vals filled
-def fillMisingVals(intable,bufferDist):
-    rawData = table_to_data_frame(intable)
-    coveredIndexes = list(rawData['FID_'])
-    vals = list(rawData['MEAN'])
-
-    # QA check
-    if(len(vals)<360):
-
-        # for each radial degree, if the value is missing then fill with the nearest bufffer distance of the 
-        # same radial degree with a valid value
-        for index in range(360):
-            if index not in coveredIndexes:
-                closestIndex = findNearestIndex(index,coveredIndexes)
-                coveredIndexes.append(index)
-                vals.append(vals[closestIndex])
-
-    # combine updated lists into a single dataframe
-    updatedDF = ps.DataFrame({
-        'FID':coveredIndexes,
-        'trSh' :vals,
-        'bufferDist':[bufferDist for a in range(len(vals))]
-    })
-    return(updatedDF)
-
-# convert arcgis table of building shielding estimates into pandas dataframe
-# INPUTS:
-#    inTable (str) - full filepath to the arcgis table
-#    bufferDist (int) - buffer distance estimates in the inTable
-# OUTPUTS:
-#    updatedDF (pandas dataframe) - in Table in pandas format
-def buildingToDF(inTable,bufferDist):
-    rawData =  table_to_data_frame(inTable)
-    coveredIndexes = list(rawData['FID_'])
-    vals = list(rawData['PERCENTAGE'])
-    updatedDF = ps.DataFrame({
-        'FID':coveredIndexes,
-        'bldgSh' :vals,
-        'bufferDist':[bufferDist for a in range(len(vals))]
-    })
-    return(updatedDF)
-
-# convert arcgis table into a pandas df with an object ID index
-# INPUTFS:
-#    in_table (str) - full filepath to the table to convert
+# format of the wind roses, must match OUTPUT_FORMAT in wind metrics/scripts/residentialWindParallel.py.
+# 'geoparquet' reads the year's rose dataset, 'shapefile' reads one shapefile per residence
+ROSE_FORMAT = 'geoparquet'
+ROSE_FOLDER = roseGeometry.getRoseFolder(PARENT_FOLDER + "/outputRoses/",YEAR)
+
+# import arcpy and check out the spatial analyst extension, once per process
+# needed when using the ArcGIS license for a large # of parallel threads
 # OUTPUTS:
-#    pandas dataframe version of in_table
-def table_to_data_frame(in_table):
-    OIDFieldName = arcpy.Describe(in_table).OIDFieldName
-    final_fields = [field.name for field in arcpy.ListFields(in_table)]
-    data = [row for row in arcpy.da.SearchCursor(in_table, final_fields)]
-    fc_dataframe = ps.DataFrame(data, columns=final_fields)
-    fc_dataframe = fc_dataframe.set_index(OIDFieldName, drop=True)
-    return fc_dataframe
-
-# calculate percent tree between roads and maternal residence.  Repeat every 10m
-# to apply to road networks at 10m resolution
+#    arcpy module
+def loadArcpy():
+    global arcpy
+    while arcpy is None:
+        try:
+            import arcpy as arcpyModule
+            arcpyModule.env.overwriteOutput = True
+            arcpyModule.CheckOutExtension("Spatial")
+            arcpy = arcpyModule
+        except Exception as e:
+            print("couldn't import arcgis: %s" %(str(e)))
+            time.sleep(1)
+    return(arcpy)
+
+# calculate percent tree between roads and maternal residence for each radial degree and buffer distance
+# with a road segment, from one windowed read of the tree raster (see polarSampling.py).  Radial degrees
+# without tree values take the value of the nearest radial degree
 # INPUTS:
-#    bufferDist (int) - buffer distance to calculate percent trees
+#    birthRecord (pandas dataframe) - contains one row, one unique birth record
+#    bufferDists (list of ints) - buffer distances with a road segment.  Roads within the first 10m use
+#                                 the 10m buffer
+#    windFIDs (numpy array) - FID of each radial degree in the wind rose, see readWindRose
 #    paths (dictionary) - list of input and output filepaths
 # OUTPUTS:
-#    dataframe containing estimated percent tree cover for each radial degree for the
-#    given buffer distance
-def calcZonalIntersectTree(bufferDist,paths):
-    try:
-        windShapefile = paths['windBufferFolder'] + "/bw" + str(bufferDist) + paths['uniqueid'] + ".shp"
-        zonalFile =   paths['tmpTreeFolder'] + "/z" + str(bufferDist) + "_" + paths['uniqueid'] + ".dbf" # temporary file.  Deleted later
-
-        # calcualte zonal statistics, fill in mising vals, and return as dataframe
-        if not(os.path.exists(zonalFile)):
-            arcpy.sa.ZonalStatisticsAsTable(
-                windShapefile, "FID", paths['resampled_tree'], zonalFile, "DATA", "MEAN"
-            )
-        df = fillMisingVals(zonalFile,bufferDist)
-        arcpy.Delete_management(zonalFile)
-        return(df)
-    except Exception as e:
-        print("failed to calculate zonal statistics for trees")
-        print(str(e))
-        print(str(bufferDist))
-
-# calculate percent building between roads and maternal residence.  Repeat every 10m
-# to apply to road networks at 10m resolution
+#    dataframe containing estimated percent tree cover for each radial degree and buffer distance
+def calcPolarTree(birthRecord,bufferDists,windFIDs,paths):
+    lat, lon = float(birthRecord['b_lat']), float(birthRecord['b_long'])
+    window = tileCache.loadRasterWindow(getTileCache(paths['treeTiles']),lat,lon,BIGGEST_BUFFER)
+    template = polarSampling.getTemplate(BIGGEST_BUFFER,SMALLEST_BUFFER)
+    means = polarSampling.fillMissingSectors(polarSampling.calcSectorMeans(window,lat,lon,template))
+    sectors = np.nonzero(windFIDs >= 0)[0]
+    dfArr = []
+    for bufferDist in bufferDists:
+        bufferIndex = int(max(bufferDist,SMALLEST_BUFFER)/SMALLEST_BUFFER) - 1
+        dfArr.append(ps.DataFrame({
+            'FID':windFIDs[sectors],
+            'trSh':means[sectors,bufferIndex],
+            'bufferDist':[bufferDist for a in range(len(sectors))]
+        }))
+    return(mergeSet(dfArr))
+
+# open the tiles of a statewide source (see tileCache.py), once per process.  Recently used tiles are
+# kept in memory by the tile cache
+# INPUTS:
+#    tileFolder (str) - tile folder of the source
+# OUTPUTS:
+#    tile cache (dict) - see tileCache.openTileCache
+def getTileCache(tileFolder):
+    if tileFolder not in workerTiles:
+        workerTiles[tileFolder] = tileCache.openTileCache(tileFolder)
+    return(workerTiles[tileFolder])
+
+# calculate percent building between roads and maternal residence for each radial degree and buffer
+# distance with a road segment (see footprintIndex.py).  As with TabulateIntersection, only radial
+# degrees that intersect a building are included
 # INPUTS:
-#    bufferDist (int) - buffer distance to calculate percent building
+#    birthRecord (pandas dataframe) - contains one row, one unique birth record
+#    bufferDists (list of ints) - buffer distances with a road segment.  Roads within the first 10m use
+#                                 the 10m buffer
+#    windFIDs (numpy array) - FID of each radial degree in the wind rose, see readWindRose
 #    paths (dictionary) - list of input and output filepaths
 # OUTPUTS:
-#    dataframe containing estimates percent building cover for each radial degree for the given 
-#    buffer distances
-def calcZonalIntersectBuilding(bufferDist,paths):
-    try:
-        windShapefile = paths['windBufferFolder'] + "/bw" + str(bufferDist) + paths['uniqueid'] + ".shp"
-        outputZonalFile = paths['tmpBuildingFolder'] + "/i" + str(bufferDist) + "_" + paths['uniqueid'] + ".dbf" # temporary file.  Deleted later
-
-        # calculate zonal statistics, return as dataframe
-        if not(os.path.exists(outputZonalFile)):
-            arcpy.TabulateIntersection_analysis(
-                windShapefile, "FID", paths['clipped_building'], outputZonalFile
-            )
-        df = buildingToDF(outputZonalFile,bufferDist)
-        arcpy.Delete_management(outputZonalFile)
-        return(df)
-    except Exception as e:
-        print("failed to calcualte zonal statistics for buildings")
-        print(str(e))
-        print(str(bufferDist))
+#    dataframe containing percent building cover for each radial degree and buffer distance
+def calcPolarBuilding(birthRecord,bufferDists,windFIDs,paths):
+    lat, lon = float(birthRecord['b_lat']), float(birthRecord['b_long'])
+    footprints = tileCache.loadFootprints(getTileCache(paths['footprintTiles']),lat,lon,BIGGEST_BUFFER)
+    cover = footprintIndex.calcBuildingCover(footprintIndex.createFootprintIndex(footprints),lat,lon,BIGGEST_BUFFER,SMALLEST_BUFFER)
+    dfArr = []
+    for bufferDist in bufferDists:
+        bufferIndex = int(max(bufferDist,SMALLEST_BUFFER)/SMALLEST_BUFFER) - 1
+        sectors = np.nonzero((windFIDs >= 0) & (cover[:,bufferIndex] > 0))[0]
+        dfArr.append(ps.DataFrame({
+            'FID':windFIDs[sectors],
+            'bldgSh':cover[sectors,bufferIndex],
+            'bufferDist':[bufferDist for a in range(len(sectors))]
+        }))
+    return(mergeSet(dfArr))
 
 # given one dataframe for each buffer distance, combine all dataframes into a single dataframe
 # INPUTS:
@@ -235,137 +137,136 @@ def calcZonalIntersectBuilding(bufferDist,paths):
 # OUTPUTS:
 #   mergedSet (pandas dataframe) - single dataframe containing all data from dfArr
 def mergeSet(dfArr):
-    mergedSet = dfArr[0]
-    for curDF in dfArr[1:]:
-        mergedSet = mergedSet.append(curDF)
+    mergedSet = ps.concat(dfArr,ignore_index=True)
     return(mergedSet)
 
-# given shielding estimates for building and trees, combine them into a single dataset
+# given shielding estimates for building and trees, combine them into a single dataset with the hours
+# downwind of each sector
 # INPUTS:
 #    shield1 (pandas dataframe) - pandas dataframe containing tree shielding estimates
 #    shield2 (pandas dataframe) - contains building shielding estimates
+#    windRose (dict) - created by readWindRose
 # OUTPUTS:
 #    mergedSet (pandas dataframe) - combined data from shield1 and shield2
-def mergeShields(shield1,shield2,paths):
+def mergeShields(shield1,shield2,windRose,paths):
     mergedSet = ps.merge(
         shield1,shield2,how='outer',on=["FID","bufferDist"]
     )
     mergedSet = mergedSet.fillna(0)
+    sectors = np.nonzero(windRose['FID'] >= 0)[0]
+    mergedSet['sum_' + str(YEAR)] = mergedSet['FID'].map(dict(zip(windRose['FID'][sectors],windRose['sum'][sectors])))
     mergedSet['joinStr'] = mergedSet['FID'].astype(str).str.zfill(3) + mergedSet['bufferDist'].astype(str).str.zfill(3)
     outputFilename = paths['bufferFolder'] + "/shieldMeas" + paths['uniqueid'] + ".csv"
     mergedSet.to_csv(outputFilename,index=False)
     return(mergedSet)
 
-# restrict road networks to within 500m of the maternal residence.  Greatly speeds up downstream computations
+# get the FID and hours downwind of each sector of the maternal residence wind rose.  Roses are read from
+# one shapefile per residence, or from the year's GeoParquet dataset (see wind metrics/scripts/roseGeometry.py),
+# where the sector is used as the FID.  Shapefiles restricted to road-bearing sectors (see
+# wind metrics/scripts/roadSectors.py) store the sector in an angle field, otherwise the FID is the sector
 # INPUTS:
 #    paths (dictionary) - list of filepaths
-def clipRds(paths):
-    if not(os.path.exists(paths['tmpRdFolder'])):
-        os.mkdir(paths['tmpRdFolder'])
-    tmpFiles = []
-
-    # for each road classification, restrict road networks to wihtin 500m of residence and create temporary files of restricted data
-    for index in range(len(paths['rdArray'])):
-        tempFile = paths['tmpRdFolder'] + "/a" + str(index) + paths['uniqueid'] + ".shp"
-        curRdInFile = paths['rdArray'][index]
-        curRdBufferFile = paths['bufferFolder'] + "/b" + str(BIGGEST_BUFFER) + paths['uniqueid'] + ".shp"
-        arcpy.Clip_analysis(curRdInFile, curRdBufferFile, tempFile)
-        arcpy.AddField_management(tempFile, "rdType", "SHORT")
-        arcpy.CalculateField_management(tempFile, "rdType", str(index),"PYTHON")
-        tmpFiles.append(tempFile)
-    
-    # combine temporary road files into a single file with an additional attribute field to desginate road type
-    arcpy.Merge_management(tmpFiles, paths['tmpRdFolder'] + "/rdsCombined" + paths['uniqueid'] + ".shp")
-    arcpy.AddField_management(paths['tmpRdFolder'] + "/rdsCombined" + paths['uniqueid'] + ".shp", "wndFID", "SHORT")
-    
-    # cleanup temporary files created during this function
-    for filepath in tmpFiles:
-        arcpy.Delete_management(filepath)
+# OUTPUTS:
+#    windRose (dict) - int numpy arrays of 360 'FID's, -1 for sectors without a triangle, and 360 'sum's of
+#                      hours downwind.  None if the residence has no wind rose
+def readWindRose(paths):
+    windRose = {'FID':np.full(polarBinning.N_SECTORS,-1,np.int64),'sum':np.zeros(polarBinning.N_SECTORS,np.int64)}
+    sumField = 'sum_' + str(YEAR)
+    if ROSE_FORMAT == 'geoparquet':
+        angles, sums = roseGeometry.readResidenceRose(getRoseDataset(),YEAR,paths['uniqueid'])
+        windRose['FID'][angles], windRose['sum'][angles] = angles, sums
+    elif not(os.path.exists(paths['windShp'])):
+        return(None)
+    elif 'angle' in [field.name for field in arcpy.ListFields(paths['windShp'])]:
+        for fid, angle, hours in arcpy.da.SearchCursor(paths['windShp'],["FID","angle",sumField]):
+            windRose['FID'][int(angle)], windRose['sum'][int(angle)] = fid, hours
+    else:
+        for fid, hours in arcpy.da.SearchCursor(paths['windShp'],["FID",sumField]):
+            windRose['FID'][fid], windRose['sum'][fid] = fid, hours
+    if not((windRose['FID'] >= 0).any()):
+        return(None)
+    return(windRose)
+
+# open the year's GeoParquet wind rose dataset, once per process
+# OUTPUTS:
+#    pyarrow dataset - see roseGeometry.openRoseDataset
+def getRoseDataset():
+    if ROSE_FOLDER not in workerRoses:
+        workerRoses[ROSE_FOLDER] = roseGeometry.openRoseDataset(ROSE_FOLDER)
+    return(workerRoses[ROSE_FOLDER])
+
+# partition the road network within 500m of a maternal residence by the 360 radial degrees and 10m
+# distance rings (see polarBinning.py).  Pieces in sectors missing from the rose wind shapefile are dropped,
+# as when roads were clipped by each triangle of the shapefile
+# INPUTS:
+#    birthRecord (pandas dataframe) - contains one row, one unique birth record
+#    paths (dictionary) - list of filepaths
+#    windFIDs (numpy array) - FID of each radial degree in the wind rose, see readWindRose
+# OUTPUTS:
+#    pieces (dict) - see polarBinning.binSegments, with the FID of each piece's triangle in 'wndFID'
+def binRoads(birthRecord,paths,windFIDs):
+    lat, lon = float(birthRecord['b_lat']), float(birthRecord['b_long'])
+    pieces = polarBinning.binSegments(
+        tileCache.loadRoadSegments(getTileCache(paths['roadTiles']),lat,lon,BIGGEST_BUFFER),lat,lon,BIGGEST_BUFFER,SMALLEST_BUFFER
+    )
+    pieces['wndFID'] = windFIDs[pieces['sector']]
+    isCovered = pieces['wndFID'] >= 0
+    return({key:values[isCovered] for key, values in pieces.items()})
 
-# partition the road network around a maternal residence based on each of the 360 radial degrees
+# save road pieces as the rdsSplit shapefile read by joinFiles, with the road type, wind sector FID,
+# distance to the residence, and rndDist key linking each piece to its shielding estimates
 # INPUTS:
+#    pieces (dict) - created by binRoads
 #    paths (dictionary) - list of filepaths
-def createRoadIntersects(paths):
-
-    # make a new feature called stateslyr
-    arcpy.MakeFeatureLayer_management (paths['windBufferFolder'] + "/bw500" + paths['uniqueid'] + ".shp", "stateslyr")
-    outputArray = []
-
-    # for each radial degree, create an in memory copy of the road network clipped to the radial coverage.  
-    # at the end, merge in memory files and write to disk
-    for i in range(360):
-        outputRds = "in_memory" + "/rds" + str(i) 
-        outputArray.append(outputRds)
-        FID_String = ' "FID" = ' + str(i) + ' '
-        arcpy.SelectLayerByAttribute_management("stateslyr", "NEW_SELECTION", FID_String)
-        arcpy.Clip_analysis(paths['tmpRdFolder'] + "/rdsCombined" + paths['uniqueid'] + ".shp", "stateslyr", outputRds)
-        arcpy.CalculateField_management(outputRds, "wndFID", str(i),"PYTHON")
-    arcpy.Merge_management(outputArray,paths['tmpRdFolder'] + "/rdsSplit" + paths['uniqueid'] + ".shp")
-    
-    # cleanup, delete in memory files
-    for curFile in outputArray:
-        arcpy.Delete_management(curFile)
-    
+def saveRoadPieces(pieces,paths):
+    if not(os.path.exists(paths['tmpRdFolder'])):
+        os.makedirs(paths['tmpRdFolder'])
+    arcpy.CreateFeatureclass_management(paths['tmpRdFolder'],os.path.basename(paths['rdsShp']),"POLYLINE",spatial_reference=GCS)
+    arcpy.AddField_management(paths['rdsShp'], "rdType", "SHORT")
+    arcpy.AddField_management(paths['rdsShp'], "wndFID", "SHORT")
+    arcpy.AddField_management(paths['rdsShp'], "NEAR_FID", "LONG")
+    arcpy.AddField_management(paths['rdsShp'], "NEAR_DIST", "DOUBLE")
+    arcpy.AddField_management(paths['rdsShp'], "rndDist", "TEXT")
+    with arcpy.da.InsertCursor(paths['rdsShp'],["SHAPE@","rdType","wndFID","NEAR_FID","NEAR_DIST","rndDist"]) as cursor:
+        for index in range(len(pieces['length'])):
+            line = arcpy.Polyline(arcpy.Array([
+                arcpy.Point(pieces['x1'][index],pieces['y1'][index]),arcpy.Point(pieces['x2'][index],pieces['y2'][index])
+            ]),GCS)
+            wndFID, ring = int(pieces['wndFID'][index]), int(pieces['ring'][index])
+            cursor.insertRow((line,int(pieces['roadClass'][index]),wndFID,0,float(pieces['nearDist'][index]),
+                str(wndFID).zfill(3) + str(ring).zfill(3)))
+
 # get the distances of road segments within 500m of residences.  Only distances with roads need to be processsed, all other 
 # buffer sizes can be ignored to improve computational speed
 # INPUTS:
-#    paths (dictionary) - list of filepaths
+#    pieces (dict) - created by binRoads
 # OUTPUTS:
 #    validDists (list of ints) - buffer distances that need to be processed
-def getBufferDistsToProcess(paths):
-    validDists = []
-    rdsShp = paths['tmpRdFolder'] + "/rdsSplit" + paths['uniqueid'] + ".shp"
-    cursor = arcpy.SearchCursor(rdsShp)
-    row = cursor.next()
-
-    # search through all road segments.  Round distance from road to residence to nearest 10m, and return set of 
-    # road segments distances
-    while row:
-        newDist = int(int(row.getValue("NEAR_DIST"))/10)*10
-        if(newDist <= BIGGEST_BUFFER and newDist not in validDists):
-            validDists.append(int(int(row.getValue("NEAR_DIST"))/10)*10)
-        row = cursor.next()
-    validDists = list(set(validDists))
-    del cursor, row
+def getBufferDistsToProcess(pieces):
+    validDists = [int(dist) for dist in np.unique(pieces['ring']) if dist <= BIGGEST_BUFFER]
     return(validDists)
 
-# create a new attribute field in two shapefiles that will be used to link the two shapefiles together
-# INPUTS:
-#    shapefile (str) - filepath to a shapefile representing the maternal residence
-#    paths (dictionary) - list of other filepaths used in the analysis
-def linkFiles(shapefile,paths):
-    arcpy.Near_analysis(paths['tmpRdFolder'] + "/rdsSplit" + paths['uniqueid'] + ".shp", shapefile, "", "NO_LOCATION", "NO_ANGLE", "GEODESIC")
-    arcpy.AddField_management(paths['tmpRdFolder'] + "/rdsSplit" + paths['uniqueid'] + ".shp", "rndDist", "TEXT")
-    arcpy.CalculateField_management(paths['tmpRdFolder'] + "/rdsSplit" + paths['uniqueid'] + ".shp", "rndDist", "str(!wndFID!).zfill(3) + str(int(!NEAR_DIST!/10)*10).zfill(3)", "PYTHON")
-
 # calculate tree and building shielding for all buffer distances
 # INPUTS:
+#    birthRecord (pandas dataframe) - contains one row, one unique birth record
 #    paths (dictionary) - list of filepaths
+#    bufferDists (list of ints) - sorted buffer distances with a road segment, see getBufferDistsToProcess
+#    windRose (dict) - created by readWindRose
 # outputs:
 #    pandas dataframe containing all tree and shielding estimates 
-def calcShields(paths):
-    
-    # get buffer distances with a road segment
-    bufferDists = getBufferDistsToProcess(paths)
-    arr = []
-    bufferDists.sort()
-    
+def calcShields(birthRecord,paths,bufferDists,windRose):
     # for all buffer dsitances with a road sgement, calculate tree shielding
-    for buf in bufferDists:
-        arr.append(calcZonalIntersectTree(buf,paths))
-    combinedTree = mergeSet(arr)
-    arr = []
+    combinedTree = calcPolarTree(birthRecord,bufferDists,windRose['FID'],paths)
 
     # for all buffer distances with a road segment, calcualte building shielding
-    for buf in bufferDists:
-        arr.append(calcZonalIntersectBuilding(buf,paths))
+    combinedBuilding = calcPolarBuilding(birthRecord,bufferDists,windRose['FID'],paths)
 
     # combine building and tree shielding estimates and return as pandas df
-    combinedBuilding = mergeSet(arr)
-    combinedAll = mergeShields(combinedTree,combinedBuilding,paths)
+    combinedAll = mergeShields(combinedTree,combinedBuilding,windRose,paths)
     return(combinedAll)
 
-# join shield, wind, and road len metrics into a single shapefile
+# join shield, wind, and road len metrics into a single shapefile.  Hours downwind are in the shielding
+# metrics table (see mergeShields), so both wind rose formats are joined the same way
 # INPUTS:
 #     paths (pandas dataframe) - list of filepaths
 def joinFiles(paths):
@@ -383,148 +284,108 @@ def joinFiles(paths):
         '', 
         "TEXT"
     )
-    # join road and shielding metrics into new shapefile
+    # join road, shielding, and wind metrics into new shapefile
     joinTable = arcpy.AddJoin_management(paths['rdsShp'], "rndDist", "in_memory/" + tempname, "join_str2", "KEEP_ALL")
     #arcpy.conversion.TableToTable(joinTable, paths['bufferFolder'],paths['tempMetrics'])
-    # joint road,shielding,and wind metrics into a new shapefile
-    joinTable2 = arcpy.AddJoin_management(joinTable,"wndFID",paths['windShp'],"FID","KEEP_ALL")
-    arcpy.CopyFeatures_management(joinTable2, paths['shieldShp'])
+    arcpy.CopyFeatures_management(joinTable, paths['shieldShp'])
 
-# define input, temporary, and output filepaths used throughout this entire script
-# INPUTS:
-#    birth record (pandas dataframe) - contains only 1 row, one unique birth record
+# define filepaths of the statewide tree raster, building footprints, and road files, and the folders
+# they are tiled into (see tileCache.py)
 # OUTPUTS:
 #    dictionary of filepaths
-def defineFilepaths(birthRecord):
+def getSourcePaths():
     paths = {}
     TREE_FOLDER = PARENT_FOLDER + "tr/"
     BUILDING_GEODATABASE = PARENT_FOLDER + "AnnualFootprints/MyProject6.gdb"
-
-    
     ROADS_FOLDER = PARENT_FOLDER + "roads/" + str(YEAR) + "/"
-    
-    paths['uniqueid'] = birthRecord['uniqueid']
-    paths['bufferFolder'] = PARENT_FOLDER + "buffers"
-    paths['windBufferFolder'] = paths['bufferFolder'] + "/wind"
-    paths['tmpTreeFolder'] = paths['bufferFolder'] + "/tmpTree"
-    paths['tmpBuildingFolder'] = paths['bufferFolder'] + "/tmpBuilding"
-    paths['tmpRdFolder'] = paths['bufferFolder'] + "/tmpRds"
+    TILE_FOLDER = PARENT_FOLDER + "tiles/"
+
     paths['tree_raster'] = TREE_FOLDER + "texas_tr2015.tif" if (YEAR> 2012) else TREE_FOLDER + "texas_tr2010.tif"
-    paths['clipped_tree'] = TREE_FOLDER + paths['uniqueid'] + "_trclip.tif"
     paths['building_shapefile'] = BUILDING_GEODATABASE + "/footprints_" + str(YEAR)
-    paths['resampled_tree'] = paths['tmpTreeFolder'] + "/t_" + paths['uniqueid'].lower() + "r.tif" 
-    paths['clipped_building'] = paths['tmpBuildingFolder'] + "/bu" + paths['uniqueid'] + ".shp"
-    paths['bufferExtent'] = paths['bufferFolder'] + "/b" + str(BIGGEST_BUFFER) + paths['uniqueid'] + ".shp"
-    paths['rdsShp'] = paths['tmpRdFolder'] + "/rdsSplit" + birthRecord['uniqueid'] + ".shp"
-    paths['metricsCSV'] = paths['bufferFolder'] + "/shieldMeas" + birthRecord['uniqueid'] + ".csv"
-    paths['tempMetrics'] = birthRecord['uniqueid'] + "a.csv"
-    paths['shieldShp'] = PARENT_FOLDER + "shpFile/" + str(YEAR) + "/" + birthRecord['uniqueid'] + ".shp"
     paths['rdArray'] = [
         ROADS_FOLDER + "/aadt0.shp",
         ROADS_FOLDER + "/aadt1.shp",
         ROADS_FOLDER + "/taadt0.shp",
         ROADS_FOLDER + "/taadt1.shp"    
     ]
-    paths['windShp'] = birthRecord['windShp']
-
+    paths['treeTiles'] = TILE_FOLDER + os.path.basename(paths['tree_raster'])[:-4] + "/"
+    paths['footprintTiles'] = TILE_FOLDER + "footprints_" + str(YEAR) + "/"
+    paths['roadTiles'] = TILE_FOLDER + "roads_" + str(YEAR) + "/"
     return(paths)
 
-# given a birth record with lat/lon coordinates, create an arcgis geometry object
-# IMPORTANT: MATERNAL RESIDENCE COORDINATES MUST BE IN GCS WGS84 !!!
-# INPUTS:
-#    birthRecord (pandas dataframe) - contains one row, one unique birth record
-# OUTPUTS:
-#    geometry object centered on the maternal residence coordinates
-def createGeometryPoints(birthRecord):
-    try:
-        tempPoint = arcpy.Point()
-        tempPoint.X = float(birthRecord['b_long'])
-        tempPoint.Y = float(birthRecord['b_lat'])
-        tempMonitorShp = arcpy.PointGeometry(tempPoint,GCS)
-        return(tempMonitorShp)
-    except Exception as e:
-        print("couldn't create point: " + str(e))
-    return(None)
-
-# create buffers from 10m to 500m centered on maternal residence
+# cut the statewide tree raster, building footprints, and road files into tiles.  Sources tiled by an
+# earlier run are skipped
 # INPUTS:
-#    geometryPoint (arcpy geometry object) - centered on maternal residence
-#    paths (dictionary) - list of filepaths
-def createAllBuffers(geometryPoint,paths):
-    createBuffers(geometryPoint,paths)
-    createWindBuffers(paths)
+#    sourcePaths (dictionary) - created by getSourcePaths
+def createTiles(sourcePaths):
+    if not(tileCache.isTiled(sourcePaths['roadTiles'])):
+        print("tiled roads: %i tiles" %(tileCache.tileRoads(sourcePaths['rdArray'],sourcePaths['roadTiles'])))
+    if not(tileCache.isTiled(sourcePaths['footprintTiles'])):
+        print("tiled footprints: %i tiles" %(tileCache.tileFootprints(sourcePaths['building_shapefile'],sourcePaths['footprintTiles'])))
+    if not(tileCache.isTiled(sourcePaths['treeTiles'])):
+        print("tiled tree raster: %i tiles" %(tileCache.tileRaster(sourcePaths['tree_raster'],sourcePaths['treeTiles'])))
 
-# create buffers from 10m to 500m centered on maternal residence
+# define input, temporary, and output filepaths used throughout this entire script
 # INPUTS:
-#    geometryPoint (arcpy geometry object) - centered on maternal residence
-#    paths (dictionary) - list of filepaths
-def deleteAllBuffers(paths):
-    deleteBuffers(paths)
-    deleteWindBuffers(paths)
+#    birth record (pandas dataframe) - contains only 1 row, one unique birth record
+# OUTPUTS:
+#    dictionary of filepaths
+def defineFilepaths(birthRecord):
+    paths = getSourcePaths()
+    paths['uniqueid'] = birthRecord['uniqueid']
+    paths['bufferFolder'] = PARENT_FOLDER + "buffers"
+    paths['tmpRdFolder'] = paths['bufferFolder'] + "/tmpRds"
+    paths['rdsShp'] = paths['tmpRdFolder'] + "/rdsSplit" + birthRecord['uniqueid'] + ".shp"
+    paths['metricsCSV'] = paths['bufferFolder'] + "/shieldMeas" + birthRecord['uniqueid'] + ".csv"
+    paths['tempMetrics'] = birthRecord['uniqueid'] + "a.csv"
+    paths['shieldShp'] = PARENT_FOLDER + "shpFile/" + str(YEAR) + "/" + birthRecord['uniqueid'] + ".shp"
+    paths['windShp'] = birthRecord['windShp']
 
-# prepare building and tree dtasets for shielding analysis.  Operations include clipping datasets
-# to 500m and resamling the tree raster 
-# INPUTS:
-#    paths (dict) - list of filepaths
-def preprocessShields(paths):
-    outExtractByMask = arcpy.sa.ExtractByMask(paths['tree_raster'], paths['bufferExtent'])
-    outExtractByMask.save(paths['clipped_tree'])
-    arcpy.Resample_management(in_raster=paths['clipped_tree'], out_raster=paths['resampled_tree'], cell_size="0.000026949456 0.000026949456", resampling_type="BILINEAR")
-    arcpy.Clip_analysis(paths['building_shapefile'], paths['bufferExtent'], paths['clipped_building'])
+    return(paths)
 
 # peform all steps to calculate wind, shielding, and road metrics for one single maternal residence
 # INPUTS:
 #    birthRecord (pandas dataframe) - single row, unique birth record
 def processSingleResidence(birthRecord):
+    loadArcpy()
     #print(birthRecord)
     # create temporary and output filepaths that incorporate the birth reqcord unique identifier
     paths = defineFilepaths(birthRecord)
     if(os.path.exists(paths['shieldShp'])):
         print("estimates already derived for record " + paths['uniqueid'])
-        #try:
-        #    deleteAllBuffers(paths)
-        #except Exception as e:
-        #    print("couldn't delete buffers: " + str(e))
-        return
-    if not(os.path.exists(paths['windShp'])):
-        print("no wind estimates for record " + paths['uniqueid'])
         return
-    # create an arcgis point geometry object centered on the maternal residence
-    geometryPoint = createGeometryPoints(birthRecord)
-    if(geometryPoint == None): return
-    print("created geometry")
 
-    # create buffers from 10m to 500m
+    # the wind rose is read once and shared by road binning and shielding
     try:
-        createAllBuffers(geometryPoint,paths)    
+        windRose = readWindRose(paths)
     except Exception as e:
-        print("couldn't create buffers: " + str(e))
+        print("couldn't read wind rose: " + str(e))
+        return
+    if windRose is None:
+        print("no wind estimates for record " + paths['uniqueid'])
         return
 
-    # prepare tree and building datasets for shielding metrics
+    # split roads within 500m by radial degree and 10m distance ring
     try:
-        preprocessShields(paths)
-        print("finished prep")
+        pieces = binRoads(birthRecord,paths,windRose['FID'])
     except Exception as e:
-        print("couldn't preprocess shields: " + str(e))
+        print("couldn't split roads: " + str(e))
+        return
+    if len(pieces['length']) == 0:
+        print("no roads within %im of record %s" %(BIGGEST_BUFFER,paths['uniqueid']))
         return
+    bufferDists = getBufferDistsToProcess(pieces)
     try:
-        clipRds(paths)
-        createRoadIntersects(paths)
-        linkFiles(geometryPoint,paths)
-        calcShields(paths)
+        saveRoadPieces(pieces,paths)
+        calcShields(birthRecord,paths,bufferDists,windRose)
         joinFiles(paths)
     except Exception as e:
         print("culdn't derive road weighted shield and wind: " + str(e))
         return
-    try:
-        deleteAllBuffers(paths)
-    except Exception as e:
-        print("couldn't delete buffers: " + str(e))
     print("completed birth record %s" %(birthRecord['uniqueid']))
 
 # load birth records and use unique id to get the filepath for the maternal
-# residence rose wind shapefile
+# residence rose wind shapefile (only read when ROSE_FORMAT is 'shapefile')
 # OUTPUTS:
 #    vbariables from birth records in pandas dtaframe format
 def getBirthMeta():
@@ -566,10 +427,16 @@ def prepForParallel(birthRecords):
 ####################### MAIN FUNCTION ##################
 if __name__ == '__main__':
     
-    # load birth records and convert to tuple for parallel processing
+    # cut statewide datasets into tiles once, before workers start
+    loadArcpy()
+    createTiles(getSourcePaths())
+
+    # load birth records and convert to tuple for parallel processing.  Records are ordered by tile, so
+    # each worker's share of residences reuses its cached tiles
     birthMeta = getBirthMeta()
+    tileRows, tileCols = tileCache.getTileIndex(birthMeta['b_lat'],birthMeta['b_long'])
+    birthMeta = birthMeta.iloc[np.lexsort((tileCols,tileRows))]
     result = prepForParallel(birthMeta)
-    random.shuffle(result)
 
     pool = Pool(processes=64)
     res = pool.map_async(processSingleResidence,result)
@@ -0,0 +1,333 @@
+############### tileCache.py #############
+# Developed for HEI Transit Study
+# Summary: cut the statewide shielding inputs (yearly road files, building footprints, and the tree
+#          raster) into fixed ~2km tiles once, so each maternal residence reads only the few tiles within
+#          500m.  Replaces clipping or loading the statewide datasets in every pool worker, which
+#          saturates storage when 64 workers run at once
+# Layout: one folder per source with index.json (tile size, source kind, and saved tiles) and
+# tile_<row>_<col>.npz files.  Tile (row, col) covers latitudes [row, row+1)*TILE_DEGREES and longitudes
+# [col, col+1)*TILE_DEGREES.  Vector items are saved in every tile their bounding box touches, with an
+# itemId to remove duplicates when tiles are combined.  Raster tiles are blocks of pixels aligned to the
+# source raster.  Tiles with no items or only NoData are not saved
+# Steps include:
+# 1) tiling each source once with tileRoads, tileFootprints, and tileRaster (see shieldingScript.py main)
+# 2) opening a tile cache per source in each pool worker.  The most recently used tiles are kept in
+#    memory, so nearby residences processed by the same worker share tiles
+# 3) loading the roads, footprints, or raster window around each residence from the cached tiles, in the
+#    formats used by polarBinning.py, footprintIndex.py, and polarSampling.py
+
+
+############### Setup: import libraries and define constants ##############
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+import polarBinning
+import polarSampling
+import footprintIndex
+
+TILE_DEGREES = 0.02 # ~2.2km north-south, ~1.9km east-west in Texas
+MIN_RASTER_TILE = 256 # pixels per raster tile side, so coarse rasters are not split into tiny files
+MAX_TILES = 64 # tiles kept in memory per source and process
+INDEX_FILENAME = "index.json"
+
+
+
+################ Tile geometry ##############
+
+# get the tile containing each coordinate
+# INPUTS:
+#    lats, lons (array-like) - coordinates in degrees
+#    tileDegrees (float) - tile size in degrees
+# OUTPUTS:
+#    tileRows, tileCols (numpy int64 arrays)
+def getTileIndex(lats,lons,tileDegrees=TILE_DEGREES):
+    tileRows = np.floor(np.asarray(lats,np.float64)/tileDegrees).astype(np.int64)
+    tileCols = np.floor(np.asarray(lons,np.float64)/tileDegrees).astype(np.int64)
+    return(tileRows,tileCols)
+
+# pair each item with every tile its bounding box touches
+# INPUTS:
+#    bounds (numpy array) - organized by (item, minLon/minLat/maxLon/maxLat)
+#    tileDegrees (float) - tile size in degrees
+# OUTPUTS:
+#    itemIndex, tileRows, tileCols (numpy int64 arrays) - one value per (item, tile) pair
+def assignTiles(bounds,tileDegrees=TILE_DEGREES):
+    firstRows, firstCols = getTileIndex(bounds[:,1],bounds[:,0],tileDegrees)
+    lastRows, lastCols = getTileIndex(bounds[:,3],bounds[:,2],tileDegrees)
+    nRows, nCols = lastRows - firstRows + 1, lastCols - firstCols + 1
+    itemIndex = np.repeat(np.arange(len(bounds)),nRows*nCols)
+    offsets = np.arange(len(itemIndex)) - np.repeat(np.cumsum(nRows*nCols) - nRows*nCols,nRows*nCols)
+    tileRows = firstRows[itemIndex] + offsets // nCols[itemIndex]
+    tileCols = firstCols[itemIndex] + offsets % nCols[itemIndex]
+    return(itemIndex,tileRows,tileCols)
+
+# get the tiles within a distance of a residence
+# INPUTS:
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+#    tileDegrees (float) - tile size in degrees
+# OUTPUTS:
+#    list of (tileRow, tileCol) tuples
+def getNearbyTiles(lat,lon,radius=polarBinning.MAX_DIST,tileDegrees=TILE_DEGREES):
+    metersPerLat, metersPerLon = polarBinning.getLocalScale(lat)
+    box = np.array([[lon - radius/metersPerLon,lat - radius/metersPerLat,lon + radius/metersPerLon,lat + radius/metersPerLat]])
+    itemIndex, tileRows, tileCols = assignTiles(box,tileDegrees)
+    return(list(zip(tileRows.tolist(),tileCols.tolist())))
+
+# get the filepath of one tile
+# INPUTS:
+#    folder (str) - tile folder of a source
+#    tileRow, tileCol (int) - tile position
+# OUTPUTS:
+#    filepath (str)
+def getTileFile(folder,tileRow,tileCol):
+    return(os.path.join(folder,"tile_" + str(tileRow) + "_" + str(tileCol) + ".npz"))
+
+
+
+################ Tiling sources ##############
+
+# check if a source has been tiled.  The index is written last, so partially tiled sources are not used
+# INPUTS:
+#    folder (str) - tile folder of a source
+# OUTPUTS:
+#    bool
+def isTiled(folder):
+    return(os.path.exists(os.path.join(folder,INDEX_FILENAME)))
+
+# save one tile.  The file is written to a temporary name and moved into place
+# INPUTS:
+#    folder (str) - tile folder of a source
+#    tileRow, tileCol (int) - tile position
+#    arrays (dict) - numpy arrays to save
+#    compress (bool) - if True, compress the arrays
+def saveTile(folder,tileRow,tileCol,arrays,compress=False):
+    tileFile = getTileFile(folder,tileRow,tileCol)
+    with open(tileFile + ".tmp",'wb') as tileStream:
+        (np.savez_compressed if compress else np.savez)(tileStream,**arrays)
+    os.replace(tileFile + ".tmp",tileFile)
+
+# save the index of a tiled source
+# INPUTS:
+#    folder (str) - tile folder of a source
+#    index (dict) - source kind, tile size, and any metadata needed to read the tiles
+#    tiles (list) - (tileRow, tileCol) of every saved tile
+def saveIndex(folder,index,tiles):
+    index = dict(index,tiles=[[int(tileRow),int(tileCol)] for tileRow, tileCol in tiles])
+    with open(os.path.join(folder,INDEX_FILENAME),'w') as indexFile:
+        json.dump(index,indexFile)
+
+# save vector items into the tiles their bounding boxes touch
+# INPUTS:
+#    folder (str) - tile folder of a source
+#    kind (str) - 'roads' or 'footprints'
+#    bounds (numpy array) - organized by (item, minLon/minLat/maxLon/maxLat)
+#    arrays (dict) - numpy arrays with one value per item
+#    blobs (list) - optional variable length bytes per item, saved as 'blob' and 'blobOffsets'
+#    tileDegrees (float) - tile size in degrees
+# OUTPUTS:
+#    number of tiles saved (int)
+def saveVectorTiles(folder,kind,bounds,arrays,blobs=None,tileDegrees=TILE_DEGREES):
+    if not(os.path.exists(folder)):
+        os.makedirs(folder)
+    itemIndex, tileRows, tileCols = assignTiles(bounds,tileDegrees)
+    order = np.lexsort((itemIndex,tileCols,tileRows))
+    itemIndex, tileRows, tileCols = itemIndex[order], tileRows[order], tileCols[order]
+    isFirst = np.ones(len(itemIndex),dtype=bool)
+    isFirst[1:] = (tileRows[1:] != tileRows[:-1]) | (tileCols[1:] != tileCols[:-1])
+    starts = np.nonzero(isFirst)[0]
+    ends = np.append(starts[1:],len(itemIndex))
+    tiles = []
+    for start, end in zip(starts,ends):
+        items = itemIndex[start:end]
+        tileArrays = {key:values[items] for key, values in arrays.items()}
+        tileArrays['itemId'] = items
+        if blobs is not None:
+            tileBlobs = [blobs[item] for item in items]
+            tileArrays['blob'] = np.frombuffer(b"".join(tileBlobs),dtype=np.uint8)
+            tileArrays['blobOffsets'] = np.concatenate([[0],np.cumsum([len(blob) for blob in tileBlobs])]).astype(np.int64)
+        saveTile(folder,tileRows[start],tileCols[start],tileArrays)
+        tiles.append((tileRows[start],tileCols[start]))
+    saveIndex(folder,{'kind':kind,'tileDegrees':tileDegrees},tiles)
+    return(len(tiles))
+
+# tile the yearly road files as line segments
+# INPUTS:
+#    roadFiles (list) - filepaths of the road shapefiles, in road class order
+#    folder (str) - tile folder
+# OUTPUTS:
+#    number of tiles saved (int)
+def tileRoads(roadFiles,folder):
+    segments = polarBinning.readRoadSegments(roadFiles)
+    bounds = np.stack([
+        np.minimum(segments['x1'],segments['x2']),np.minimum(segments['y1'],segments['y2']),
+        np.maximum(segments['x1'],segments['x2']),np.maximum(segments['y1'],segments['y2'])
+    ],axis=1)
+    return(saveVectorTiles(folder,'roads',bounds,segments))
+
+# tile building footprints as WKB polygons
+# INPUTS:
+#    featureClass (str) - filepath of the footprint feature class
+#    folder (str) - tile folder
+# OUTPUTS:
+#    number of tiles saved (int)
+def tileFootprints(featureClass,folder):
+    footprints = footprintIndex.readFootprints(featureClass)
+    bounds = footprintIndex.shapely.bounds(footprints)
+    isValid = ~np.isnan(bounds).any(axis=1) # empty geometries have no bounds
+    footprints, bounds = footprints[isValid], bounds[isValid]
+    return(saveVectorTiles(folder,'footprints',bounds,{},list(footprintIndex.shapely.to_wkb(footprints))))
+
+# tile a raster in a geographic (lon/lat) coordinate system into blocks of pixels.  Tiles are read from
+# the raster one at a time, so the statewide raster is never held in memory
+# INPUTS:
+#    rasterFile (str) - filepath of the raster
+#    folder (str) - tile folder
+#    tileDegrees (float) - approximate tile size in degrees
+# OUTPUTS:
+#    number of tiles saved (int)
+def tileRaster(rasterFile,folder,tileDegrees=TILE_DEGREES):
+    import arcpy
+    if not(os.path.exists(folder)):
+        os.makedirs(folder)
+    raster = arcpy.Raster(rasterFile)
+    grid = polarSampling.getRasterGrid(raster)
+    blockRows = max(int(np.ceil(tileDegrees/grid['cellHeight'])),MIN_RASTER_TILE)
+    blockCols = max(int(np.ceil(tileDegrees/grid['cellWidth'])),MIN_RASTER_TILE)
+    tiles = []
+    for tileRow in range(int(np.ceil(grid['nRows']/blockRows))):
+        for tileCol in range(int(np.ceil(grid['nCols']/blockCols))):
+            nRows = min(blockRows,grid['nRows'] - tileRow*blockRows)
+            nCols = min(blockCols,grid['nCols'] - tileCol*blockCols)
+            lowerLeft = arcpy.Point(grid['west'] + tileCol*blockCols*grid['cellWidth'],grid['north'] - (tileRow*blockRows + nRows)*grid['cellHeight'])
+            values = arcpy.RasterToNumPyArray(raster,lowerLeft,nCols,nRows)
+            if raster.noDataValue is not None and (values == raster.noDataValue).all():
+                continue
+            saveTile(folder,tileRow,tileCol,{'values':values},compress=True)
+            tiles.append((tileRow,tileCol))
+    noData = None if raster.noDataValue is None else float(raster.noDataValue)
+    index = dict(grid,kind='raster',blockRows=blockRows,blockCols=blockCols,noData=noData)
+    saveIndex(folder,index,tiles)
+    return(len(tiles))
+
+
+
+################ Reading tiles ##############
+
+# open the tiles of a source.  Tiles are read on first use and the most recently used are kept in memory
+# INPUTS:
+#    folder (str) - tile folder of a source
+#    maxTiles (int) - number of tiles kept in memory
+# OUTPUTS:
+#    cache (dict) - folder, index, set of saved tiles, and the tiles in memory
+def openTileCache(folder,maxTiles=MAX_TILES):
+    with open(os.path.join(folder,INDEX_FILENAME)) as indexFile:
+        index = json.load(indexFile)
+    cache = {
+        'folder':folder,
+        'index':index,
+        'saved':set([tuple(tile) for tile in index['tiles']]),
+        'tiles':OrderedDict(),
+        'maxTiles':maxTiles
+    }
+    return(cache)
+
+# read one tile through the cache.  Footprint tiles are decoded to shapely polygons when read
+# INPUTS:
+#    cache (dict) - created by openTileCache
+#    tileRow, tileCol (int) - tile position
+# OUTPUTS:
+#    tile (dict) - arrays of the tile, or None if no tile was saved
+def readTile(cache,tileRow,tileCol):
+    key = (tileRow,tileCol)
+    if key not in cache['saved']:
+        return(None)
+    if key in cache['tiles']:
+        cache['tiles'].move_to_end(key)
+        return(cache['tiles'][key])
+    with np.load(getTileFile(cache['folder'],tileRow,tileCol)) as tileData:
+        tile = {name:tileData[name] for name in tileData.files}
+    if cache['index']['kind'] == 'footprints':
+        blob, offsets = tile.pop('blob'), tile.pop('blobOffsets')
+        wkbs = np.array([blob[start:end].tobytes() for start, end in zip(offsets[:-1],offsets[1:])],dtype=object)
+        tile['footprints'] = footprintIndex.shapely.from_wkb(wkbs)
+    cache['tiles'][key] = tile
+    if len(cache['tiles']) > cache['maxTiles']:
+        cache['tiles'].popitem(last=False)
+    return(tile)
+
+# combine the vector tiles within a distance of a residence, keeping one copy of each item
+# INPUTS:
+#    cache (dict) - created by openTileCache
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+# OUTPUTS:
+#    dict of numpy arrays, or None if there are no tiles nearby
+def combineVectorTiles(cache,lat,lon,radius):
+    tiles = [readTile(cache,tileRow,tileCol) for tileRow, tileCol in getNearbyTiles(lat,lon,radius,cache['index']['tileDegrees'])]
+    tiles = [tile for tile in tiles if tile is not None]
+    if len(tiles) == 0:
+        return(None)
+    combined = {key:np.concatenate([tile[key] for tile in tiles]) for key in tiles[0]}
+    itemIds, firstIndex = np.unique(combined['itemId'],return_index=True)
+    return({key:values[firstIndex] for key, values in combined.items()})
+
+# load the road segments within a distance of a residence
+# INPUTS:
+#    cache (dict) - created by openTileCache for a folder tiled by tileRoads
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+# OUTPUTS:
+#    segments (dict) - see polarBinning.readRoadSegments
+def loadRoadSegments(cache,lat,lon,radius=polarBinning.MAX_DIST):
+    combined = combineVectorTiles(cache,lat,lon,radius)
+    if combined is None:
+        return({'x1':np.zeros(0),'y1':np.zeros(0),'x2':np.zeros(0),'y2':np.zeros(0),'roadClass':np.zeros(0,np.uint8)})
+    return({key:combined[key] for key in ['x1','y1','x2','y2','roadClass']})
+
+# load the building footprints within a distance of a residence
+# INPUTS:
+#    cache (dict) - created by openTileCache for a folder tiled by tileFootprints
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+# OUTPUTS:
+#    numpy array of shapely polygons in WGS84 coordinates
+def loadFootprints(cache,lat,lon,radius=polarBinning.MAX_DIST):
+    combined = combineVectorTiles(cache,lat,lon,radius)
+    if combined is None:
+        return(np.zeros(0,dtype=object))
+    return(combined['footprints'])
+
+# load the raster window covering a distance around a residence.  Pixels in tiles that were not saved
+# are NoData
+# INPUTS:
+#    cache (dict) - created by openTileCache for a folder tiled by tileRaster
+#    lat, lon (float) - residence coordinates in degrees
+#    radius (float) - distance in meters
+# OUTPUTS:
+#    window (dict) - see polarSampling.readRasterWindow
+def loadRasterWindow(cache,lat,lon,radius=polarBinning.MAX_DIST):
+    index = cache['index']
+    firstRow, lastRow, firstCol, lastCol = polarSampling.getPixelWindow(index,lat,lon,radius)
+    values = np.full((lastRow - firstRow,lastCol - firstCol),np.nan)
+    for tileRow in range(firstRow//index['blockRows'],(lastRow - 1)//index['blockRows'] + 1):
+        for tileCol in range(firstCol//index['blockCols'],(lastCol - 1)//index['blockCols'] + 1):
+            tile = readTile(cache,tileRow,tileCol)
+            if tile is None:
+                continue
+            tileTop, tileLeft = tileRow*index['blockRows'], tileCol*index['blockCols']
+            rowStart, rowEnd = max(firstRow,tileTop), min(lastRow,tileTop + tile['values'].shape[0])
+            colStart, colEnd = max(firstCol,tileLeft), min(lastCol,tileLeft + tile['values'].shape[1])
+            values[rowStart-firstRow:rowEnd-firstRow,colStart-firstCol:colEnd-firstCol] = \
+                tile['values'][rowStart-tileTop:rowEnd-tileTop,colStart-tileLeft:colEnd-tileLeft]
+    if index['noData'] is not None:
+        values[values == index['noData']] = np.nan
+    window = {
+        'values':values,
+        'west':index['west'] + firstCol*index['cellWidth'],
+        'north':index['north'] - firstRow*index['cellHeight'],
+        'cellWidth':index['cellWidth'],
+        'cellHeight':index['cellHeight']
+    }
+    return(window)
@@ -8,7 +8,6 @@
 
 
 ############### Setup: import libraries and define constants ##############
-sucessfulImport = False
 import time
 import os
 from multiprocessing import Pool
@@ -17,21 +16,6 @@ import pandas as ps
 import random
 import gConst as const
 
-# needed when using the ArcGIS license for a large # of parallel threads
-while(sucessfulImport == False):
-    try:
-        #print("try again")
-        import arcpy
-        from arcpy.ia import * 
-        from arcpy import env
-        from arcpy.sa import *
-        arcpy.env.overwriteOutput = True
-        arcpy.CheckOutExtension("Spatial")
-        sucessfulImport = True
-    except Exception as e:
-        print("couldn't import arcgis: %s" %(str(e)))
-        time.sleep(1)
-
 
 # Define global constants used by all parallel processing threads
 BUFFER_DISTANCE = 500
@@ -41,6 +25,36 @@ MATCHING_FOLDER = PARENT_FOLDER + "matching/"
 OLDER_TRAFFIC = const.TRAFFIC_FOLDER + "rhino_vmt_1995_2009.shp"
 NEWER_TRAFFIC = const.TRAFFIC_FOLDER + "rhino_vmt_2010_2016.shp"
 
+# arcpy and the control cohort are loaded once per process the first time a residence is matched,
+# rather than when the module is imported or once per residence
+arcpy = None
+workerCache = {}
+
+
+# import arcpy once per process.  Retrying the import is
+# needed when using the ArcGIS license for a large # of parallel threads
+# OUTPUTS:
+#    arcpy module
+def loadArcpy():
+    global arcpy
+    while arcpy is None:
+        try:
+            import arcpy as arcpyModule
+            arcpyModule.env.overwriteOutput = True
+            arcpyModule.CheckOutExtension("Spatial")
+            arcpy = arcpyModule
+        except Exception as e:
+            print("couldn't import arcgis: %s" %(str(e)))
+            time.sleep(1)
+    return(arcpy)
+
+# get residences in the bottom quartile of time spent downwind (candidate controls), read once per process
+# OUTPUTS:
+#    control (pandas dataframe)
+def getControls():
+    if 'control' not in workerCache:
+        workerCache['control'] = ps.read_csv(MATCHING_FOLDER + "bottom_" + str(BUFFER_DISTANCE) + ".csv")
+    return(workerCache['control'])
 
 
 # reformat exposed cohort data from a table to tuples to facilitate high throughput parallel processing.  
@@ -205,8 +219,9 @@ def matchOneResidence(dataTuple):
     
     # identify all control points close enough to be a candidate match and calculate distances 
     # from control points to road segements near the exposed 
+    loadArcpy()
     try:
-        control = ps.read_csv(MATCHING_FOLDER + "bottom_" + str(BUFFER_DISTANCE) + ".csv")
+        control = getControls()
         distToRoad = processOneResidence(dataTuple[0],dataTuple[1],dataTuple[2],BUFFER_DISTANCE)
     except Exception as e:
         print("couldn't calc dist to road: " + str(e))
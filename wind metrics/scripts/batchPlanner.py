@@ -0,0 +1,199 @@
+############### batchPlanner.py #############
+# Developed for HEI Transit Study
+# Summary: choose the number of maternal residences processed per batch in the wind matrix stage
+#          (createWindMatrix.py) based on available GPU or host memory and the size of the cohort
+# Steps to create a batch plan include :
+# 1) reading free GPU memory (cuda backend) or available host RAM (cpu backends)
+# 2) estimating memory required per maternal residence for the selected backend
+# 3) splitting the cohort into evenly sized batches that fit in memory.  The final batch may be partial
+# 4) saving the plan next to the w_ <n>.npy partitions so interrupted runs resume with the same batches
+
+
+############### Setup: import libraries and define constants ##############
+import datetime
+import json
+import math
+import os
+import windBackends
+import ioPipeline
+
+PLAN_FILENAME = "batchPlan.json"
+MEMORY_FRACTION = 0.8 # fraction of free memory the wind matrix stage is allowed to use
+MAX_CUDA_GRID_Z = 65535 # cuda limit on the number of blocks along the z axis (one block per residence)
+HOURS_PER_BIRTH = 24*366*2 # upper bound on hourly wind records per residence (2 years)
+BYTES_PER_RECORD = 4+1+1+1+2 # id index (int32), hour, day, month (uint8), and wind direction (int16) columns
+
+# memory needed per maternal residence
+HOURLY_BYTES = windBackends.N_HOURS*windBackends.N_DAYS*windBackends.N_MONTHS*2 # int16 rearranged matrix
+OUTPUT_BYTES = windBackends.N_MONTHS*windBackends.N_DAYS*windBackends.N_ANGLES*8 # float64 wind matrix
+RECORD_BYTES = HOURS_PER_BIRTH*BYTES_PER_RECORD # long-format hourly records
+
+# batches and finished wind matrices held in host memory at once: the one being processed, plus those
+# queued and in flight in the prefetch and write-behind threads (see ioPipeline.py).  When several downwind
+# kernels are evaluated in one pass (windBackends.calcWindMatrixMulti) each wind matrix has one copy per kernel
+HOST_BATCHES = ioPipeline.PREFETCH_DEPTH + 2
+HOST_OUTPUTS = ioPipeline.WRITE_DEPTH + 2
+
+# cpu backends allocate histograms for one chunk of residences per thread, independent of batch size
+HISTOGRAM_BYTES = windBackends.N_MONTHS*windBackends.N_DAYS*(windBackends.N_ANGLES+1)*8
+
+
+
+################ Helper functions ##############
+
+# get free memory on the GPU used by numba
+# OUTPUTS:
+#    free memory in bytes (int), None if no GPU is available
+def getDeviceMemory():
+    if not windBackends.isCudaAvailable():
+        return(None)
+    from numba import cuda
+    free, total = cuda.current_context().get_memory_info()
+    return(int(free))
+
+# get RAM available to new allocations on the host.  Uses MemAvailable from /proc/meminfo
+# when possible since it accounts for reclaimable page cache
+# OUTPUTS:
+#    available memory in bytes (int)
+def getHostMemory():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return(int(line.split()[1])*1024)
+    except OSError:
+        pass
+    return(int(os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')))
+
+# estimate memory required for each maternal residence in a batch.  The same arrays are held in GPU
+# memory by the cuda backend and in host memory by the cpu backends.  Host memory also holds the
+# batches and wind matrices buffered by the prefetch and write-behind threads
+# INPUTS:
+#    memorySource (str) - 'device' or 'host'
+#    nKernels (int) - number of downwind kernels evaluated in one pass
+# OUTPUTS:
+#    bytes per maternal residence (int)
+def estimateBytesPerBirth(memorySource='host',nKernels=1):
+    if memorySource == 'device':
+        return(HOURLY_BYTES + OUTPUT_BYTES*nKernels + RECORD_BYTES)
+    return(HOURLY_BYTES + OUTPUT_BYTES*nKernels*HOST_OUTPUTS + RECORD_BYTES*HOST_BATCHES)
+
+# estimate memory required by a backend regardless of batch size
+# INPUTS:
+#    backend (str) - name of the compute backend (see windBackends.py)
+# OUTPUTS:
+#    fixed overhead in bytes (int)
+def estimateFixedBytes(backend):
+    if backend == 'numpy':
+        return(windBackends.getNumCores()*windBackends.STATIONS_PER_CHUNK*HISTOGRAM_BYTES)
+    return(0)
+
+# split a cohort into evenly sized batches no larger than maxBatchSize
+# INPUTS:
+#    nBirths (int) - number of maternal residences in the cohort
+#    maxBatchSize (int) - largest batch that fits in memory
+# OUTPUTS:
+#    batchSize (int) - number of residences in all batches except the final (possibly partial) batch
+def balanceBatchSize(nBirths,maxBatchSize):
+    if nBirths == 0:
+        return(max(maxBatchSize,1))
+    nBatches = math.ceil(nBirths/maxBatchSize)
+    return(math.ceil(nBirths/nBatches))
+
+
+
+################ Main planner functions ##############
+
+# create a batch plan for one birth year
+# INPUTS:
+#    year (int) - birth year
+#    nBirths (int) - number of maternal residences with hourly wind records
+#    backend (str) - name of the compute backend (see windBackends.py)
+#    memoryFraction (float) - fraction of free memory the batch may use
+#    batchSize (int) - optional fixed batch size, overrides the memory based estimate
+#    nKernels (int) - number of downwind kernels evaluated in one pass
+# OUTPUTS:
+#    plan (dict) - batch size, number of batches, and the memory estimates used to derive them
+def createBatchPlan(year,nBirths,backend,memoryFraction=MEMORY_FRACTION,batchSize=None,nKernels=1):
+    deviceMemory = getDeviceMemory() if backend == 'cuda' else None
+    memorySource = 'device' if deviceMemory is not None else 'host'
+    availableMemory = deviceMemory if deviceMemory is not None else getHostMemory()
+    bytesPerBirth = estimateBytesPerBirth(memorySource,nKernels)
+    usableMemory = availableMemory*memoryFraction - estimateFixedBytes(backend)
+    maxBatchSize = max(1,int(usableMemory//bytesPerBirth))
+    if backend == 'cuda':
+        maxBatchSize = min(maxBatchSize,MAX_CUDA_GRID_Z)
+    if batchSize is None:
+        batchSize = balanceBatchSize(nBirths,maxBatchSize)
+    elif batchSize > maxBatchSize:
+        print("warning: batch size %i exceeds the %i residences estimated to fit in %s memory" %(batchSize,maxBatchSize,memorySource))
+    plan = {
+        'year':year,
+        'backend':backend,
+        'nBirths':nBirths,
+        'batchSize':batchSize,
+        'nBatches':math.ceil(nBirths/batchSize),
+        'nKernels':nKernels,
+        'memorySource':memorySource,
+        'availableMemory':availableMemory,
+        'memoryFraction':memoryFraction,
+        'bytesPerBirth':bytesPerBirth,
+        'created':datetime.datetime.now().isoformat(timespec='seconds')
+    }
+    return(plan)
+
+# get the [start, end) unique id indeces for each batch in a plan.  The final batch contains
+# the remaining residences and may be smaller than the batch size
+# INPUTS:
+#    plan (dict) - batch plan created by createBatchPlan
+# OUTPUTS:
+#    list of (start, end) tuples
+def getBatchBounds(plan):
+    batchSize, nBirths = plan['batchSize'], plan['nBirths']
+    return([(start,min(start+batchSize,nBirths)) for start in range(0,nBirths,batchSize)])
+
+# save a batch plan in the folder containing the wind matrix partitions
+# INPUTS:
+#    plan (dict) - batch plan created by createBatchPlan
+#    partitionFolder (str) - folder containing the w_ <n>.npy partitions
+def savePlan(plan,partitionFolder):
+    if not(os.path.exists(partitionFolder)):
+        os.makedirs(partitionFolder)
+    with open(os.path.join(partitionFolder,PLAN_FILENAME),'w') as f:
+        json.dump(plan,f,indent=2)
+
+# load the batch plan saved in a partition folder
+# INPUTS:
+#    partitionFolder (str) - folder containing the w_ <n>.npy partitions
+# OUTPUTS:
+#    plan (dict), None if the folder does not contain a plan
+def loadPlan(partitionFolder):
+    planFile = os.path.join(partitionFolder,PLAN_FILENAME)
+    if not(os.path.exists(planFile)):
+        return(None)
+    with open(planFile) as f:
+        return(json.load(f))
+
+# get the batch plan for a birth year.  A plan saved by an earlier run is reused so partitions created
+# before an interruption line up with the remaining batches.  A new plan is created if none exists, if the
+# cohort size or number of downwind kernels changed, or if replan is requested
+# INPUTS:
+#    year (int) - birth year
+#    nBirths (int) - number of maternal residences with hourly wind records
+#    backend (str) - name of the compute backend (see windBackends.py)
+#    partitionFolder (str) - folder containing the w_ <n>.npy partitions
+#    batchSize (int) - optional fixed batch size, overrides the memory based estimate
+#    replan (bool) - if True, ignore any saved plan
+#    nKernels (int) - number of downwind kernels evaluated in one pass
+# OUTPUTS:
+#    plan (dict)
+def getBatchPlan(year,nBirths,backend,partitionFolder,batchSize=None,replan=False,nKernels=1):
+    plan = None if replan else loadPlan(partitionFolder)
+    if (plan is not None and plan['nBirths'] == nBirths and plan.get('nKernels',1) == nKernels
+        and batchSize in (None,plan['batchSize'])):
+        print("reusing batch plan: %i batches of %i residences" %(plan['nBatches'],plan['batchSize']))
+        return(plan)
+    plan = createBatchPlan(year,nBirths,backend,batchSize=batchSize,nKernels=nKernels)
+    savePlan(plan,partitionFolder)
+    print("created batch plan: %i batches of %i residences using %s memory" %(plan['nBatches'],plan['batchSize'],plan['memorySource']))
+    return(plan)
@@ -5,236 +5,253 @@
 #          around each maternal residence in a yearly subset of the Texas cohort
 # Steps to create wind estimates include :
 # 1) loading hourly wind estimates from storage
-# 2) reformatting data for matrix algebra operations on GPUs
-# 3) push data to GPU memory
-# 4) calculate number of days downwind for each radial degree using GPUS
-# 5) push wind matrix back to RAM 
-# 6) save wind matrix to storage
+# 2) reformatting data for matrix algebra operations on GPUs or CPUs
+# 3) push data to GPU memory (cuda backend only)
+# 4) calculate number of days downwind for each radial degree using GPUS or all CPU cores
+# 5) push wind matrix back to RAM (cuda backend only)
+# 6) save wind matrix to storage on a background thread while the next batch is processed
 
 
 # important information:
 # tested on RTX 3090 and RTX Titan GPUs
-# 24GB GPU ram is necesssary for a batch size of 1000.  Decrease batch size for GPUs with less RAM
+# batch size is chosen at runtime from free GPU memory or available host RAM (see batchPlanner.py)
+# and saved to windPartitions/<year>/batchPlan.json.  Use --batch-size to override
 # CUDA version 11.3.  Newer version of CUDA are not comptabile with numba at this time (Fall 2021).
+# nodes without a GPU use the numba cpu or numpy backends in windBackends.py, which produce
+# bit-identical output.  Select a backend with --backend (default 'auto')
+# when hourly records were extracted per ERA5 cell (see eraGrid.py), ids are cell labels and each
+# wind matrix row is shared by all births in the cell
+# sensitivity analyses (other angular windows, daytime or nighttime hours) are evaluated in the same pass
+# with repeated --kernel arguments.  Each kernel's partitions are saved in windPartitions/<year>/<kernel name>/
 
 
 ############### Setup: import libraries and define constants ##############
-from __future__ import division
-from numba import cuda, float32
+import argparse
 import numpy as np
-import math
-import numba
 import pandas as ps
-import time
 import os
 import gConst as const
+import windBackends
+import batchPlanner
+import windRoseStore
+import windPartitioner
+import windowIndex
+import hourlyWindStore
+import ioPipeline
 
 BIRTH_FOLDER = const.WIND_FOLDER + "Birth_Addresses_Wind/births_by_year/"
 YEAR = 2009
-
-
-# constants necessary for GPU oeprations.  MUST BE SET/HARD-CODED BEFORE RUNTIME!!!!
-N_ANGLES = 360
-N_BIRTHS = 624 # input data is preprocessed into batch sizes of 1000
-thread_x_dim = math.ceil(360/128)*128 # number of threads per streaming multiprocessor
-thread_dim = (thread_x_dim,1) # cuda requires 2d tuple
-block_x_dim = 24 # months in 2 years, one of the dimensions of the output wind matrix
-block_y_dim = 31 # max days in month, one ofthe dimensions of the output wind matrix
-block_z_dim = N_BIRTHS # number of 
-block_dim = (block_x_dim,block_y_dim,block_z_dim)
-TOTAL_THREADS = thread_x_dim*block_x_dim*block_y_dim*block_z_dim
+BACKEND = 'auto' # 'auto', 'cuda', 'numba', or 'numpy'
+OUTPUT_FORMAT = 'npy' # 'npy' (float64), 'wrt' (compact uint8, see windRoseStore.py), or 'hourly' (see hourlyWindStore.py)
+RAW_DATA_EXTENSIONS = ['','.parquet','.feather','.csv'] # formats accepted for comb_<year> hourly records ('' is a partitioned dataset)
+UTC_OFFSET = -6 # central standard time.  ERA5 hours are UTC, kernel hour ranges are local
 
 
 
 ################ Helper functions called by the main function ##############
 
-# create a uniqueId->index map.  Called in combination with the python map function
+# get the filepath to the long-format hourly wind records for a birth year.  Partitioned datasets
+# (see longTableStore.py) and columnar copies (parquet or feather) are preferred over the csv when they exist
+# INPUTS:
+#    year (int) - birth year
+# OUTPUTS:
+#    filepath (str)
+def getRawDataFile(year):
+    for extension in RAW_DATA_EXTENSIONS:
+        filepath = const.WIND_FOLDER + "/comb_" + str(year) + extension
+        if os.path.exists(filepath):
+            return(filepath)
+    raise FileNotFoundError("no hourly wind records found for %i" %(year))
+
+# parse a downwind kernel argument of the form name,maxDiff or name,maxDiff,startHour-endHour
+# INPUTS:
+#    kernelText (str) - e.g. 'wide,22.5' or 'day,15,7-19'.  Hours are local, the end hour is exclusive
+#    utcOffset (int) - local time minus UTC, in hours
+# OUTPUTS:
+#    kernel (dict) - created by windBackends.createKernel
+def parseKernel(kernelText,utcOffset=UTC_OFFSET):
+    fields = kernelText.split(',')
+    if len(fields) not in (2,3):
+        raise ValueError("kernels must be formatted as name,maxDiff[,startHour-endHour]: %s" %(kernelText))
+    hourMask = None
+    if len(fields) == 3:
+        startHour, endHour = [int(hour) for hour in fields[2].split('-')]
+        hourMask = windBackends.localHourMask(startHour,endHour,utcOffset)
+    return(windBackends.createKernel(fields[0],float(fields[1]),hourMask))
+
+# get the folders where partitions are saved.  Without kernels partitions are saved in the year folder,
+# with kernels each kernel has its own subfolder with the layout of a single wind matrix.  Set KERNEL_NAME
+# in residentialWindParallel.py to read one kernel's subfolder
 # INPUTS:
-#    idToMap (str) - unique id too map
+#    partitionFolder (str) - folder containing the partitions for a birth year
+#    kernels (list) - optional kernels created by windBackends.createKernel
 # OUTPUTS:
-#    index of the unique id (int)
-def mapIds(idToMap):
-    return masterList.index(idToMap)
+#    list of str
+def getKernelFolders(partitionFolder,kernels=None):
+    if kernels is None:
+        return([partitionFolder])
+    return([partitionFolder + kernel['name'] + '/' for kernel in kernels])
 
-# read hourly wind estimates extracted for all residences in the birth year
+# get the filepath whose existence marks a completed partition
+# INPUTS:
+#    partitionFolder (str) - folder containing the partitions for a birth year
+#    index (int) - partition index
+#    outputFormat (str) - 'npy', 'wrt', or 'hourly'
+# OUTPUTS:
+#    filepath (str)
+def getOutputFile(partitionFolder,index,outputFormat):
+    if outputFormat == 'hourly':
+        return(hourlyWindStore.getSidecarFile(partitionFolder,index))
+    return(partitionFolder + 'w_ ' + str(index) + ('.npy' if outputFormat == 'npy' else windRoseStore.FILE_EXTENSION))
+
+# get the filepath of the unique ids of a partition
 # INPUTS:
 #    year (int) - birth year
+#    index (int) - partition index
 # OUTPUTS:
-#    windTuples (array) - arrray of tuples.  Each tuple contains sorted 
-#                         hourly wind estimates and unique ids
-def readRawData(year):
-    windTuples = [] # each tuple contains wind estimates and unique ids for 1000 births
-    windData= ps.read_csv(const.WIND_FOLDER + "/comb_" + str(year) + ".csv")
-    print("finished loading wind data")
-    uniqueIds = list(set(windData['master_id'])) # all unique ids in the curr batch
-    numIds = len(uniqueIds) 
-    curIndex = 0
-
-    # for each 1000 unique ids, get wind records for those ids, sort the ids and wind records
-    # in the same order, and create a tuple.  Adjust the month variable to be relative to the first 
-    # month of coverage (january year before birth)
-    while(curIndex < numIds):
-        subsetids = uniqueIds[curIndex: min(curIndex+1000,numIds)] # get next 1000 unique ids
-        subsetData = windData[windData['master_id'].isin(subsetids)] # get records for this subset of ids
-        subsetData.sort_values(by=['master_id'],inplace=True) # sort wind records by unique ids
-        subsetids.sort() # sort unique ids
-        
-        # for records in the year of the birth, add 12 to the months value.  This makes the month variable
-        # relative to the first month of coverage (january year before birth)
-        tempVals = (subsetData['year'] - year +1)*12 # 
-        subsetData['month'] = subsetData['month'] + tempVals
-        
-        windTuples.append((subsetData,subsetids))
-        curIndex+=1000 # go to next batch of 1000 unique ids
-        print(curIndex)
-    print("completed partitioning wind data")
-    return(windTuples)
+#    filepath (str)
+def getIdFile(year,index):
+    return(const.WIND_FOLDER + "masterIds/" + str(year) + "/id_" + str(index) + ".csv")
 
+# save one partition in a single folder
+# INPUTS:
+#    resStation (numpy array) - wind matrix (id, month, day, angle), or hourly matrix for the 'hourly' format
+#    masterList (list) - unique ids, sorted in the same order as resStation
+#    year (int) - birth year
+#    partitionFolder (str) - folder the partition is saved in
+#    index (int) - partition index
+#    outputFormat (str) - 'npy', 'wrt', or 'hourly'
+#    compress (bool) - if True, compress 'wrt' partitions in chunks
+#    buildIndex (bool) - if True, also save a prefix-sum window index for the partition
+def savePartitionFile(resStation,masterList,year,partitionFolder,index,outputFormat,compress,buildIndex):
+    outputFile = getOutputFile(partitionFolder,index,outputFormat)
+    # the output file marks a completed partition, so it is written last
+    if buildIndex and outputFormat != 'hourly':
+        windowIndex.writeWindowIndex(resStation,masterList,year,partitionFolder,index)
+    if outputFormat == 'hourly':
+        hourlyWindStore.writeHourlyStore(resStation,masterList,year,partitionFolder,index)
+    elif outputFormat == 'npy':
+        with open(outputFile + '.tmp', 'wb') as f:
+            np.save(f, resStation)
+        os.replace(outputFile + '.tmp',outputFile)
+    else:
+        windRoseStore.writeWindRoseTensor(outputFile,resStation,masterList,year,compress)
 
+# save one partition and its unique ids.  Runs on the write-behind thread
+# INPUTS:
+#    resStation (numpy array) - wind matrix (id, month, day, angle), hourly matrix for the 'hourly' format,
+#                               or wind matrices (kernel, id, month, day, angle) when kernels are evaluated
+#    masterList (list) - unique ids, sorted in the same order as resStation
+#    year (int) - birth year
+#    index (int) - partition index
+#    outputFormat (str) - 'npy', 'wrt', or 'hourly'
+#    compress (bool) - if True, compress 'wrt' partitions in chunks
+#    buildIndex (bool) - if True, also save a prefix-sum window index for the partition
+#    kernels (list) - optional kernels created by windBackends.createKernel, one per leading axis of resStation
+def savePartition(resStation,masterList,year,index,outputFormat,compress,buildIndex,kernels=None):
+    partitionFolder = const.WIND_FOLDER + 'windPartitions/' + str(year) + '/'
+
+    # convert results to pandas dataframe and save.  Ids are saved before the partition, so a
+    # completed partition always has its ids
+    masterDF = ps.DataFrame({
+        'masterIds':masterList
+    })
+    masterDF.to_csv(getIdFile(year,index),index=False)
+
+    if kernels is None:
+        savePartitionFile(resStation,masterList,year,partitionFolder,index,outputFormat,compress,buildIndex)
+    else:
+        for kernelIndex, kernelFolder in enumerate(getKernelFolders(partitionFolder,kernels)):
+            savePartitionFile(resStation[kernelIndex],masterList,year,kernelFolder,index,outputFormat,compress,buildIndex)
+    print("saved index %i" %(index))
 
-################### precombiled GPU operations #####################
-# cuda function.  Must be compiled before runtime (@cuda.jit decorator)
 
 
+################# Main function ######################
 
-# rearrange data so hourly records in the matrix are organized by:
-#      matrix[hourIndex][dayIndex][monthIndex][uniqueIdIndex]
-# INPUTS:
-#    idList (numpy array) - indeces for unique ids
-#    hour (numpy arrray) - hour of the wind direction measures
-#    day (numpy array) - day of the wind direction measures
-#    month (numpy array) - month of the wind direction measures
-#    wind_dir (numpy array) - wind direction measures
-#    outData (numpy array) - stores reorganized wind direction measures
-#    maxThread (int) - number of wind direction measures
-@cuda.jit
-def rearrangeData(idList,hour,day,month,wnd_dir,outData,maxThread):
-    tid = cuda.blockIdx.x*cuda.blockDim.x + cuda.threadIdx.x
-    if(tid < maxThread):
-        outData[hour[tid],day[tid]-1,month[tid]-1,idList[tid]] = wnd_dir[tid]
-    
-
-# calculate number of hours each radial degree is upwind of the maternal residence
-# results are stored in place in the output dataset
+# for each batch of maternal residences, rearrange data into matrix organized by day, month, year, 
+# and unique id, calculate daily number of hours downwind for all 360 degrees, and save data as npy file
 # INPUTS:
-#    inputData (numpy array) - hourly wnd direction matrix
-#    outputData (numpy array) - where results are stored in place
-@cuda.jit
-def calcDailyDownwind(inputData,outputData):
-    
-    
-    # inline function.  Must be within compiled function so it can be sent to the 
-    # GPU driver and implemented by each streaming multiprocessor at runtime
-    # test if a radial degree is within the +/- 15 degree angular window for being downwind
-    # INPUTS:
-    #    val1 (int) - radial degree
-    #    val2 (int) - wind direction
-    # OUTPUTS:
-    #     True if radial degree is within 15 degrees of wind direction. False otherwise.
-    def isDownwind(val1,val2):
-        diff1 = val1 - val2 if val1-val2 > 0 else (val1-val2 + 360)
-        diff2 = val2 - val1 if val2-val1 >0 else (val2 - val1 + 360)
-        minDiff = min(diff1,diff2)
-        if(minDiff < 15):
-            return 1
-        return 0
-    
-    # each of the 360 degrees is assigned a unique thread id along the x axis of the cuda block
-    angle = cuda.threadIdx.x
-    
-    # cuda has thousands of threads per sm along the x axis.  No need to go beyond 360
-    if(angle >= 360):
-        return
-
-    # important that these dimensions/indeces match those assigned in the funtion 'rearrange data'
-    day = cuda.blockIdx.y
-    month = cuda.blockIdx.x
-    station = cuda.blockIdx.z
-
-    # for each hour in 24 hours of a day, test if the current radial degree is downwind of the wind direction
-    # add to the hours downwind if yes, do not change hoursDownwind otherwise
-    hoursDownwind = 0
-    for hourIndex in range(24):
-        wndAngle = inputData[hourIndex,day,month,station]
-        if(wndAngle>=0):
-            hoursDownwind += isDownwind(angle,wndAngle)
-        else:
-            hoursDownwind = -999
-    
-    # WARNING: IT IS ESSENTIAL THAT EACH THREAD HAS GUARANTEED EXCLUSIVE ACCESS TO IT's INDEX IN THE 
-    # outputData matrix.  One thread, one index exactly.
-
-    # update the output dataset in place
-    outputData[station,month,day,angle] = hoursDownwind
-
-
+#    year (int) - birth year
+#    backend (str) - name of the compute backend to use (see windBackends.py)
+#    batchSize (int) - optional fixed batch size.  By default the batch size is chosen from available memory
+#    replan (bool) - if True, ignore the batch plan saved by an earlier run
+#    outputFormat (str) - 'npy' for float64 partitions, 'wrt' for compact uint8 partitions, 'hourly' for raw
+#                         hourly wind directions (wind roses are built on demand, no wind matrix is calculated)
+#    compress (bool) - if True, compress 'wrt' partitions in chunks
+#    buildIndex (bool) - if True, also save a prefix-sum window index for each partition (see windowIndex.py)
+#    kernels (list) - optional downwind kernels created by windBackends.createKernel, evaluated in one pass
+#                     over the hourly data.  Ignored for the 'hourly' format, where the angular window is
+#                     chosen when wind roses are built
+def processYear(year,backend,batchSize=None,replan=False,outputFormat=OUTPUT_FORMAT,compress=False,buildIndex=False,kernels=None):
+    partitionFolder = const.WIND_FOLDER + 'windPartitions/' + str(year) + '/'
+    if outputFormat == 'hourly':
+        kernels = None
+    if kernels is not None:
+        windBackends.validateKernels(kernels)
+    windTable = windPartitioner.readLongTable(getRawDataFile(year)) # single pass, ids coded in sorted order
+    print("finished loading wind data")
+    nKernels = 1 if kernels is None else len(kernels)
+    plan = batchPlanner.getBatchPlan(year,len(windTable['ids']),backend,partitionFolder,batchSize,replan,nKernels)
+    partitions = windPartitioner.createPartitions(windTable,year,batchPlanner.getBatchBounds(plan))
+    print("completed partitioning wind data")
 
-################# Main function ######################
-windTuples = readRawData(YEAR)
-index = 0
-
-
-# for each batch of 1000 maternal residences
-# rearrange data into matrix organized by day, month, year, and unique id
-# calculate daily number of hours downwind for all 360 degrees 
-# save data as npy file
-for tupleVal in windTuples:
-    outputFile = const.WIND_FOLDER + 'windPartitions/' + str(YEAR) + '/w_ ' + str(index) + '.npy'
-    
-    # no need to process data if output file was already created
-    if not(os.path.exists(outputFile)):
-        print("starting index %i" %(index))
-
-        windData, masterList = tupleVal[0], tupleVal[1]
-
-        # get index for each unique id
-        inputIds = list(map(mapIds,windData['master_id']))
-
-        # transfer data from RAM to GPU memory.  Part of this process
-        # includes creating variables on the GPU
-        inputList = cuda.to_device(np.array(inputIds))
-        cuda.synchronize()
-        inputHour = cuda.to_device(np.array(windData['hour']))
-        cuda.synchronize()
-        inputDay = cuda.to_device(np.array(windData['day']))
-        cuda.synchronize()
-        inputMonth = cuda.to_device(np.array(windData['month']))
-        cuda.synchronize()
-        inputDir = cuda.to_device(np.array(windData['wnd_dir']))
-        cuda.synchronize()        
-        testInput = np.full((24,31,24,N_BIRTHS),-999,np.int16)
-        outData = cuda.to_device(testInput)
-        cuda.synchronize()
-        nThreads = len(windData['hour'])
-        cuda.synchronize()
-        nBlocks = math.ceil(nThreads/thread_x_dim)
-        cuda.synchronize()
-
-        # rearrange wind direction so its organized in a matrix by day,month,year,unique id
-        rearrangeData[(nBlocks,1),(thread_x_dim,1)](inputList,inputHour,inputDay,inputMonth,inputDir,outData,nThreads)
-        cuda.synchronize()
-        print("finished rearranging data")
-
-        blankFile = np.full((N_BIRTHS,24,31,360),-999,np.float) # blank output matrix.  CUDA writes in place
-        cuda.synchronize()
-
-        station_mem = cuda.to_device(blankFile) # version of blank file to store on the GPU
-        cuda.synchronize()
-
-        # calcualte number or hours downwind for each of 360 degrees, for each day, each maternal residence
-        calcDailyDownwind[block_dim,(thread_dim)](outData,station_mem)
-        print("calcualted daily averages")
-        cuda.synchronize()
-     
-        # transfer results from GPU to RAM
-        resStation = station_mem.copy_to_host()
-
-        # convert results to pandas dataframe and save 
-        with open(outputFile, 'wb') as f:
-            np.save(f, resStation)
-        masterDF = ps.DataFrame({
-            'masterIds':masterList
-        })
-        masterDF.to_csv(const.WIND_FOLDER + "masterIds/" + str(YEAR) + "/id_" + str(index) + ".csv",index=False)
-    index+=1    
-    
+    # no need to process data if output files were already created for every kernel
+    kernelFolders = getKernelFolders(partitionFolder,kernels)
+    for kernelFolder in kernelFolders:
+        if not(os.path.exists(kernelFolder)):
+            os.makedirs(kernelFolder)
+    remaining = [index for index in range(len(partitions['bounds']))
+        if not(os.path.exists(getIdFile(year,index))
+            and all(os.path.exists(getOutputFile(kernelFolder,index,outputFormat)) for kernelFolder in kernelFolders))]
+
+    # the next batch is gathered and finished partitions are saved in background threads while
+    # the current batch is processed (see ioPipeline.py)
+    writer = ioPipeline.startWriter()
+    try:
+        for index, batch in ioPipeline.prefetch(lambda index: windPartitioner.getBatch(partitions,index),remaining):
+            print("starting index %i" %(index))
+            masterList = batch['ids']
+
+            # raw hourly partitions skip the wind matrix entirely
+            if outputFormat == 'hourly':
+                resStation = hourlyWindStore.createHourlyMatrix(batch,year)
+            elif kernels is None:
+                # calcualte number or hours downwind for each of 360 degrees, for each day, each maternal residence
+                resStation = windBackends.calcWindMatrix(
+                    backend,batch['idIndex'],batch['hour'],batch['day'],batch['month'],batch['wnd_dir'],len(masterList)
+                )
+                print("calcualted daily averages")
+            else:
+                # one pass over the hourly data for all downwind kernels
+                resStation = windBackends.calcWindMatrixMulti(
+                    backend,batch['idIndex'],batch['hour'],batch['day'],batch['month'],batch['wnd_dir'],len(masterList),kernels
+                )
+                print("calcualted daily averages for %i kernels" %(len(kernels)))
+            ioPipeline.submitWrite(writer,savePartition,resStation,masterList,year,index,outputFormat,compress,buildIndex,kernels)
+    finally:
+        # partitions already queued are saved even if a batch fails or the run is interrupted
+        ioPipeline.closeWriter(writer)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="calculate daily hours downwind for each maternal residence")
+    parser.add_argument('--year',type=int,default=YEAR,help="birth year to process")
+    parser.add_argument('--backend',default=BACKEND,choices=['auto'] + list(windBackends.BACKENDS.keys()),
+        help="compute backend.  'auto' prefers the GPU, then numba cpu kernels, then numpy")
+    parser.add_argument('--batch-size',type=int,default=None,
+        help="residences per batch.  By default chosen from available GPU or host memory")
+    parser.add_argument('--replan',action='store_true',help="ignore the batch plan saved by an earlier run")
+    parser.add_argument('--format',default=OUTPUT_FORMAT,choices=['npy','wrt','hourly'],
+        help="partition format. 'wrt' stores hours downwind as uint8 (8x smaller), 'hourly' stores raw hourly wind directions")
+    parser.add_argument('--compress',action='store_true',help="compress 'wrt' partitions in chunks")
+    parser.add_argument('--window-index',action='store_true',
+        help="also save a prefix-sum index for wind roses over arbitrary date windows")
+    parser.add_argument('--kernel',action='append',default=None,
+        help="downwind kernel name,maxDiff[,startHour-endHour] (local hours, end exclusive).  Repeat to evaluate "
+        + "several kernels in one pass, e.g. --kernel base,15 --kernel wide,22.5 --kernel day,15,7-19")
+    parser.add_argument('--utc-offset',type=int,default=UTC_OFFSET,help="local time minus UTC for kernel hour ranges")
+    args = parser.parse_args()
+    backend = windBackends.selectBackend(args.backend)
+    print("using %s backend" %(backend))
+    kernels = None if args.kernel is None else [parseKernel(kernelText,args.utc_offset) for kernelText in args.kernel]
+    processYear(args.year,backend,args.batch_size,args.replan,args.format,args.compress,args.window_index,kernels)
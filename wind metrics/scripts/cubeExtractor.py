@@ -0,0 +1,142 @@
+############### cubeExtractor.py #############
+# Developed for HEI Transit Study
+# Summary: extract hourly wind direction at maternal residences from wind direction cubes (windCube.py)
+#          rather than extracting raster values to points once per day with arcpy
+# Steps include:
+# 1) computing the ERA5 grid (row, col) of each residence once, per occupied cell by default (see eraGrid.py)
+# 2) loading the cubes for the year before birth and the birth year
+# 3) gathering all hours for a partition of residences with a single fancy index into the cubes
+# 4) writing the (residence, calendar day, hour) int16 matrices directly as hourly wind partitions
+#    (see hourlyWindStore.py), with the masterIds csvs read by residentialWindParallel.py
+# Hours missing from a cube's mask are stored as -999, so days with a missing hour are treated as
+# missing downstream, as when a day without all 24 rasters was skipped during point extraction.
+# writeLongTable also saves the comb_<year> long-format dataset read by createWindMatrix.py
+
+
+############### Setup: import libraries and define constants ##############
+import os
+import numpy as np
+import pandas as ps
+import eraGrid
+import hourlyWindStore
+import longTableStore
+import windCube
+import windowIndex
+
+PARTITION_SIZE = 4096 # residences per hourly wind partition
+MISSING = -999
+
+
+
+################ Helper functions ##############
+
+# get the ids and ERA5 grid positions of the residences to extract
+# INPUTS:
+#    birthData (pandas dataframe) - maternal residences with uniqueid, b_lat, and b_long columns
+#    windFolder (str) - parent wind folder, where the cell map is saved
+#    year (int) - birth year
+#    deduplicate (bool) - if True, extract once per occupied ERA5 cell and save the birth -> cell map
+# OUTPUTS:
+#    ids (list) - sorted cell labels or birth ids
+#    rows, cols (numpy int64 arrays) - grid position of each id
+def getResidenceGrid(birthData,windFolder,year,deduplicate=True):
+    if deduplicate:
+        cellMap = eraGrid.createCellMap(birthData)
+        eraGrid.saveCellMap(cellMap,windFolder,year)
+        ids = list(eraGrid.getOccupiedCells(cellMap)[eraGrid.CELL_ID_COL])
+        cellIds = np.array([int(label[len(eraGrid.CELL_PREFIX):]) for label in ids],dtype=np.int64)
+    else:
+        birthData = birthData.assign(cellNum=eraGrid.getCellIds(birthData['b_lat'],birthData['b_long']))
+        birthData = birthData[birthData['cellNum'] >= 0].drop_duplicates('uniqueid')
+        birthData = birthData.iloc[np.argsort(birthData['uniqueid'].astype(str).values,kind='stable')]
+        ids = list(birthData['uniqueid'].astype(str))
+        cellIds = birthData['cellNum'].values.astype(np.int64)
+    rows, cols = np.divmod(cellIds,eraGrid.N_COLS)
+    return(ids,rows,cols)
+
+# load the cubes covering the calendar days of a birth year's wind partitions (january of the year
+# before birth through december of the birth year) into memory, with unwritten hours set to -999
+# INPUTS:
+#    cubeFolder (str) - folder containing the cubes
+#    year (int) - birth year
+# OUTPUTS:
+#    int16 numpy array organized by (hour, row, col)
+def loadCubes(cubeFolder,year):
+    cubeList = []
+    for curYear in (year-1,year):
+        cube = windCube.openCube(cubeFolder,curYear)
+        direction = np.array(cube['direction'])
+        direction[~np.asarray(cube['mask'])] = MISSING
+        nMissing = int((~np.asarray(cube['mask'])).sum())
+        if nMissing > 0:
+            print("warning: %i hours missing from the %i wind cube" %(nMissing,curYear))
+        cubeList.append(direction)
+    return(np.concatenate(cubeList))
+
+# gather hourly wind directions for a set of grid positions
+# INPUTS:
+#    direction (numpy array) - created by loadCubes
+#    rows, cols (numpy arrays) - grid position of each residence
+# OUTPUTS:
+#    int16 numpy array organized by (residence, calendar day, hour)
+def gatherHourly(direction,rows,cols):
+    hourly = direction[:,rows,cols] # (hour, residence)
+    return(np.ascontiguousarray(hourly.T.reshape(len(rows),-1,windCube.N_HOURS)))
+
+
+
+################ Main extraction functions ##############
+
+# extract hourly wind directions for all residences in a birth year and save them as hourly wind
+# partitions, replacing point extraction and combining daily csvs
+# INPUTS:
+#    birthData (pandas dataframe) - maternal residences with uniqueid, b_lat, and b_long columns
+#    year (int) - birth year
+#    cubeFolder (str) - folder containing the cubes
+#    windFolder (str) - parent wind folder.  Partitions are saved in windPartitions/<year>/ and
+#                       ids in masterIds/<year>/
+#    deduplicate (bool) - if True, extract once per occupied ERA5 cell
+#    partitionSize (int) - residences per partition
+# OUTPUTS:
+#    number of partitions saved (int)
+def extractYear(birthData,year,cubeFolder,windFolder,deduplicate=True,partitionSize=PARTITION_SIZE):
+    ids, rows, cols = getResidenceGrid(birthData,windFolder,year,deduplicate)
+    direction = loadCubes(cubeFolder,year)
+    nDays = len(windowIndex.getCalendarDays(year))
+    if direction.shape[0] != nDays*windCube.N_HOURS:
+        raise ValueError("wind cubes cover %i hours, expected %i" %(direction.shape[0],nDays*windCube.N_HOURS))
+    partitionFolder = windFolder + 'windPartitions/' + str(year) + '/'
+    idFolder = windFolder + "masterIds/" + str(year) + "/"
+    for folder in [partitionFolder,idFolder]:
+        if not(os.path.exists(folder)):
+            os.makedirs(folder)
+
+    for index, start in enumerate(range(0,len(ids),partitionSize)):
+        end = min(start+partitionSize,len(ids))
+        hourly = gatherHourly(direction,rows[start:end],cols[start:end])
+        hourlyWindStore.writeHourlyStore(hourly,ids[start:end],year,partitionFolder,index)
+        ps.DataFrame({'masterIds':ids[start:end]}).to_csv(idFolder + "id_" + str(index) + ".csv",index=False)
+        print("saved hourly partition %i for %i" %(index,year))
+    return(len(range(0,len(ids),partitionSize)))
+
+# convert hourly wind partitions to the comb_<year> long-format dataset read by createWindMatrix.py
+# (see longTableStore.py).  Only hours present in the cubes are included
+# INPUTS:
+#    year (int) - birth year
+#    windFolder (str) - parent wind folder
+# OUTPUTS:
+#    dataset folder (str)
+def writeLongTable(year,windFolder):
+    store = hourlyWindStore.openHourlyStore(windFolder + 'windPartitions/' + str(year) + '/')
+    writer = longTableStore.startWriter(longTableStore.getDatasetFolder(windFolder,year))
+    days = windowIndex.getCalendarDays(year).astype(object)
+    for partition, hourly in enumerate(store['hourly']):
+        hourly = np.asarray(hourly)
+        partitionIds = np.asarray(store['ids'][store['partition'] == partition])
+        for dayIndex, dayDate in enumerate(days):
+            isValid = (hourly[:,dayIndex] >= 0).all(axis=1) # days with a missing hour have no records, as in the daily csvs
+            if isValid.any():
+                dayTable = longTableStore.meltDay(hourly[isValid,dayIndex],partitionIds[isValid],dayDate.year,dayDate.month,dayDate.day)
+                longTableStore.appendRecords(writer,dayTable)
+    longTableStore.closeWriter(writer)
+    return(writer['folder'])
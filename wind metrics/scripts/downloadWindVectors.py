@@ -4,26 +4,31 @@
 # Summary: 
 # 1) download daily 10m u- and v- wind vector components from the ERA5 reanalysis product
 # 2) calculate daily wind speed from u and v wind vectors
+#    by default each year is converted to a single wind direction cube (see windCube.py) rather than
+#    one .tif per hour
 # 3) reference: https://confluence.ecmwf.int/display/CKB/ERA5%3A+data+documentation
 
 
 ############### Setup: import libraries and define constants ##############
-#import cdsapi
 import os
 import math
 import numpy as np
 from multiprocessing import Pool 
 import arcpy
 import gConst as const
+import windCube
+import eraDownloader
 arcpy.env.overwriteOutput = True
 N_PROCESSES = 96 # number of parallel processes to run.  Empirically 96 is ideal for a 64-core multithreaded processor
 
-# required API to automate ERA5 data download.   See https://cds.climate.copernicus.eu/api-how-to
-#c = cdsapi.Client()
+# ERA5 requests are sent with the cdsapi client in eraDownloader.py.   See https://cds.climate.copernicus.eu/api-how-to
 
 PARENT_FOLDER = const.WIND_FOLDER
 WIND_VECTOR_FOLDER = PARENT_FOLDER + "wind_surfaces/wind_components/"
 WIND_DIRECTION_FOLDER = PARENT_FOLDER + "wind_surfaces/wind_direction/"
+WIND_CUBE_FOLDER = PARENT_FOLDER + "wind_surfaces/wind_cubes/"
+OUTPUT_CUBE = True # save one wind direction cube per year instead of one .tif per hour
+DOWNLOAD_COALESCE = 'month' if OUTPUT_CUBE else 'day' # hourly .tif conversion expects one grib file per day
 DAYS_IN_MONTH = [31,28,31,30,31,30,31,31,30,31,30,31]
 LEAP_YEARS = [2008,2012,2016]
 COMPONENT_DICT = {
@@ -38,60 +43,17 @@ PROJECTION = "GEOGCS['GCS_Coordinate_System_imported_from_GRIB_file',DATUM['D_un
 
 
 
-# download hourly wind components for one 24 hour period
+# download one year of wind components (hourly temporal resolution).  Requests run concurrently and
+# completed files are recorded in a checksum manifest so interrupted downloads resume (see eraDownloader.py)
 # INPUTS:
 #    year (int) - year of interest
-#    month (int) - month of interest
-#    day (int) - day of interest
-#    filename (string) - full filepath where the downloaded data should be stored
-def downloadHourlyDataOneData(year,month,day,filename):
-    d = c.retrieve(
-    'reanalysis-era5-single-levels',
-    {
-        'product_type': 'reanalysis',
-        'variable': [
-            '10m_u_component_of_wind', '10m_v_component_of_wind',
-        ],
-        'year': str(year),
-        'month': str(month).zfill(2),
-        'day': str(day).zfill(2),
-        'time': [
-            '00:00', '01:00', '02:00',
-            '03:00', '04:00', '05:00',
-            '06:00', '07:00', '08:00',
-            '09:00', '10:00', '11:00',
-            '12:00', '13:00', '14:00',
-            '15:00', '16:00', '17:00',
-            '18:00', '19:00', '20:00',
-            '21:00', '22:00', '23:00',
-        ],
-        'format': 'grib',
-        'area': [
-            40, -120, 20, 
-            -90,
-        ],
-    },
-    filename)
-
-# download one year of wind components (hourly temporal resolution)
-# INPUTS:
-#    year (int) - year of interest
-def downloadSingleYearData(year):
+#    fetch (function) - optional fetcher, e.g. eraDownloader.createHttpFetcher for a stand-in server.
+#                       Defaults to the CDS
+def downloadSingleYearData(year,fetch=None):
     yearFolder = WIND_VECTOR_FOLDER + str(year) + "/"
-    if not(os.path.exists(yearFolder)): 
-        os.mkdir(yearFolder)
-
-    # for each month in the year
-    for month in list(range(1,13)):
-        curDays = DAYS_IN_MONTH[month-1]
-        if(year % 4 == 0 and month == 2): # adjust days in Feb for leap year if necessary
-            curDays +=1
-        
-        # for each day in the month
-        for day in list(range(1,curDays+1)):
-            outputFile = yearFolder + str(year) + "_" + str(month).zfill(2) + "_" + str(day).zfill(2) + ".grib"
-            if not os.path.exists(outputFile):
-                downloadHourlyDataOneData(year,month,day,outputFile)
+    if fetch is None:
+        fetch = eraDownloader.createCdsFetcher()
+    eraDownloader.downloadYear(year,yearFolder,fetch,DOWNLOAD_COALESCE)
 
 
 
@@ -196,10 +158,25 @@ def convertComponentsToDirectionOneYear(year):
 
 
 
+# convert hourly u- and v- wind components for an entire year to a single wind direction cube.
+# Each grib file is decoded once and directions are calculated for all of its hours at once
+# INPUTS:
+#    year (int) - year of interest
+def convertComponentsToCubeOneYear(year):
+    inputFolder = WIND_VECTOR_FOLDER + str(year) + "/"
+    gribFiles = sorted([inputFolder + filename for filename in os.listdir(inputFolder) if filename.endswith(".grib")])
+    windCube.convertYear(gribFiles,WIND_CUBE_FOLDER,year,N_PROCESSES)
+
+
+
 ################# Main function ######################
 
 if __name__ == '__main__':
     for year in YEARS:
         downloadSingleYearData(year)
-    with Pool(processes=N_PROCESSES) as pool:
-        res = pool.map(convertComponentsToDirectionOneYear,YEARS)
\ No newline at end of file
+    if OUTPUT_CUBE:
+        for year in YEARS:
+            convertComponentsToCubeOneYear(year)
+    else:
+        with Pool(processes=N_PROCESSES) as pool:
+            res = pool.map(convertComponentsToDirectionOneYear,YEARS)
\ No newline at end of file
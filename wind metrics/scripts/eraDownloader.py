@@ -0,0 +1,328 @@
+############### eraDownloader.py #############
+# Developed for HEI Transit Study
+# Summary: download ERA5 10m u- and v- wind components with a bounded number of concurrent requests
+#          instead of one day at a time
+# Steps include:
+# 1) planning one request per day, or one per month when requests are coalesced.  Monthly files are
+#    named <year>_<MM>.grib and are read by windCube.py in one pass
+# 2) skipping files recorded in the year's manifest, after checking their size and sha256 checksum
+# 3) retrieving the remaining files in a thread pool, retrying failed requests with exponential backoff
+# 4) recording each completed file in the manifest, so interrupted downloads resume where they stopped
+# The fetcher is a function fetch(request, targetFile) and can be swapped out.  createCdsFetcher uses the
+# cdsapi client, createHttpFetcher posts requests to a stand-in server such as the one started by
+# startLocalServer, for offline runs
+
+
+############### Setup: import libraries and define constants ##############
+import argparse
+import calendar
+import datetime
+import hashlib
+import http.server
+import json
+import os
+import random
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import eraGrid
+
+DATASET = 'reanalysis-era5-single-levels'
+VARIABLES = ['10m_u_component_of_wind','10m_v_component_of_wind']
+HOURS = [str(hour).zfill(2) + ':00' for hour in range(24)]
+AREA = [eraGrid.GRID_NORTH,eraGrid.GRID_WEST,eraGrid.GRID_SOUTH,eraGrid.GRID_EAST]
+MANIFEST_FILENAME = "manifest.json"
+MAX_CONCURRENT = 4 # requests in flight at once.  The CDS queues additional requests from the same user
+MAX_RETRIES = 5 # attempts per file after the first failure
+BACKOFF_SECONDS = 30 # wait before the first retry, doubled after each failed attempt
+HASH_BLOCK_BYTES = 1 << 20
+LOCAL_PORT = 8765
+
+
+
+################ Request planning ##############
+
+# create an ERA5 request for one day, or for all days of a month
+# INPUTS:
+#    year (int) - year of interest
+#    month (int) - month of interest
+#    day (int) - day of interest.  None requests the whole month
+# OUTPUTS:
+#    request (dict) - CDS request parameters
+def createRequest(year,month,day=None):
+    days = [day] if day is not None else list(range(1,calendar.monthrange(year,month)[1]+1))
+    request = {
+        'product_type': 'reanalysis',
+        'variable': VARIABLES,
+        'year': str(year),
+        'month': str(month).zfill(2),
+        'day': [str(curDay).zfill(2) for curDay in days],
+        'time': HOURS,
+        'format': 'grib',
+        'area': AREA
+    }
+    return(request)
+
+# get the filename for a daily or monthly download
+# INPUTS:
+#    year (int) - year of interest
+#    month (int) - month of interest
+#    day (int) - day of interest.  None for monthly downloads
+# OUTPUTS:
+#    filename (str)
+def getRequestFilename(year,month,day=None):
+    filename = str(year) + "_" + str(month).zfill(2)
+    if day is not None:
+        filename += "_" + str(day).zfill(2)
+    return(filename + ".grib")
+
+# plan the requests needed to download one year
+# INPUTS:
+#    year (int) - year of interest
+#    coalesce (str) - 'day' for one request per day, 'month' for one request per month
+# OUTPUTS:
+#    list of (filename, request) tuples
+def planYear(year,coalesce='month'):
+    if coalesce not in ('day','month'):
+        raise ValueError("requests can be coalesced by 'day' or 'month': %s" %(coalesce))
+    tasks = []
+    for month in range(1,13):
+        if coalesce == 'month':
+            tasks.append((getRequestFilename(year,month),createRequest(year,month)))
+            continue
+        for day in range(1,calendar.monthrange(year,month)[1]+1):
+            tasks.append((getRequestFilename(year,month,day),createRequest(year,month,day)))
+    return(tasks)
+
+
+
+################ Manifest ##############
+
+# calculate the sha256 checksum of a file
+# INPUTS:
+#    filepath (str) - file to hash
+# OUTPUTS:
+#    hex digest (str)
+def hashFile(filepath):
+    digest = hashlib.sha256()
+    with open(filepath,'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_BYTES),b''):
+            digest.update(block)
+    return(digest.hexdigest())
+
+# load the manifest of completed downloads in a folder
+# INPUTS:
+#    folder (str) - download folder
+# OUTPUTS:
+#    manifest (dict) - filename -> sha256, size, request, and download time
+def loadManifest(folder):
+    manifestFile = os.path.join(folder,MANIFEST_FILENAME)
+    if not(os.path.exists(manifestFile)):
+        return({})
+    with open(manifestFile) as f:
+        return(json.load(f))
+
+# save a manifest.  The previous manifest is replaced only once the new one is fully written
+# INPUTS:
+#    manifest (dict) - created by loadManifest
+#    folder (str) - download folder
+def saveManifest(manifest,folder):
+    manifestFile = os.path.join(folder,MANIFEST_FILENAME)
+    with open(manifestFile + ".tmp",'w') as f:
+        json.dump(manifest,f,indent=2,sort_keys=True)
+    os.replace(manifestFile + ".tmp",manifestFile)
+
+# check that a file recorded in the manifest is present and unchanged
+# INPUTS:
+#    manifest (dict) - created by loadManifest
+#    folder (str) - download folder
+#    filename (str) - file to check
+#    verify (bool) - if True, also compare the sha256 checksum (otherwise only the size is compared)
+# OUTPUTS:
+#    True if the file does not need to be downloaded again
+def isComplete(manifest,folder,filename,verify=True):
+    filepath = os.path.join(folder,filename)
+    if filename not in manifest or not(os.path.exists(filepath)):
+        return(False)
+    if os.path.getsize(filepath) != manifest[filename]['bytes']:
+        return(False)
+    return(not(verify) or hashFile(filepath) == manifest[filename]['sha256'])
+
+
+
+################ Fetchers ##############
+
+# create a fetcher that retrieves data from the Copernicus Climate Data Store.
+# See https://cds.climate.copernicus.eu/api-how-to
+# OUTPUTS:
+#    fetch (function) - fetch(request, targetFile)
+def createCdsFetcher():
+    import cdsapi
+    client = cdsapi.Client()
+
+    def fetch(request,targetFile):
+        client.retrieve(DATASET,request,targetFile)
+    return(fetch)
+
+# create a fetcher that posts requests to an http server implementing the same interface as
+# startLocalServer.  Used for offline runs against a stand-in for the CDS
+# INPUTS:
+#    baseUrl (str) - e.g. http://localhost:8765
+#    timeout (float) - seconds to wait for a response
+# OUTPUTS:
+#    fetch (function) - fetch(request, targetFile)
+def createHttpFetcher(baseUrl,timeout=600):
+    def fetch(request,targetFile):
+        body = json.dumps({'dataset':DATASET,'request':request}).encode()
+        httpRequest = urllib.request.Request(baseUrl.rstrip('/') + "/retrieve",data=body,
+            headers={'Content-Type':'application/json'})
+        with urllib.request.urlopen(httpRequest,timeout=timeout) as response, open(targetFile,'wb') as f:
+            for block in iter(lambda: response.read(HASH_BLOCK_BYTES),b''):
+                f.write(block)
+    return(fetch)
+
+# default response of the local server: deterministic bytes derived from the request, so repeated
+# requests return identical files
+# INPUTS:
+#    request (dict) - CDS request parameters
+# OUTPUTS:
+#    bytes
+def createPlaceholderData(request):
+    seed = hashlib.sha256(json.dumps(request,sort_keys=True).encode()).digest()
+    return(seed*(len(request['day'])*len(request['time'])))
+
+# start a local http server that stands in for the CDS.  Each POST to /retrieve returns the bytes
+# created by responder for the posted request.  Errors raised by responder return status 500
+# INPUTS:
+#    port (int) - port to listen on.  0 chooses a free port
+#    responder (function) - called with the request dict, returns the file contents (bytes)
+# OUTPUTS:
+#    server (ThreadingHTTPServer) - serving on a daemon thread.  The url is
+#                                   http://localhost:<server.server_address[1]>, stop with server.shutdown()
+def startLocalServer(port=LOCAL_PORT,responder=createPlaceholderData):
+    class RetrieveHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                data = responder(body['request'])
+            except Exception as e:
+                self.send_error(500,str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type','application/octet-stream')
+            self.send_header('Content-Length',str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self,format,*args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('localhost',port),RetrieveHandler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return(server)
+
+
+
+################ Main download functions ##############
+
+# download one file, retrying with exponential backoff.  The file is written under a temporary name
+# and renamed once complete, so partial downloads are never mistaken for finished ones
+# INPUTS:
+#    fetch (function) - fetch(request, targetFile)
+#    request (dict) - CDS request parameters
+#    filepath (str) - where the file is saved
+#    maxRetries (int) - attempts after the first failure
+#    backoffSeconds (float) - wait before the first retry
+# OUTPUTS:
+#    record (dict) - manifest entry for the file
+def fetchWithRetry(fetch,request,filepath,maxRetries=MAX_RETRIES,backoffSeconds=BACKOFF_SECONDS):
+    tempFile = filepath + ".part"
+    for attempt in range(maxRetries+1):
+        try:
+            fetch(request,tempFile)
+            record = {
+                'sha256':hashFile(tempFile),
+                'bytes':os.path.getsize(tempFile),
+                'request':request,
+                'downloaded':datetime.datetime.now().isoformat(timespec='seconds')
+            }
+            os.replace(tempFile,filepath)
+            return(record)
+        except Exception as e:
+            if attempt == maxRetries:
+                raise
+            wait = backoffSeconds*(2**attempt)*(1 + random.random())
+            print("attempt %i for %s failed (%s), retrying in %.0f seconds" %(attempt+1,os.path.basename(filepath),str(e),wait))
+            time.sleep(wait)
+
+# download one year of wind components, with up to maxConcurrent requests in flight
+# INPUTS:
+#    year (int) - year of interest
+#    folder (str) - folder where the year's files and manifest are saved
+#    fetch (function) - fetch(request, targetFile), e.g. from createCdsFetcher or createHttpFetcher
+#    coalesce (str) - 'day' for one file per day, 'month' for one file per month
+#    maxConcurrent (int) - number of requests in flight at once
+#    verify (bool) - if True, check the checksum of files recorded in the manifest before skipping them
+#    maxRetries (int) - attempts per file after the first failure
+#    backoffSeconds (float) - wait before the first retry
+# OUTPUTS:
+#    summary (dict) - lists of downloaded, skipped, and failed filenames
+def downloadYear(year,folder,fetch,coalesce='month',maxConcurrent=MAX_CONCURRENT,verify=True,
+    maxRetries=MAX_RETRIES,backoffSeconds=BACKOFF_SECONDS):
+    if not(os.path.exists(folder)):
+        os.makedirs(folder)
+    manifest = loadManifest(folder)
+    manifestLock = threading.Lock()
+    summary = {'downloaded':[],'skipped':[],'failed':[]}
+    tasks = []
+    for filename, request in planYear(year,coalesce):
+        if isComplete(manifest,folder,filename,verify):
+            summary['skipped'].append(filename)
+        else:
+            tasks.append((filename,request))
+
+    def downloadTask(task):
+        filename, request = task
+        try:
+            record = fetchWithRetry(fetch,request,os.path.join(folder,filename),maxRetries,backoffSeconds)
+        except Exception as e:
+            print("failed to download %s: %s" %(filename,str(e)))
+            summary['failed'].append(filename)
+            return
+        with manifestLock:
+            manifest[filename] = record
+            saveManifest(manifest,folder)
+            summary['downloaded'].append(filename)
+        print("downloaded %s" %(filename))
+
+    with ThreadPoolExecutor(max_workers=max(1,maxConcurrent)) as executor:
+        list(executor.map(downloadTask,tasks))
+    print("%i: %i downloaded, %i already complete, %i failed" %(year,len(summary['downloaded']),
+        len(summary['skipped']),len(summary['failed'])))
+    return(summary)
+
+
+
+################# Main function ######################
+
+if __name__ == '__main__':
+    import gConst as const
+    parser = argparse.ArgumentParser(description="download ERA5 10m wind components")
+    parser.add_argument('years',type=int,nargs='+',help="years to download")
+    parser.add_argument('--folder',default=const.WIND_FOLDER + "wind_surfaces/wind_components/",
+        help="parent folder, files are saved in <folder>/<year>/")
+    parser.add_argument('--coalesce',default='month',choices=['day','month'],help="one request per day or per month")
+    parser.add_argument('--concurrency',type=int,default=MAX_CONCURRENT,help="requests in flight at once")
+    parser.add_argument('--server',default=None,help="url of a stand-in server to use instead of the CDS")
+    parser.add_argument('--serve-local',action='store_true',help="start a local stand-in server and download from it")
+    args = parser.parse_args()
+    if args.serve_local:
+        server = startLocalServer()
+        fetch = createHttpFetcher("http://localhost:" + str(server.server_address[1]))
+    elif args.server is not None:
+        fetch = createHttpFetcher(args.server)
+    else:
+        fetch = createCdsFetcher()
+    for year in args.years:
+        downloadYear(year,os.path.join(args.folder,str(year)),fetch,args.coalesce,args.concurrency)
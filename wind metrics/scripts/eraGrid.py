@@ -0,0 +1,141 @@
+############### eraGrid.py #############
+# Developed for HEI Transit Study
+# Summary: map maternal residences to ERA5 grid cells.  ERA5 wind direction is constant within each
+#          0.25 degree cell, so hourly extraction (partitionWindByYear.py) and daily wind matrices
+#          (createWindMarix.py) only need to be computed once per occupied cell.  Per-birth results are
+#          an indexed view of the cell results (residentialWindParallel.py)
+# Steps include:
+# 1) converting residence coordinates to the row and column of the nearest ERA5 grid point
+# 2) labelling each occupied cell with a sortable id that replaces the birth id in the wind pipeline
+# 3) saving a cell map (birth id -> cell id) for each birth year
+
+
+############### Setup: import libraries and define constants ##############
+import os
+import numpy as np
+import pandas as ps
+
+# grid used when downloading ERA5 data (see downloadWindVectors.py, area [40,-120,20,-90]).
+# Grid points are the centers of raster cells
+GRID_NORTH = 40.0
+GRID_WEST = -120.0
+GRID_SOUTH = 20.0
+GRID_EAST = -90.0
+RESOLUTION = 0.25
+N_ROWS = int(round((GRID_NORTH - GRID_SOUTH)/RESOLUTION)) + 1
+N_COLS = int(round((GRID_EAST - GRID_WEST)/RESOLUTION)) + 1
+CELL_PREFIX = "cell_" # zero padded so that sorted labels are in cell id order
+CELL_ID_COL = 'cellId'
+
+
+
+################ Helper functions ##############
+
+# get the ERA5 grid cell containing each coordinate
+# INPUTS:
+#    lat (array-like) - latitude coordinates
+#    lon (array-like) - longitude coordinates
+# OUTPUTS:
+#    cellIds (numpy int32 array) - row*N_COLS + col, -1 for coordinates outside the grid
+def getCellIds(lat,lon):
+    row = np.round((GRID_NORTH - np.asarray(lat,dtype=np.float64))/RESOLUTION)
+    col = np.round((np.asarray(lon,dtype=np.float64) - GRID_WEST)/RESOLUTION)
+    isValid = (row >= 0) & (row < N_ROWS) & (col >= 0) & (col < N_COLS)
+    cellIds = np.where(isValid,row*N_COLS + col,-1)
+    return(cellIds.astype(np.int32))
+
+# get the coordinates of the grid point at the center of each cell
+# INPUTS:
+#    cellIds (array-like) - cell ids created by getCellIds
+# OUTPUTS:
+#    lat, lon (numpy float64 arrays)
+def getCellCenters(cellIds):
+    row, col = np.divmod(np.asarray(cellIds,dtype=np.int64),N_COLS)
+    return(GRID_NORTH - row*RESOLUTION,GRID_WEST + col*RESOLUTION)
+
+# convert cell ids to the labels used in place of birth ids in the wind pipeline
+# INPUTS:
+#    cellIds (array-like) - cell ids created by getCellIds
+# OUTPUTS:
+#    list of str
+def getCellLabels(cellIds):
+    width = len(str(N_ROWS*N_COLS))
+    return([CELL_PREFIX + str(cellId).zfill(width) for cellId in np.asarray(cellIds)])
+
+
+
+################ Cell maps ##############
+
+# map each maternal residence to its ERA5 cell
+# INPUTS:
+#    birthData (pandas dataframe) - maternal residences with id and coordinate columns
+#    idCol (str) - unique birth id column
+#    latCol (str) - latitude column
+#    lonCol (str) - longitude column
+# OUTPUTS:
+#    cellMap (pandas dataframe) - uniqueid and cellId (cell label) for births inside the ERA5 grid
+def createCellMap(birthData,idCol='uniqueid',latCol='b_lat',lonCol='b_long'):
+    cellIds = getCellIds(birthData[latCol],birthData[lonCol])
+    isValid = cellIds >= 0
+    if not isValid.all():
+        print("warning: %i residences are outside the ERA5 grid" %(int((~isValid).sum())))
+    cellMap = ps.DataFrame({
+        'uniqueid':birthData[idCol].values[isValid],
+        CELL_ID_COL:getCellLabels(cellIds[isValid])
+    })
+    return(cellMap)
+
+# get the unique occupied cells in a cell map, with the coordinates of their grid points
+# INPUTS:
+#    cellMap (pandas dataframe) - created by createCellMap
+# OUTPUTS:
+#    cells (pandas dataframe) - cellId (label), lat, and lon, sorted by label
+def getOccupiedCells(cellMap):
+    labels = np.sort(cellMap[CELL_ID_COL].unique())
+    lat, lon = getCellCenters([int(label[len(CELL_PREFIX):]) for label in labels])
+    return(ps.DataFrame({CELL_ID_COL:labels,'lat':lat,'lon':lon}))
+
+# get the filepath to the cell map for a birth year
+# INPUTS:
+#    windFolder (str) - parent wind folder
+#    year (int) - birth year
+# OUTPUTS:
+#    filepath (str)
+def getCellMapFile(windFolder,year):
+    return(windFolder + "cellMaps/cellMap_" + str(year) + ".csv")
+
+# save a cell map for a birth year
+# INPUTS:
+#    cellMap (pandas dataframe) - created by createCellMap
+#    windFolder (str) - parent wind folder
+#    year (int) - birth year
+def saveCellMap(cellMap,windFolder,year):
+    filepath = getCellMapFile(windFolder,year)
+    if not(os.path.exists(os.path.dirname(filepath))):
+        os.makedirs(os.path.dirname(filepath))
+    cellMap.to_csv(filepath,index=False)
+
+# load the cell map for a birth year
+# INPUTS:
+#    windFolder (str) - parent wind folder
+#    year (int) - birth year
+# OUTPUTS:
+#    cellMap (pandas dataframe), None if the year was processed per birth rather than per cell
+def loadCellMap(windFolder,year):
+    filepath = getCellMapFile(windFolder,year)
+    if not(os.path.exists(filepath)):
+        return(None)
+    return(ps.read_csv(filepath,dtype={CELL_ID_COL:str}))
+
+# add the cell label of each maternal residence to a birth dataframe.  Births outside the grid are dropped
+# INPUTS:
+#    birthData (pandas dataframe) - maternal residence and birth info
+#    cellMap (pandas dataframe) - created by createCellMap
+# OUTPUTS:
+#    pandas dataframe with an additional cellId column
+def attachCells(birthData,cellMap):
+    cellLookup = ps.Series(cellMap[CELL_ID_COL].values,index=cellMap['uniqueid'].astype(str))
+    cellLookup = cellLookup[~cellLookup.index.duplicated()]
+    cells = cellLookup.reindex(birthData['uniqueid'].astype(str)).values
+    birthData = birthData.assign(**{CELL_ID_COL:cells})
+    return(birthData[birthData[CELL_ID_COL].notna()])
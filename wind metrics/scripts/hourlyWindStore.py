@@ -0,0 +1,201 @@
+############### hourlyWindStore.py #############
+# Developed for HEI Transit Study
+# Summary: alternative to daily wind matrix partitions that stores only raw hourly wind directions
+#          (24 int16 values per residence-day, calendar-true days) and builds wind roses on demand.
+#          Each partition is ~8x smaller than a compact .wrt partition and ~60x smaller than a float64
+#          .npy partition, and the downwind angular window can be changed without regenerating partitions
+# Steps to build a wind rose include :
+# 1) gathering hourly wind directions for the requested [start, end] days
+# 2) dropping days with a missing hour (these are 0 hours downwind in the daily wind matrix)
+# 3) binning the remaining hours into one 361 bin histogram per query with a single bincount
+# 4) converting histograms to hours downwind with a circular window sum (windBackends.histogramToDownwind)
+# Because the window sum is linear, the rose of a multi-day histogram equals the sum of the daily
+# roses, so results match residentialWindParallel.processAnnualVals exactly
+# Roses can also be restricted to hours of the day (e.g. daytime only) with an hour mask created by
+# windBackends.localHourMask, matching the kernels evaluated by windBackends.calcWindMatrixMulti
+
+
+############### Setup: import libraries and define constants ##############
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as ps
+import windBackends
+import windowIndex
+
+STORE_PREFIX = "hourly_" # hourly_<n>.npy and hourly_<n>.json are stored with the other partitions
+ROSE_CACHE_SIZE = 4096 # recently built wind roses kept in memory per open store
+QUERY_CHUNK = 1024 # queries binned at a time, bounds memory used by the gathered hourly values
+
+
+
+################ Writer ##############
+
+# convert one batch of long-format hourly records to a hourly matrix over calendar days
+# INPUTS:
+#    batch (dict) - batch created by windPartitioner.getBatch
+#    year (int) - birth year
+# OUTPUTS:
+#    hourly (numpy array) - int16 wind directions organized by (id, calendar day, hour), -999 for missing
+def createHourlyMatrix(batch,year):
+    hourly = windBackends.rearrangeDataNumpy(batch['idIndex'],batch['hour'],batch['day'],batch['month'],
+        batch['wnd_dir'],len(batch['ids'])) # (hour, day, month, id)
+    monthIndex, dayIndex = windowIndex.getMatrixIndexes(year)
+    return(np.ascontiguousarray(hourly[:,dayIndex,monthIndex,:].transpose(2,1,0)))
+
+# save hourly wind directions for one partition.  The json sidecar is written last, so a partition
+# is complete once its sidecar exists
+# INPUTS:
+#    hourly (numpy array) - created by createHourlyMatrix
+#    ids (list) - unique ids, sorted in the same order as hourly
+#    year (int) - birth year
+#    partitionFolder (str) - folder containing the partitions
+#    index (int) - partition index
+def writeHourlyStore(hourly,ids,year,partitionFolder,index):
+    if hourly.size > 0 and hourly.max() > windBackends.N_ANGLES:
+        raise ValueError("wind directions must be in [0,360] to build wind roses from hourly values")
+    prefix = os.path.join(partitionFolder,STORE_PREFIX + str(index))
+    with open(prefix + ".npy.tmp",'wb') as f:
+        np.save(f,hourly.astype(np.int16))
+    os.replace(prefix + ".npy.tmp",prefix + ".npy")
+    sidecar = {
+        'year':int(year),
+        'origin':str(windowIndex.getCalendarDays(year)[0]),
+        'nDays':int(hourly.shape[1]),
+        'ids':[str(curId) for curId in ids]
+    }
+    with open(prefix + ".json",'w') as f:
+        json.dump(sidecar,f)
+
+# get the filepath whose existence marks a complete partition
+# INPUTS:
+#    partitionFolder (str) - folder containing the partitions
+#    index (int) - partition index
+# OUTPUTS:
+#    filepath (str)
+def getSidecarFile(partitionFolder,index):
+    return(os.path.join(partitionFolder,STORE_PREFIX + str(index) + ".json"))
+
+
+
+################ Readers ##############
+
+# open all hourly partitions for a birth year.  Hourly values are memory mapped
+# INPUTS:
+#    partitionFolder (str) - folder containing the hourly_<n> files
+# OUTPUTS:
+#    store (dict) - memory mapped hourly values, origin date, id lookup, and rose cache
+def openHourlyStore(partitionFolder):
+    hourlyList, idList, partitionList, rowList = [], [], [], []
+    origin, nDays = None, None
+    index = 0
+    while os.path.exists(getSidecarFile(partitionFolder,index)):
+        with open(getSidecarFile(partitionFolder,index)) as f:
+            sidecar = json.load(f)
+        origin, nDays = np.datetime64(sidecar['origin'],'D'), sidecar['nDays']
+        hourlyList.append(np.load(os.path.join(partitionFolder,STORE_PREFIX + str(index) + ".npy"),mmap_mode='r'))
+        idList += sidecar['ids']
+        partitionList.append(np.full(len(sidecar['ids']),index,np.int32))
+        rowList.append(np.arange(len(sidecar['ids']),dtype=np.int64))
+        index += 1
+    if index == 0:
+        raise FileNotFoundError("no hourly wind partitions found in %s" %(partitionFolder))
+    store = {
+        'hourly':hourlyList,
+        'origin':origin,
+        'nDays':nDays,
+        'ids':ps.Index(idList),
+        'partition':np.concatenate(partitionList),
+        'row':np.concatenate(rowList),
+        'roseCache':OrderedDict()
+    }
+    return(store)
+
+# build wind roses for queries within a single partition
+# INPUTS:
+#    hourlyData (numpy array) - hourly values for the partition (id, calendar day, hour)
+#    rows (numpy array) - row of each query's residence in the partition
+#    starts (numpy array) - first day offset of each window
+#    ends (numpy array) - day offset after the last day of each window
+#    halfWindow (int) - largest angular difference that is downwind (see windBackends.getHalfWindow)
+#    hourMask (numpy array) - optional, True for hours that are counted.  Other hours are ignored
+# OUTPUTS:
+#    roses (numpy array) - int32 hours downwind organized by (query, angle)
+def buildRoses(hourlyData,rows,starts,ends,halfWindow,hourMask=None):
+    lengths = ends - starts
+    queryIndex = np.repeat(np.arange(len(rows)),lengths)
+    dayOffsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths,lengths) + np.repeat(starts,lengths)
+    hourly = np.asarray(hourlyData[np.repeat(rows,lengths),dayOffsets]) # (query day, hour)
+    if hourMask is not None:
+        hourly = hourly[:,np.asarray(hourMask,bool)]
+
+    # a missing hour sets the daily count negative, which is treated as 0 hours downwind
+    isValidDay = (hourly >= 0).all(axis=1)
+    binIndex = queryIndex[isValidDay,np.newaxis]*(windBackends.N_ANGLES+1) + hourly[isValidDay]
+    hist = np.bincount(binIndex.ravel(),minlength=len(rows)*(windBackends.N_ANGLES+1))
+    return(windBackends.histogramToDownwind(hist.reshape(len(rows),-1),halfWindow,np.int32))
+
+# get wind roses for arrays of unique ids and inclusive [start, end] date windows
+# INPUTS:
+#    store (dict) - opened with openHourlyStore
+#    ids (array-like) - unique ids
+#    starts (array-like) - first day of each window
+#    ends (array-like) - last day of each window (inclusive)
+#    maxDiff (float) - angular window in degrees (see windBackends.getHalfWindow)
+#    hourMask (array-like) - optional, 24 booleans marking the hours that are counted
+# OUTPUTS:
+#    roses (numpy array) - int32 hours downwind organized by (query, angle)
+def getWindowRoses(store,ids,starts,ends,maxDiff=windBackends.DOWNWIND_WINDOW,hourMask=None):
+    halfWindow = windBackends.getHalfWindow(maxDiff)
+    if hourMask is not None:
+        hourMask = np.asarray(hourMask,bool)
+    maskKey = None if hourMask is None else hourMask.tobytes()
+    ids = np.asarray(ids).astype(str)
+    lookup = store['ids'].get_indexer(ps.Index(ids))
+    if (lookup < 0).any():
+        raise KeyError("ids not found in hourly wind store: %s" %(str(list(ids[lookup < 0][:5]))))
+    startOffsets = windowIndex.toDayOffsets(starts,store['origin'])
+    endOffsets = windowIndex.toDayOffsets(ends,store['origin']) + 1
+    if (startOffsets < 0).any() or (endOffsets > store['nDays']).any() or (endOffsets < startOffsets).any():
+        raise ValueError("date windows must fall within the %i days covered by the store" %(store['nDays']))
+    roses = np.zeros((len(ids),windBackends.N_ANGLES),np.int32)
+
+    # reuse recently built roses
+    cache = store['roseCache']
+    keys = list(zip(ids,startOffsets.tolist(),endOffsets.tolist(),[halfWindow]*len(ids),[maskKey]*len(ids)))
+    toBuild = []
+    for queryIndex, key in enumerate(keys):
+        if key in cache:
+            cache.move_to_end(key)
+            roses[queryIndex] = cache[key]
+        else:
+            toBuild.append(queryIndex)
+    toBuild = np.array(toBuild,dtype=np.int64)
+
+    partitions, rows = store['partition'][lookup], store['row'][lookup]
+    for partition in np.unique(partitions[toBuild]):
+        current = toBuild[partitions[toBuild] == partition]
+        for chunkStart in range(0,len(current),QUERY_CHUNK):
+            chunk = current[chunkStart:chunkStart+QUERY_CHUNK]
+            roses[chunk] = buildRoses(store['hourly'][partition],rows[chunk],startOffsets[chunk],endOffsets[chunk],halfWindow,hourMask)
+
+    for queryIndex in toBuild:
+        cache[keys[queryIndex]] = roses[queryIndex].copy()
+        if len(cache) > ROSE_CACHE_SIZE:
+            cache.popitem(last=False)
+    return(roses)
+
+# get wind roses for pregnancy periods, from the conception date up to, but not including, the birth date
+# INPUTS:
+#    store (dict) - opened with openHourlyStore
+#    ids (array-like) - unique ids
+#    cdates (array-like) - conception dates
+#    bdates (array-like) - birth dates
+#    maxDiff (float) - angular window in degrees
+#    hourMask (array-like) - optional, 24 booleans marking the hours that are counted
+# OUTPUTS:
+#    roses (numpy array) - int32 hours downwind organized by (birth, angle)
+def getPregnancyRoses(store,ids,cdates,bdates,maxDiff=windBackends.DOWNWIND_WINDOW,hourMask=None):
+    lastDays = ps.to_datetime(np.asarray(bdates)) - ps.Timedelta(days=1)
+    return(getWindowRoses(store,ids,cdates,lastDays,maxDiff,hourMask))
@@ -0,0 +1,111 @@
+############### ioPipeline.py #############
+# Developed for HEI Transit Study
+# Summary: overlap storage reads and writes with computation when processing wind partitions.
+#          A background reader prefetches the next partition while the current one is processed, and a
+#          write-behind thread saves finished results.  Both queues are bounded, so a slow disk blocks
+#          the producer (backpressure) rather than letting finished or prefetched partitions pile up in RAM
+# Steps include:
+# 1) prefetch - generator that yields (item, loaded data) in order, loading up to PREFETCH_DEPTH items ahead
+# 2) startWriter/submitWrite/closeWriter - run save functions in submission order on a background thread
+# Errors raised in background threads are re-raised in the main thread
+
+
+############### Setup: import libraries and define constants ##############
+import queue
+import threading
+
+PREFETCH_DEPTH = 1 # loaded partitions waiting to be processed, in addition to the one being loaded
+WRITE_DEPTH = 1 # finished partitions waiting to be written, in addition to the one being written
+STOP = object() # sentinel marking the end of a queue
+
+
+
+################ Prefetching reader ##############
+
+# iterate over items, loading each item on a background thread while the previous one is processed
+# INPUTS:
+#    loadFunction (function) - called with one item, returns the loaded data
+#    items (list) - items to load, in processing order
+#    depth (int) - maximum number of loaded items waiting to be processed
+# OUTPUTS:
+#    generator of (item, loaded data) tuples
+def prefetch(loadFunction,items,depth=PREFETCH_DEPTH):
+    loaded = queue.Queue(maxsize=max(depth,1))
+    isCancelled = threading.Event()
+
+    def readItems():
+        try:
+            for item in items:
+                if isCancelled.is_set():
+                    return
+                loaded.put((item,loadFunction(item)))
+        except BaseException as e:
+            loaded.put((STOP,e))
+            return
+        loaded.put((STOP,None))
+
+    reader = threading.Thread(target=readItems,daemon=True)
+    reader.start()
+    try:
+        while True:
+            item, data = loaded.get()
+            if item is STOP:
+                if data is not None:
+                    raise data
+                break
+            yield((item,data))
+    finally:
+        # unblock the reader if the consumer stops early
+        isCancelled.set()
+        while reader.is_alive():
+            try:
+                loaded.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+
+################ Write-behind writer ##############
+
+# start a background thread that runs save functions in submission order
+# INPUTS:
+#    depth (int) - maximum number of submitted writes waiting to start
+# OUTPUTS:
+#    writer (dict) - queue, thread, and the first error raised while writing
+def startWriter(depth=WRITE_DEPTH):
+    writer = {'queue':queue.Queue(maxsize=max(depth,1)),'error':None}
+
+    def writeItems():
+        while True:
+            task = writer['queue'].get()
+            if task is STOP:
+                return
+            if writer['error'] is None:
+                saveFunction, args = task
+                try:
+                    saveFunction(*args)
+                except BaseException as e:
+                    writer['error'] = e
+
+    writer['thread'] = threading.Thread(target=writeItems,daemon=True)
+    writer['thread'].start()
+    return(writer)
+
+# queue a save function.  Blocks while the queue is full
+# INPUTS:
+#    writer (dict) - created by startWriter
+#    saveFunction (function) - function that persists one result
+#    args (list) - arguments passed to saveFunction
+def submitWrite(writer,saveFunction,*args):
+    if writer['error'] is not None:
+        raise writer['error']
+    writer['queue'].put((saveFunction,args))
+
+# wait for all queued writes to finish and stop the writer thread
+# INPUTS:
+#    writer (dict) - created by startWriter
+def closeWriter(writer):
+    writer['queue'].put(STOP)
+    writer['thread'].join()
+    if writer['error'] is not None:
+        raise writer['error']
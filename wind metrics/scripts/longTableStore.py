@@ -0,0 +1,129 @@
+############### longTableStore.py #############
+# Developed for HEI Transit Study
+# Summary: columnar storage for long-format hourly wind records (one row per residence-hour), replacing
+#          the comb_<year>.csv files read by createWindMatrix.py
+# Layout: comb_<year>/year=<Y>/month=<M>/part-0.parquet, a parquet dataset partitioned by year and month.
+# Columns are typed (int16 direction, uint8 day and hour, dictionary encoded master_id), and readers
+# can filter on master_id so only matching records are decoded
+# Steps to write a dataset include:
+# 1) melting each daily extraction csv (one column per hour) to long format with np.repeat/np.tile
+# 2) appending the records to the writer for their month
+# 3) moving the completed dataset into place, so partially written datasets are never read
+
+
+############### Setup: import libraries and define constants ##############
+import os
+import shutil
+import numpy as np
+import pandas as ps
+
+N_HOURS = 24
+PART_FILENAME = "part-0.parquet"
+COLUMNS = ['year','month','day','hour','wnd_dir','master_id']
+CHUNK_ROWS = 5000000 # records per batch when reading
+
+# pyarrow is only required when datasets are written or read
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+
+
+################ Helper functions ##############
+
+# get the dataset folder for a birth year
+# INPUTS:
+#    windFolder (str) - parent wind folder
+#    year (int) - birth year
+# OUTPUTS:
+#    folder (str)
+def getDatasetFolder(windFolder,year):
+    return(os.path.join(windFolder,"comb_" + str(year)))
+
+# melt one day of hourly values from wide format (one column per hour) to long format
+# INPUTS:
+#    hourlyVals (numpy array) - wind directions organized by (residence, hour), hour 0 is the first column
+#    ids (array-like) - unique id of each residence
+#    year, month, day (int) - date of the hourly values
+# OUTPUTS:
+#    pyarrow table with the columns in COLUMNS
+def meltDay(hourlyVals,ids,year,month,day):
+    hourlyVals = np.asarray(hourlyVals)
+    nResidences, nHours = hourlyVals.shape
+    idCodes = ps.Categorical(np.asarray(ids).astype(str))
+    nRecords = nResidences*nHours
+    table = pa.table({
+        'year':np.full(nRecords,year,np.int16),
+        'month':np.full(nRecords,month,np.uint8),
+        'day':np.full(nRecords,day,np.uint8),
+        'hour':np.repeat(np.arange(nHours,dtype=np.uint8),nResidences),
+        'wnd_dir':hourlyVals.T.ravel().astype(np.int16),
+        'master_id':pa.DictionaryArray.from_arrays(
+            np.tile(idCodes.codes.astype(np.int32),nHours),pa.array(idCodes.categories.astype(str),pa.string()))
+    })
+    return(table)
+
+
+
+################ Writer ##############
+
+# start writing a dataset.  Records are written to a temporary folder until closeWriter is called
+# INPUTS:
+#    datasetFolder (str) - final location of the dataset
+# OUTPUTS:
+#    writer (dict) - temporary folder and one parquet writer per (year, month)
+def startWriter(datasetFolder):
+    tempFolder = datasetFolder + ".tmp"
+    if os.path.exists(tempFolder):
+        shutil.rmtree(tempFolder)
+    os.makedirs(tempFolder)
+    return({'folder':datasetFolder,'tempFolder':tempFolder,'writers':{},'nRecords':0})
+
+# append records to a dataset.  Records are split by year and month
+# INPUTS:
+#    writer (dict) - created by startWriter
+#    table (pyarrow table) - records with the columns in COLUMNS
+def appendRecords(writer,table):
+    yearMonth = table['year'].to_numpy().astype(np.int32)*100 + table['month'].to_numpy()
+    for key in np.unique(yearMonth):
+        subset = table.filter(pa.array(yearMonth == key))
+        if key not in writer['writers']:
+            partFolder = os.path.join(writer['tempFolder'],"year=" + str(key//100),"month=" + str(key%100))
+            os.makedirs(partFolder)
+            writer['writers'][key] = pq.ParquetWriter(os.path.join(partFolder,PART_FILENAME),
+                subset.drop(['year','month']).schema)
+        writer['writers'][key].write_table(subset.drop(['year','month']))
+    writer['nRecords'] += table.num_rows
+
+# finish writing a dataset and move it into place
+# INPUTS:
+#    writer (dict) - created by startWriter
+def closeWriter(writer):
+    for partWriter in writer['writers'].values():
+        partWriter.close()
+    if os.path.exists(writer['folder']):
+        shutil.rmtree(writer['folder'])
+    os.replace(writer['tempFolder'],writer['folder'])
+    print("saved %i records to %s" %(writer['nRecords'],writer['folder']))
+
+
+
+################ Reader ##############
+
+# iterate over records in a dataset, optionally for a subset of unique ids
+# INPUTS:
+#    datasetFolder (str) - dataset folder
+#    ids (list) - optional unique ids.  Only records for these ids are read
+#    chunkRows (int) - records per chunk
+# OUTPUTS:
+#    generator of pandas dataframes containing the columns in COLUMNS
+def iterRecords(datasetFolder,ids=None,chunkRows=CHUNK_ROWS):
+    dataset = ds.dataset(datasetFolder,format='parquet',partitioning='hive')
+    recordFilter = None if ids is None else ds.field('master_id').isin([str(curId) for curId in ids])
+    for batch in dataset.to_batches(columns=COLUMNS,filter=recordFilter,batch_size=chunkRows):
+        if batch.num_rows > 0:
+            yield(batch.to_pandas())
@@ -3,31 +3,52 @@
 # Developed for HEI Transit Study
 # Summary: given hourly wind rasters and annual birth residences, extract hourly
 #          values for two years and combine them to into a single csv
+# ERA5 wind direction is constant within each 0.25 degree cell, so by default values are extracted
+# once per occupied cell rather than once per birth (see eraGrid.py).  The master_id column then
+# holds cell labels, and the birth -> cell map is saved to cellMaps/cellMap_<year>.csv
+# When wind direction cubes exist (see windCube.py), all hours are gathered for all residences with
+# array indexing instead (see cubeExtractor.py) and saved directly as hourly wind partitions
 
 
 # Steps include:
 # 1) extracting values to points
 # 2) extracting date and hour from filename
-# 3) combining results to create a single comprehensive csv
+# 3) combining results into a single columnar dataset, partitioned by month (see longTableStore.py)
 
 ############### Setup: import libraries and define constants ##############
 
-import arcpy
 import pandas as ps
 import numpy as np
 import os
 import gConst as const
-arcpy.env.overwriteOutput = True
+import eraGrid
+import cubeExtractor
+import longTableStore
 from multiprocessing import Pool
 
 YEARS = list(range(2007,2017))
 PARENT_FOLDER = const.WIND_FOLDER
 BIRTH_FOLDER = PARENT_FOLDER + "Birth_Addresses_Wind/births_by_year/"
 WIND_DIRECTION_FOLDER = PARENT_FOLDER + "wind_surfaces/wind_direction/"
+DEDUPLICATE_CELLS = True # extract one set of hourly values per ERA5 cell instead of per birth
+WIND_CUBE_FOLDER = PARENT_FOLDER + "wind_surfaces/wind_cubes/"
+USE_CUBES = True # gather hourly values from wind direction cubes rather than extracting raster values to points
+arcpy = None # only needed for point extraction, imported by loadArcpy
 
 
 ################ helper functions ################
 
+# import arcpy once per process
+# OUTPUTS:
+#    arcpy module
+def loadArcpy():
+    global arcpy
+    if arcpy is None:
+        import arcpy as arcpyModule
+        arcpyModule.env.overwriteOutput = True
+        arcpy = arcpyModule
+    return(arcpy)
+
 # check if 24 rasters are available for one day.  If so, return
 # array with filepaths to the rasters
 # INPUTS:
@@ -69,15 +90,37 @@ def arcgis_table_to_df(in_fc):
     fc_dataframe = fc_dataframe[valsList]
     return fc_dataframe
 
+# map all births within a single year to ERA5 cells, save the cell map, and create a point feature
+# class with one point per occupied cell, located at the cell's grid point
+# INPUTS:
+#    year (int) - year of births
+#    cellFeatures (str) - name of the point feature class to create in the memory workspace
+def createCellPoints(year,cellFeatures):
+    birthData = ps.read_csv(BIRTH_FOLDER + "csvs/births_" + str(year) + ".csv")
+    cellMap = eraGrid.createCellMap(birthData)
+    eraGrid.saveCellMap(cellMap,PARENT_FOLDER,year)
+    cells = eraGrid.getOccupiedCells(cellMap)
+    print("%i births in %i ERA5 cells for %i" %(len(cellMap),len(cells),year))
+    arcpy.CreateFeatureclass_management("memory",cellFeatures,"POINT",spatial_reference=arcpy.SpatialReference(4326))
+    arcpy.management.AddField("memory/" + cellFeatures,"uniqueid","TEXT")
+    with arcpy.da.InsertCursor("memory/" + cellFeatures,['SHAPE@XY','uniqueid']) as cursor:
+        for label, lat, lon in zip(cells[eraGrid.CELL_ID_COL],cells['lat'],cells['lon']):
+            cursor.insertRow([(lon,lat),label])
+
 # for all births within a single year, extract 2 years of hourly wind directions
 # INPUTS:
 #    year (int) - year of births
 def extractPointVals(year):
+    loadArcpy()
     birthShapefile = BIRTH_FOLDER + "births_" + str(year) + ".shp"
     masterBirthFile = "memory/births_" + str(year)
 
-    # create a temp copy of the birth shapefile to prevent accidentally altering the original
-    arcpy.CopyFeatures_management(birthShapefile, masterBirthFile)
+    # sample each occupied ERA5 cell once, or create a temp copy of the birth shapefile to prevent
+    # accidentally altering the original
+    if DEDUPLICATE_CELLS:
+        createCellPoints(year,"births_" + str(year))
+    else:
+        arcpy.CopyFeatures_management(birthShapefile, masterBirthFile)
     outputFolder = const.WIND_FOLDER + str(year)
     if not(os.path.exists(outputFolder)):
         os.mkdir(outputFolder)
@@ -106,6 +149,16 @@ def extractPointVals(year):
                             print("couldn't extract value to points for file %s: %s" %(windDayPrefix,str(e)))
 
 
+# for all births within a single year, gather 2 years of hourly wind directions from wind direction
+# cubes and save them as hourly wind partitions.  Also saves the comb_<year> long-format dataset
+# INPUTS:
+#    year (int) - year of births
+def extractCubeVals(year):
+    birthData = ps.read_csv(BIRTH_FOLDER + "csvs/births_" + str(year) + ".csv")
+    cubeExtractor.extractYear(birthData,year,WIND_CUBE_FOLDER,PARENT_FOLDER,DEDUPLICATE_CELLS)
+    cubeExtractor.writeLongTable(year,PARENT_FOLDER)
+
+
 # given a filename with the date in it, extract the month and day
 # INPUTS:
 #    filename (str) - can be absolute or relative filepath
@@ -120,64 +173,37 @@ def getMonthDayFromFilename(filename):
     day = filename[dayStart+1:][:dayEnd]
     return([month,day])         
 
-# given a csv of measurements, denormalize the variables and store in dataframe format
+# given a csv of measurements, denormalize the variables into typed columns
 # INPUTS:
 #    folder (str) - absolute filepath to the folder containing the csv
-#    csv (str) - relative filepath to the csv file
-#    curYear (int) - year of birth
+#    csv (str) - relative filepath to the csv file, named <year>_<month>_<day>.csv
 # OUTPUTS:
-#    pandas dataframe containing denormalized records
-def transformCSVtoDF(folder,csv,curYear):
-    df = ps.read_csv(folder + "/" + csv)
-    curMonth,curDay =getMonthDayFromFilename(csv)
-    hour,day,month,year,wnd_dir,master_id = [[] for x in range(6)]
-
-    # denormalize dataset
-    for curHour in range(1,25):
-        tempVals = list(df[str(curHour).zfill(2)])
-        nVals = len(tempVals)
-        wnd_dir += tempVals
-        hour += [curHour-1 for x in range(nVals)]
-        month += [curMonth for x in range(nVals)]
-        day += [curDay for x in range(nVals)]
-        year += [curYear for x in range(nVals)]
-        master_id += list(df['uniqueid'])
-    df = ps.DataFrame({
-        'year':year,
-        'month':month,
-        'day':day,
-        'hour':hour,
-        'wnd_dir':wnd_dir,
-        'master_id':master_id    
-    })
-    return(df)
-
-# given a single csv for each day, combine all records for a year of births into a single 
-# comprehensive csv
+#    pyarrow table containing denormalized records (see longTableStore.py)
+def transformCSVtoTable(folder,csv):
+    df = ps.read_csv(folder + "/" + csv,dtype={'uniqueid':str})
+    curMonth,curDay = getMonthDayFromFilename(csv)
+    curYear = int(csv.split("_")[0]) # year of the wind data, which precedes the birth year for half the files
+    hourlyVals = df[[str(curHour).zfill(2) for curHour in range(1,25)]].to_numpy()
+    return(longTableStore.meltDay(hourlyVals,df['uniqueid'],curYear,int(curMonth),int(curDay)))
+
+# given a single csv for each day, stream all records for a year of births into a columnar dataset
+# partitioned by year and month (comb_<year>/, see longTableStore.py)
 # INPUTS:
 #    year (int) - year of birth
 def combineAnnualCSVs(year):
-    outputFile = const.WIND_FOLDER + "/comb_" + str(year) + ".csv"
-    if(os.path.exists(outputFile)):
+    outputFolder = longTableStore.getDatasetFolder(const.WIND_FOLDER,year)
+    if(os.path.exists(outputFolder)):
         return
     inputFolder = const.WIND_FOLDER + str(year)
-    csvsToCombine = os.listdir(inputFolder)
-    pandasData = transformCSVtoDF(inputFolder,csvsToCombine[0],year)
-    index = 1
-    allPandas = []
+    csvsToCombine = [csv for csv in os.listdir(inputFolder) if csv.endswith(".csv")]
+    writer = longTableStore.startWriter(outputFolder)
 
-    # for each daily csv file of wind direction estimates, add to the dataframe
-    for file in csvsToCombine[1:]:
+    # for each daily csv file of wind direction estimates, append to the dataset
+    for index, file in enumerate(csvsToCombine):
+        longTableStore.appendRecords(writer,transformCSVtoTable(inputFolder,file))
         if(index%30==0):
-            allPandas.append(pandasData)
-            pandasData = transformCSVtoDF(inputFolder,csvsToCombine[0],year)
-        else:
-            pandasData = ps.concat([pandasData,transformCSVtoDF(inputFolder,file,year)])
-        print(index)
-        index+=1
-    for tempData in allPandas:
-        pandasData = ps.concat([pandasData,tempData])
-    pandasData.to_csv(outputFile,index=False)
+            print(index)
+    longTableStore.closeWriter(writer)
             
 
 
@@ -187,8 +213,12 @@ def combineAnnualCSVs(year):
 
 
 if __name__ == '__main__':
-    with Pool(processes=len(YEARS)) as pool:
-        res = pool.map(extractPointVals,YEARS)
+    if USE_CUBES:
+        for year in YEARS:
+            extractCubeVals(year)
+    else:
+        with Pool(processes=len(YEARS)) as pool:
+            res = pool.map(extractPointVals,YEARS)
     
-    for year in list(range(2007,2018)):
-        combineAnnualCSVs(year)
+        for year in list(range(2007,2018)):
+            combineAnnualCSVs(year)
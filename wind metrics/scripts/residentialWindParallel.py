@@ -3,112 +3,73 @@
 # Developed for HEI Transit Study
 # Summary: create rose-wind shapefiles (1 degree radial resolution) for each maternal address
 # Steps to create rose wind shapefiles include :
-# 1) load 2 years of daily wind directions from storage
+# 1) load 2 years of daily wind directions from storage.  Pool workers memory map each partition and
+#    receive only row indices, so wind data is not pickled into every task
 # 2) load maternal residence metadata including coordinates, birth date, and conception date
 # 3) restrict daily wind directions to [conception date, birth date]
 # 4) sum daily wind directions for pregnancy period 
-# 5) create road wind shapefiles in ArcGIS
+# 5) create road wind triangles for all residences in a partition at once and save them to a per-year
+#    GeoParquet dataset (see roseGeometry.py), or create one shapefile per residence in ArcGIS
 
 
 ############### Setup: import libraries and define constants ##############
-sucessfulImport = False
 import time
-
-# needed when using the ArcGIS license for a large # of parallel threads
-while(sucessfulImport == False):
-    try:
-        import arcpy
-        from arcpy.ia import * 
-        from arcpy import env
-        from arcpy.sa import *
-        arcpy.env.overwriteOutput = True
-        sucessfulImport = True
-    except Exception as e:
-        print("couldn't import arcgis: %s" %(str(e)))
-        time.sleep(1)
-
 import numpy as np
-import math
 import pandas as ps
 import os
 import datetime
 import gConst as const
+import windRoseStore
+import windowIndex
+import eraGrid
+import hourlyWindStore
+import ioPipeline
+import roadSectors
+import roseGeometry
+from functools import partial
 from multiprocessing import Pool
-arcpy.env.overwriteOutput = True
 
 YEAR = 2016
 PARENT_FOLDER = const.WIND_FOLDER
 masterIdFolder = PARENT_FOLDER + "/masterIds/" + str(YEAR) + '/'
-windPartitions = PARENT_FOLDER + "/windPartitions/" + str(YEAR) + "/"
-BIRTH_DATA = ps.read_csv(PARENT_FOLDER + "Birth_Addresses_Wind/births_by_year/csvs/births_" + str(YEAR) + ".csv")
+KERNEL_NAME = None # downwind kernel to read (see createWindMarix.py --kernel), None for partitions created without kernels
+windPartitions = PARENT_FOLDER + "/windPartitions/" + str(YEAR) + "/" + ("" if KERNEL_NAME is None else KERNEL_NAME + "/")
+BIRTH_FILE = PARENT_FOLDER + "Birth_Addresses_Wind/births_by_year/csvs/births_" + str(YEAR) + ".csv"
 OUTPUT_SHAPEOLDER = PARENT_FOLDER + "/outputShapefiles/" + str(YEAR)
-if not (os.path.exists(OUTPUT_SHAPEOLDER)):
-    os.mkdir(OUTPUT_SHAPEOLDER)
+ROAD_SECTOR_FOLDER = PARENT_FOLDER + "/roadSectors/" + str(YEAR) + "/" # see roadSectors.py
+OUTPUT_FORMAT = 'geoparquet' # 'geoparquet' saves all roses for the year to one dataset, 'shapefile' saves one shapefile per residence
+ROSE_FOLDER = roseGeometry.getRoseFolder(PARENT_FOLDER + "/outputRoses/",YEAR)
 
-sr = arcpy.SpatialReference()   # WGS84 spatial reference
-sr.factoryCode = 4326
-sr.create()
-
-
-# the following components are used for the Haversine formula.  For more details go to
-# http://www.movable-type.co.uk/scripts/latlong.html
-# https://www.eol.ucar.edu/content/wind-direction-quick-reference
-EARTH_RADIUS = 6378140.0                # used to calculate wind direction
-distance = 55000.0/EARTH_RADIUS         # used to calculate bearing and wind direction
 N_ANGLES = 360
+ROSE_WINDOW = 15 # degrees on either side of the wind direction counted as downwind.  Only used with hourly partitions
+workerPartitions = {} # daily wind matrix partitions memory mapped by each pool worker, keyed by filepath
 
+# arcpy and the WGS84 spatial reference are only needed to create shapefiles.  They are created on first use
+# in each process (see loadArcpy), so importing this module and starting pool workers stays fast
+arcpy = None
+sr = None
 
 
-######################### HELPER FUNCTIONS #######################
 
+######################### HELPER FUNCTIONS #######################
 
-# calculate latitude and longitude coordinates on the outside of the buffer region
-# INPUTS:
-#   origLat (float) - latitude coordinate
-#   origLong (float) - longitude coordinate
-#   bearing (float) - angular direction relative to true north
-#   distance (float) - distance that new coordinates should be from the center
+# import arcpy and create the WGS84 spatial reference once per process.  Import is retried, which is
+# needed when using the ArcGIS license for a large # of parallel threads
 # OUTPUTS:
-#   newLatit (float) - latitude coordinate of outer buffer edge
-#   newLongit (float) - longitude coordinate of outer buffer edge
-def calcCoords(origLat,origLong,bearing,distance):    
-    latRadians = origLat*0.0174533          # convert latitude from degrees to radians
-    longRadians = origLong*0.0174533        # convert longitude from degrees to radians
-    
-    # calculate the new latitude coordinate for a point that is 'distance' units away using the haversine formula (see weblink above)
-    newLatit = math.asin(math.sin(latRadians)*math.cos(distance) + math.cos(latRadians)*math.sin(distance)*math.cos(bearing))/0.0174533
-    
-    # calculate the new longitude coordinate for a point that is 'distance' units away using the haversine formula
-    longitP1 = math.sin(bearing)*math.sin(distance)*math.cos(latRadians)
-    longitP2 = math.cos(distance) - math.sin(latRadians)*math.sin(newLatit*0.0174533)    
-    newLongit = longRadians + math.atan2(longitP1,longitP2)
-    newLongit = newLongit/0.0174533
-    return([newLatit,newLongit])
-
-# create a triangle polygon in arcgis using 3 coordinate points.  The triangle will represent one angular degree of coverage
-# INPUTS:
-#   wndDrt (float) - angular wind direction, with 0 degrees corresponding to true north
-#   strtLat (float) - latitude of the centroid
-#   strtLong (float) - longitude of the centroid
-#   inputFilename (string) - filepath to the shapefile to which the triangle will be added
-#   timestamp (int) - time that corresponds to the wind direction, in epoch format
-def calcTriangle(wndDrt,strtLat, strtLong,distance,inputFilename,colNames,colVals):
-    bearing1 = ((wndDrt + 0.5)%360.0)*0.0174533       # center of triangle + 0.5 degrees
-    bearing2 = ((wndDrt - 0.5)%360.0)*0.0174533       # center of triangle - 0.5 degrees
-    airMonitorLoc = arcpy.Point(strtLong,strtLat)       # defnie the air monitor location as one point of the triangle
-    coordP1 = calcCoords(strtLat,strtLong,bearing1,distance)  # create another coordinate point
-    upPoint1 = arcpy.Point(coordP1[1],coordP1[0])
-    coordP2 = calcCoords(strtLat,strtLong,bearing2,distance)  # create another coordinate point
-    upPoint2 = arcpy.Point(coordP2[1],coordP2[0])
-    # Create a polygon geometry
-    array = arcpy.Array([airMonitorLoc,upPoint1,upPoint2])
-    polygon = arcpy.Polygon(array)
-    # Open an InsertCursor and insert the new geometry
-    cursor = arcpy.da.InsertCursor(inputFilename, ['SHAPE@'] + colNames)
-    rowVals = tuple([polygon] + list([colVals]))
-    cursor.insertRow(rowVals)
-    # Delete cursor object
-    del cursor
+#    arcpy module
+def loadArcpy():
+    global arcpy, sr
+    while arcpy is None:
+        try:
+            import arcpy as arcpyModule
+            arcpyModule.env.overwriteOutput = True
+            sr = arcpyModule.SpatialReference(4326)
+            arcpy = arcpyModule
+        except Exception as e:
+            print("couldn't import arcgis: %s" %(str(e)))
+            time.sleep(1)
+    return(arcpy)
+
 
 # add syntax necessary to create multiple attributes in an ArcGIS attribute table
 # INPUTS:
@@ -132,7 +93,8 @@ def getBirthIndexes(inDate,bYear):
 
 # given data for a single birth, restrict wind values to the pregnancy period and create a wind rose matrix
 # INPUTS:
-#    windData (numpy array) - 2 years of daily wind direction for a single maternal residence
+#    windData (numpy array) - 2 years of daily wind direction for a single maternal residence.  Either
+#                             float64 (.npy partitions) or uint8 codes (.wrt partitions, see windRoseStore.py)
 #    bdate (str) - birth date in Y-m-d format
 #    cdate (str) - conception date in Y-m-d format
 #    year (int) - birth year
@@ -141,65 +103,242 @@ def getBirthIndexes(inDate,bYear):
 def processAnnualVals(windData,bdate,cdate,byear):
     bmonth,bday = getBirthIndexes(bdate,byear)
     cmonth,cday = getBirthIndexes(cdate,byear)
-    startVals = np.sum(np.maximum(windData[cmonth][cday:],0),axis=0)
-    startVals += np.sum(np.maximum(windData[bmonth][:bday],0),axis=0)
+    startVals = np.sum(windRoseStore.getValidHours(windData[cmonth][cday:]),axis=0)
+    startVals += np.sum(windRoseStore.getValidHours(windData[bmonth][:bday]),axis=0)
     for monthData in windData[cmonth+1:bmonth]:
-        startVals += np.sum(np.maximum(monthData,0),axis=0)
+        startVals += np.sum(windRoseStore.getValidHours(monthData),axis=0)
     return(startVals)
 
-# given maternal residence information and a wind rose matrix, create a rose wind shapefile in ArcGIS
+# given maternal residence information and a wind rose matrix, create a rose wind shapefile in ArcGIS.
+# Triangles are calculated with roseGeometry.py and inserted with a single cursor
 # INPUTS:
 #    lat (float) - maternal residence latitude
 #    lon (float) - maternal residence longitude
 #    angleVals (numpy array) - wind rose matrix for pregnancy period
 #    uniqueId (str) - unique identifier for the birth record
-def calcAnnualShapefile(lat,lon,year,angleVals,uniqueId):
-    colNames = ['sum_' + str(year)]
+#    angles (numpy array) - optional road-bearing sectors (see roadSectors.py).  If provided, triangles
+#                           are only created for these sectors and an 'angle' field records the sector
+def calcAnnualShapefile(lat,lon,year,angleVals,uniqueId,angles=None):
+    loadArcpy()
+    colNames = ['sum_' + str(year)] + ([] if angles is None else ['angle'])
     fieldNames = list(map(mapCreateFieldNames,colNames))
     yearShapefile = uniqueId + ".shp"
     arcpy.CreateFeatureclass_management(OUTPUT_SHAPEOLDER,yearShapefile,"POLYGON",'#','#','#',sr)
     arcpy.management.AddFields(OUTPUT_SHAPEOLDER + "/" + yearShapefile,fieldNames)
-    for angle in range(360):
-        calcTriangle(angle+0.5,lat,lon,distance,OUTPUT_SHAPEOLDER + "/" + yearShapefile,colNames,angleVals[angle])
+    triangles = roseGeometry.calcRoseTriangles([lat],[lon])[0]
+    with arcpy.da.InsertCursor(OUTPUT_SHAPEOLDER + "/" + yearShapefile,['SHAPE@'] + colNames) as cursor:
+        for angle in (range(N_ANGLES) if angles is None else angles):
+            polygon = arcpy.Polygon(arcpy.Array([arcpy.Point(*vertex) for vertex in triangles[angle,:3]]),sr)
+            cursor.insertRow(tuple([polygon,angleVals[angle]] + ([] if angles is None else [int(angle)])))
+
+# read 2 years of daily wind direction for one residence from a partition.  Each pool worker memory maps
+# the partition the first time it is needed, so only row indeces are sent to workers.  Pages of the
+# partition are shared by all workers through the OS page cache
+# INPUTS:
+#    partitionFile (str) - filepath to a .npy or .wrt partition
+#    row (int) - row of the residence in the partition
+# OUTPUTS:
+#    numpy array organized by (month, day, angle)
+def readPartitionRow(partitionFile,row):
+    if partitionFile not in workerPartitions:
+        workerPartitions.clear() # partitions are processed one at a time
+        if partitionFile.endswith(windRoseStore.FILE_EXTENSION):
+            workerPartitions[partitionFile] = windRoseStore.openWindRoseTensor(partitionFile)
+        else:
+            workerPartitions[partitionFile] = np.load(partitionFile,mmap_mode='r')
+    partition = workerPartitions[partitionFile]
+    if isinstance(partition,dict):
+        return(windRoseStore.readBirth(partition,row))
+    return(np.asarray(partition[row]))
 
 # given 2 years of daily wind direction and all metadata about the maternal residence and birth date, 
 # perform all steps necessary to create a wind rose shapefile
 # INPUTS:
-#    dataTuple (tuple) - contains wind rose matrix, maternal resdience info, birth date, 
-#                        conception date, and unique identifier
+#    dataTuple (tuple) - contains wind data, maternal resdience info, birth date, conception date, and
+#                        unique identifier.  The first element is either a (partition file, row) reference
+#                        to daily wind data (see prepParallel) or a 360 value wind rose (see
+#                        prepParallelIndexed), which is used as is.  An optional 7th element restricts the
+#                        shapefile to road-bearing sectors (see attachSectors)
 def processSingleResidence(dataTuple):
     outputFile = OUTPUT_SHAPEOLDER + "/" + dataTuple[5] + ".shp"
     if not(os.path.exists(outputFile)):
-        sumWindVals = processAnnualVals(dataTuple[0],dataTuple[1],dataTuple[2],YEAR)
-        calcAnnualShapefile(dataTuple[3],dataTuple[4],YEAR,sumWindVals,dataTuple[5])
+        angles = dataTuple[6] if len(dataTuple) > 6 else None
+        calcAnnualShapefile(dataTuple[3],dataTuple[4],YEAR,getResidenceRose(dataTuple),dataTuple[5],angles)
+
+# get the pregnancy wind rose for one residence
+# INPUTS:
+#    dataTuple (tuple) - see processSingleResidence
+# OUTPUTS:
+#    wind rose numpy array - # of hours maternal residence is downwind of each 1 radial degree (360 total)
+def getResidenceRose(dataTuple):
+    if isinstance(dataTuple[0],tuple):
+        windData = readPartitionRow(*dataTuple[0])
+        return(processAnnualVals(windData,dataTuple[1],dataTuple[2],YEAR))
+    return(dataTuple[0])
 
-# given multiple sources of raw data, repackage the data to facilitate parallel processing 
+# create wind rose triangles for all residences in a partition and save them to the year's GeoParquet
+# dataset.  Partitions that were already saved are skipped
 # INPUTS:
-#    windData (numpy array) = 2 years of daily wind direction for multiple maternal residences
-#    idData (numpy array) - unique identifiers, sorted in the same order as the windData
+#    parallelData (list of tuples) - created by loadPartitionData
+#    index (int) - partition index
+#    pool (multiprocessing Pool) - used to read daily wind matrix partitions
+def saveRosePartition(parallelData,index,pool):
+    if len(parallelData) == 0 or roseGeometry.isPartitionSaved(ROSE_FOLDER,index):
+        return
+    if isinstance(parallelData[0][0],tuple):
+        roses = pool.map(getResidenceRose,parallelData)
+    else:
+        roses = [curTuple[0] for curTuple in parallelData]
+    sectorMask = roseGeometry.getSectorMask([curTuple[6] if len(curTuple) > 6 else None for curTuple in parallelData])
+    table = roseGeometry.createRoseTable([curTuple[5] for curTuple in parallelData],[curTuple[3] for curTuple in parallelData],
+        [curTuple[4] for curTuple in parallelData],np.array(roses),YEAR,sectorMask)
+    roseGeometry.saveRosePartition(table,ROSE_FOLDER,index)
+
+# given multiple sources of raw data, repackage the data to facilitate parallel processing.  Wind data is
+# not copied into the tuples.  Each tuple references the residence's row in the partition, which workers
+# read with readPartitionRow
+# INPUTS:
+#    partitionFile (str) - filepath to a partition with 2 years of daily wind direction for multiple
+#                          maternal residences or ERA5 cells
+#    idData (numpy array) - unique identifiers, sorted in the same order as the partition
 #    personalData (pandas dataframe) - maternal residence and birth info
+#    keyCol (str) - personalData column matching idData.  'cellId' when wind data was computed per ERA5
+#                   cell (see eraGrid.py), in which case every birth in a cell shares the cell's wind data
 # OUTPUTS:
 #    list of tuples - each tuple contains all info needed to create a wind rose for 1 maternal residence
-def prepParallel(windData,idData,personalData):
-    parallelArray = []
-    for i in range(idData.count()[0]):
-        curId = list(idData.iloc[i])
-        curPersonal = personalData[personalData['uniqueid'].isin(curId)]
-        if(int(curPersonal.count()[0])>0):
-            curTuple = (windData[i],list(curPersonal['bdate'])[0],list(curPersonal['cdate'])[0],
-            list(curPersonal['b_lat'])[0],list(curPersonal['b_long'])[0],curId[0])
-            parallelArray.append(curTuple)
-    return(parallelArray)
+def prepParallel(partitionFile,idData,personalData,keyCol='uniqueid'):
+    curPersonal = getPartitionBirths(idData,personalData,keyCol)
+    rowLookup = ps.Series(np.arange(len(idData)),index=idData.iloc[:,0].astype(str))
+    rows = rowLookup[curPersonal[keyCol].astype(str)].values
+    return(list(zip([(partitionFile,int(row)) for row in rows],curPersonal['bdate'],curPersonal['cdate'],
+        curPersonal['b_lat'],curPersonal['b_long'],curPersonal['uniqueid'])))
+
+# same as prepParallel, but pregnancy wind roses for all residences in the partition are read from a
+# prefix-sum window index (see windowIndex.py) or built from hourly partitions (see hourlyWindStore.py)
+# in one vectorized query
+# INPUTS:
+#    windIndex (dict) - window index or hourly store
+#    idData (numpy array) - unique identifiers for the partition
+#    personalData (pandas dataframe) - maternal residence and birth info
+#    keyCol (str) - personalData column matching idData ('uniqueid' or 'cellId')
+#    roseFunction (function) - getPregnancyRoses function matching windIndex
+# OUTPUTS:
+#    list of tuples - each tuple contains a wind rose and all info needed to create its shapefile
+def prepParallelIndexed(windIndex,idData,personalData,keyCol='uniqueid',roseFunction=windowIndex.getPregnancyRoses):
+    curPersonal = getPartitionBirths(idData,personalData,keyCol)
+    roses = roseFunction(windIndex,curPersonal[keyCol],curPersonal['cdate'],curPersonal['bdate'])
+    return(list(zip(roses.astype(np.float64),curPersonal['bdate'],curPersonal['cdate'],curPersonal['b_lat'],
+        curPersonal['b_long'],curPersonal['uniqueid'])))
 
+# get the births whose wind data is stored in a partition, one row per birth
+# INPUTS:
+#    idData (numpy array) - unique identifiers for the partition
+#    personalData (pandas dataframe) - maternal residence and birth info
+#    keyCol (str) - personalData column matching idData ('uniqueid' or 'cellId')
+# OUTPUTS:
+#    pandas dataframe
+def getPartitionBirths(idData,personalData,keyCol):
+    curPersonal = personalData[personalData[keyCol].astype(str).isin(idData.iloc[:,0].astype(str))]
+    return(curPersonal.drop_duplicates('uniqueid'))
+
+# get maternal residence metadata and the column used to match it to wind partitions.  If the year
+# was processed per ERA5 cell, births are labelled with their cell.  Only called by the main process,
+# workers receive the metadata they need in their task tuples
+# OUTPUTS:
+#    birthData (pandas dataframe), keyCol (str)
+def getBirthData():
+    birthData = ps.read_csv(BIRTH_FILE)
+    cellMap = eraGrid.loadCellMap(PARENT_FOLDER,YEAR)
+    if cellMap is None:
+        return(birthData,'uniqueid')
+    return(eraGrid.attachCells(birthData,cellMap),eraGrid.CELL_ID_COL)
+
+
+# get the filepath to one partition of daily wind matrices.  Compact .wrt partitions are preferred
+# INPUTS:
+#    index (int) - partition index
+# OUTPUTS:
+#    filepath (str)
+def getPartitionFile(index):
+    compactFile = windPartitions + "w_ " + str(index) + windRoseStore.FILE_EXTENSION
+    if os.path.exists(compactFile):
+        return(compactFile)
+    return(windPartitions + "w_ " + str(index) + ".npy")
+
+# add the road-bearing sectors of each residence to its parallel processing tuple.  Residences missing
+# from the sector store keep all 360 sectors
+# INPUTS:
+#    parallelData (list of tuples) - created by prepParallel or prepParallelIndexed
+#    sectorStore (dict) - loaded with roadSectors.loadSectorStore
+# OUTPUTS:
+#    list of tuples
+def attachSectors(parallelData,sectorStore):
+    sectorData = []
+    for curTuple in parallelData:
+        if str(curTuple[5]) in sectorStore['lookup']:
+            curTuple = curTuple + (roadSectors.getSectors(sectorStore,curTuple[5])[0],)
+        sectorData.append(curTuple)
+    return(sectorData)
+
+# save wind roses for road-bearing sectors only, in compressed sparse row format
+# INPUTS:
+#    parallelData (list of tuples) - created by prepParallelIndexed
+#    sectorStore (dict) - loaded with roadSectors.loadSectorStore
+#    index (int) - partition index
+def saveSparseRoses(parallelData,sectorStore,index):
+    curTuples = [curTuple for curTuple in parallelData if str(curTuple[5]) in sectorStore['lookup']]
+    if len(curTuples) == 0:
+        return
+    roses = np.array([curTuple[0] for curTuple in curTuples])
+    sparseRoses = roadSectors.getSparseRoses(sectorStore,[curTuple[5] for curTuple in curTuples],roses)
+    np.savez(OUTPUT_SHAPEOLDER + "/roses_" + str(index) + ".npz",**sparseRoses)
+
+# read one partition and repackage it for parallel processing
+# INPUTS:
+#    index (int) - partition index
+#    birthData (pandas dataframe) - maternal residence and birth info
+#    keyCol (str) - birthData column matching the partition ids ('uniqueid' or 'cellId')
+#    windIndex (dict) - window index or hourly store, None to read daily wind matrix partitions
+#    roseFunction (function) - getPregnancyRoses function matching windIndex
+#    sectorStore (dict) - road-bearing sectors for each residence, None to create all 360 triangles
+# OUTPUTS:
+#    list of tuples - see prepParallel and prepParallelIndexed
+def loadPartitionData(index,birthData,keyCol,windIndex,roseFunction,sectorStore=None):
+    idData = ps.read_csv(masterIdFolder + "id_" + str(index) + ".csv")
+    if windIndex is not None:
+        parallelData = prepParallelIndexed(windIndex,idData,birthData,keyCol,roseFunction)
+        if sectorStore is not None:
+            saveSparseRoses(parallelData,sectorStore,index)
+    else:
+        parallelData = prepParallel(getPartitionFile(index),idData,birthData,keyCol)
+    if sectorStore is not None:
+        parallelData = attachSectors(parallelData,sectorStore)
+    return(parallelData)
 
 
 ################# Main function ######################
 if __name__ == '__main__':
+    if not (os.path.exists(OUTPUT_SHAPEOLDER)):
+        os.makedirs(OUTPUT_SHAPEOLDER)
     masterIds = os.listdir(masterIdFolder)
-    for index in range(len(masterIds)):
-        windData = np.load(windPartitions + "w_ " + str(index) + ".npy")
-        idData = ps.read_csv(masterIdFolder + "id_" + str(index) + ".csv")
-        parallelData = prepParallel(windData,idData,BIRTH_DATA)
-        print("finished prepping data")
-        with Pool(processes=64) as pool:
-            pool.map(processSingleResidence,parallelData)
\ No newline at end of file
+    birthData, keyCol = getBirthData()
+    windIndex, roseFunction = None, None
+    if os.path.exists(hourlyWindStore.getSidecarFile(windPartitions,0)):
+        windIndex = hourlyWindStore.openHourlyStore(windPartitions)
+        roseFunction = partial(hourlyWindStore.getPregnancyRoses,maxDiff=ROSE_WINDOW)
+    elif os.path.exists(windPartitions + windowIndex.INDEX_PREFIX + "0.json"):
+        windIndex = windowIndex.openWindowIndex(windPartitions)
+        roseFunction = windowIndex.getPregnancyRoses
+
+    # the next partition is read and prepped on a background thread while the pool creates
+    # shapefiles for the current one (see ioPipeline.py)
+    sectorStore = roadSectors.loadSectorStore(ROAD_SECTOR_FOLDER)
+    loadFunction = partial(loadPartitionData,birthData=birthData,keyCol=keyCol,windIndex=windIndex,
+        roseFunction=roseFunction,sectorStore=sectorStore)
+    with Pool(processes=64) as pool:
+        for index, parallelData in ioPipeline.prefetch(loadFunction,range(len(masterIds))):
+            print("finished prepping data for partition %i" %(index))
+            if OUTPUT_FORMAT == 'geoparquet':
+                saveRosePartition(parallelData,index,pool)
+            else:
+                pool.map(processSingleResidence,parallelData)
@@ -0,0 +1,394 @@
+############### roadExposureSurface.py #############
+# Developed for HEI Transit Study
+# Summary: precompute a statewide ~30m grid of hours downwind of each road class (aadt0, aadt1, taadt0,
+#          taadt1) within 500m, for each month of a year.  A birth's exposure is then a sample of the grid
+#          summed over its pregnancy months, so adding births or rerunning sensitivity analyses does not
+#          require new wind roses, buffers, or road intersects
+# A pixel is downwind of a road class during an hour if any 1 degree sector containing a road of that
+# class within 500m of the pixel center is downwind of the hour's wind direction (the same test used
+# for wind roses, see windBackends.histogramToDownwind).  Days with a missing hour are dropped, as in
+# hourlyWindStore.py
+# Layout: <surfaceFolder>/<year>/ contains surface.json (grid geometry), monthlyHistograms.npy,
+# roadPieces.npz, and tile_<row>_<col>.npz (uint16 hours organized by (month, road class, row, col)).
+# Tiles without roads within 500m are not saved and are 0 hours downwind
+# Steps include:
+# 1) counting the wind directions of each ERA5 cell and month with one bincount per month (windCube.py)
+# 2) finding the road-bearing sectors of every pixel in a tile (roadSectors.calcPieceSectors)
+# 3) widening the sectors by the downwind window with a circular prefix sum, giving the wind directions
+#    for which each pixel is downwind
+# 4) multiplying by the monthly histograms of each pixel's ERA5 cell
+# Tiles are processed in parallel and saved as they finish, so interrupted runs resume at the next tile
+
+
+############### Setup: import libraries and define constants ##############
+import argparse
+import calendar
+import json
+import os
+from multiprocessing import Pool
+import numpy as np
+import pandas as ps
+import eraGrid
+import roadSectors
+import windBackends
+import windCube
+
+# statewide grid.  Pixel rows run north to south, columns west to east
+SURFACE_NORTH = 36.6
+SURFACE_SOUTH = 25.8
+SURFACE_WEST = -106.7
+SURFACE_EAST = -93.5
+RESOLUTION = 0.0003 # degrees, ~33m north-south and ~29m east-west in Texas
+TILE_SIZE = 256 # pixels per tile side
+N_PIXEL_ROWS = int(np.ceil((SURFACE_NORTH - SURFACE_SOUTH)/RESOLUTION))
+N_PIXEL_COLS = int(np.ceil((SURFACE_EAST - SURFACE_WEST)/RESOLUTION))
+N_TILE_ROWS = int(np.ceil(N_PIXEL_ROWS/TILE_SIZE))
+N_TILE_COLS = int(np.ceil(N_PIXEL_COLS/TILE_SIZE))
+
+N_CLASSES = len(roadSectors.ROAD_FILES)
+N_MONTHS = 12
+N_BINS = windBackends.N_ANGLES + 1 # wind directions 0-360
+BLOCK_ROWS = 16 # pixel rows paired with nearby road pieces at a time
+PIECE_METERS = roadSectors.PIECE_DEGREES*roadSectors.METERS_PER_DEGREE # upper bound on midpoint to end of a piece
+N_PROCESSES = 64
+SIDECAR_FILENAME = "surface.json"
+HISTOGRAM_FILENAME = "monthlyHistograms.npy"
+PIECES_FILENAME = "roadPieces.npz"
+workerState = {} # road index and histograms loaded once per pool worker, keyed by year folder
+
+
+
+################ Grid ##############
+
+# get the folder of one year's surface
+# INPUTS:
+#    surfaceFolder (str) - parent folder
+#    year (int) - year of the wind and road data
+# OUTPUTS:
+#    folder (str)
+def getYearFolder(surfaceFolder,year):
+    return(os.path.join(surfaceFolder,str(year)))
+
+# get the filepath of one tile
+# INPUTS:
+#    yearFolder (str) - created by getYearFolder
+#    tileRow, tileCol (int) - tile position
+# OUTPUTS:
+#    filepath (str)
+def getTileFile(yearFolder,tileRow,tileCol):
+    return(os.path.join(yearFolder,"tile_" + str(tileRow) + "_" + str(tileCol) + ".npz"))
+
+# get the pixel center coordinates of one tile
+# INPUTS:
+#    tileRow, tileCol (int) - tile position
+# OUTPUTS:
+#    lats (numpy array) - latitude of each pixel row, north to south
+#    lons (numpy array) - longitude of each pixel column, west to east
+def getTilePixelCenters(tileRow,tileCol):
+    offsets = np.arange(TILE_SIZE) + 0.5
+    lats = SURFACE_NORTH - (tileRow*TILE_SIZE + offsets)*RESOLUTION
+    lons = SURFACE_WEST + (tileCol*TILE_SIZE + offsets)*RESOLUTION
+    return(lats,lons)
+
+# get the pixel containing each coordinate
+# INPUTS:
+#    lats, lons (array-like) - coordinates in degrees
+# OUTPUTS:
+#    pixelRows, pixelCols (numpy int64 arrays) - statewide pixel position, -1 outside the grid
+def getPixelIndex(lats,lons):
+    pixelRows = np.floor((SURFACE_NORTH - np.asarray(lats,np.float64))/RESOLUTION).astype(np.int64)
+    pixelCols = np.floor((np.asarray(lons,np.float64) - SURFACE_WEST)/RESOLUTION).astype(np.int64)
+    isValid = (pixelRows >= 0) & (pixelRows < N_PIXEL_ROWS) & (pixelCols >= 0) & (pixelCols < N_PIXEL_COLS)
+    return(np.where(isValid,pixelRows,-1),np.where(isValid,pixelCols,-1))
+
+# get the tiles within a distance of any road piece
+# INPUTS:
+#    pieces (dict) - created by roadSectors.splitSegments
+#    radius (float) - distance in meters.  Must be smaller than a tile
+# OUTPUTS:
+#    list of (tileRow, tileCol) tuples
+def getRoadTiles(pieces,radius=roadSectors.MAX_DIST):
+    midLats, midLons = (pieces['y1'] + pieces['y2'])/2, (pieces['x1'] + pieces['x2'])/2
+    pixelRows, pixelCols = getPixelIndex(midLats,midLons)
+    isValid = pixelRows >= 0
+    rowMargin = (radius + PIECE_METERS)/(RESOLUTION*roadSectors.METERS_PER_DEGREE)
+    colMargin = rowMargin/np.cos(np.radians(midLats[isValid]))
+    tiles = set()
+    for rowShift in (-1,0,1):
+        for colShift in (-1,0,1):
+            tileRows = np.floor((pixelRows[isValid] + rowShift*rowMargin)/TILE_SIZE).astype(np.int64)
+            tileCols = np.floor((pixelCols[isValid] + colShift*colMargin)/TILE_SIZE).astype(np.int64)
+            tiles.update(zip(tileRows.tolist(),tileCols.tolist()))
+    return(sorted([tile for tile in tiles if 0 <= tile[0] < N_TILE_ROWS and 0 <= tile[1] < N_TILE_COLS]))
+
+
+
+################ Wind ##############
+
+# count the wind directions of every ERA5 cell for each month of a year.  Days with a missing hour are dropped
+# INPUTS:
+#    cubeFolder (str) - folder containing the wind direction cubes
+#    year (int) - year of interest
+# OUTPUTS:
+#    int32 numpy array organized by (month, cell, wind direction)
+def calcMonthlyHistograms(cubeFolder,year):
+    cube = windCube.openCube(cubeFolder,year)
+    nCells = eraGrid.N_ROWS*eraGrid.N_COLS
+    histograms = np.zeros((N_MONTHS,nCells,N_BINS),np.int32)
+    for month in range(1,N_MONTHS+1):
+        nDays = calendar.monthrange(year,month)[1]
+        start = int(windCube.getHourIndex(cube,np.datetime64("%i-%02i-01T00" %(year,month),'h')))
+        end = start + nDays*windCube.N_HOURS
+        block = np.array(cube['direction'][start:end]).reshape(nDays,windCube.N_HOURS,nCells)
+        block[~np.asarray(cube['mask'][start:end]).reshape(nDays,windCube.N_HOURS)] = windCube.MISSING
+        isValidDay = (block >= 0).all(axis=1) # (day, cell)
+        days, cells = np.nonzero(isValidDay)
+        binIndex = cells[:,np.newaxis]*N_BINS + block[days,:,cells]
+        histograms[month-1] = np.bincount(binIndex.ravel(),minlength=nCells*N_BINS).reshape(nCells,N_BINS)
+    return(histograms)
+
+# get the wind directions for which each pixel is downwind of a road, from its road-bearing sectors.
+# Because the downwind test is symmetric in sector and direction, the circular window sum used for
+# wind roses gives the directions for directions 0-359.  Direction 360 uses the wind rose convention
+# INPUTS:
+#    sectorMask (numpy array) - bool, last axis has 360 sectors
+#    halfWindow (int) - largest angular difference that is downwind (see windBackends.getHalfWindow)
+# OUTPUTS:
+#    bool numpy array, last axis has 361 wind directions
+def calcDownwindDirections(sectorMask,halfWindow):
+    padded = np.zeros(sectorMask.shape[:-1] + (N_BINS,),np.int16)
+    padded[...,:windBackends.N_ANGLES] = sectorMask
+    directions = np.empty(sectorMask.shape[:-1] + (N_BINS,),bool)
+    directions[...,:windBackends.N_ANGLES] = windBackends.histogramToDownwind(padded,halfWindow) > 0
+    direction360 = np.zeros(N_BINS,np.int16)
+    direction360[windBackends.N_ANGLES] = 1
+    isDownwind360 = windBackends.histogramToDownwind(direction360,halfWindow) > 0 # sectors downwind of direction 360
+    directions[...,windBackends.N_ANGLES] = (sectorMask & isDownwind360).any(axis=-1)
+    return(directions)
+
+
+
+################ Tiles ##############
+
+# find the road-bearing sectors of every pixel in a tile
+# INPUTS:
+#    roadIndex (dict) - created by roadSectors.createRoadIndex
+#    tileRow, tileCol (int) - tile position
+#    radius (float) - search radius in meters
+# OUTPUTS:
+#    bool numpy array organized by (road class, pixel, sector), None if no roads are within the radius
+def calcTileSectors(roadIndex,tileRow,tileCol,radius=roadSectors.MAX_DIST):
+    lats, lons = getTilePixelCenters(tileRow,tileCol)
+    latMargin = (radius + PIECE_METERS)/roadSectors.METERS_PER_DEGREE
+    lonMargin = latMargin/np.cos(np.radians(np.abs(lats).max() + latMargin))
+    candidates = roadSectors.getBoxPieces(roadIndex,lats.min() - latMargin,lats.max() + latMargin,
+        lons.min() - lonMargin,lons.max() + lonMargin)
+    if len(candidates) == 0:
+        return(None)
+    x1, y1 = roadIndex['x1'][candidates], roadIndex['y1'][candidates]
+    x2, y2 = roadIndex['x2'][candidates], roadIndex['y2'][candidates]
+    roadClass = roadIndex['roadClass'][candidates].astype(np.int64)
+    midX, midY = (x1 + x2)/2, (y1 + y2)/2
+    sectorMask = np.zeros((N_CLASSES,TILE_SIZE*TILE_SIZE,windBackends.N_ANGLES),bool)
+    isEmpty = True
+
+    for blockStart in range(0,TILE_SIZE,BLOCK_ROWS):
+        blockLats = lats[blockStart:blockStart+BLOCK_ROWS]
+        nearPieces = np.flatnonzero((midY >= blockLats.min() - latMargin) & (midY <= blockLats.max() + latMargin))
+        if len(nearPieces) == 0:
+            continue
+        pixelLats = np.repeat(blockLats,TILE_SIZE)
+        pixelLons = np.tile(lons,len(blockLats))
+        lonScale = roadSectors.METERS_PER_DEGREE*np.cos(np.radians(pixelLats))
+
+        # pair each pixel with the pieces whose midpoint could be within the radius
+        midDx = (midX[nearPieces][np.newaxis,:] - pixelLons[:,np.newaxis])*lonScale[:,np.newaxis]
+        midDy = (midY[nearPieces][np.newaxis,:] - pixelLats[:,np.newaxis])*roadSectors.METERS_PER_DEGREE
+        pairPixels, pairPieces = np.nonzero(midDx*midDx + midDy*midDy <= (radius + PIECE_METERS)**2)
+        if len(pairPixels) == 0:
+            continue
+        pieces = nearPieces[pairPieces]
+        scale = lonScale[pairPixels]
+        pieceIndex, sectors = roadSectors.calcPieceSectors(
+            (x1[pieces] - pixelLons[pairPixels])*scale,(y1[pieces] - pixelLats[pairPixels])*roadSectors.METERS_PER_DEGREE,
+            (x2[pieces] - pixelLons[pairPixels])*scale,(y2[pieces] - pixelLats[pairPixels])*roadSectors.METERS_PER_DEGREE,radius
+        )
+        if len(pieceIndex) > 0:
+            isEmpty = False
+            sectorMask[roadClass[pieces[pieceIndex]],blockStart*TILE_SIZE + pairPixels[pieceIndex],sectors] = True
+    return(None if isEmpty else sectorMask)
+
+# calculate monthly hours downwind of each road class for every pixel in a tile
+# INPUTS:
+#    roadIndex (dict) - created by roadSectors.createRoadIndex
+#    histograms (numpy array) - created by calcMonthlyHistograms
+#    tileRow, tileCol (int) - tile position
+#    halfWindow (int) - largest angular difference that is downwind
+#    radius (float) - search radius in meters
+# OUTPUTS:
+#    uint16 numpy array organized by (month, road class, row, col), None if no roads are within the radius
+def calcTileSurface(roadIndex,histograms,tileRow,tileCol,halfWindow,radius=roadSectors.MAX_DIST):
+    sectorMask = calcTileSectors(roadIndex,tileRow,tileCol,radius)
+    if sectorMask is None:
+        return(None)
+    lats, lons = getTilePixelCenters(tileRow,tileCol)
+    cellIds = eraGrid.getCellIds(np.repeat(lats,TILE_SIZE),np.tile(lons,TILE_SIZE))
+    hours = np.zeros((N_MONTHS,N_CLASSES,TILE_SIZE*TILE_SIZE),np.uint16)
+    for roadClass in range(N_CLASSES):
+        pixels = np.flatnonzero(sectorMask[roadClass].any(axis=1) & (cellIds >= 0))
+        if len(pixels) == 0:
+            continue
+        directions = calcDownwindDirections(sectorMask[roadClass,pixels],halfWindow).astype(np.float32)
+        for cellId in np.unique(cellIds[pixels]):
+            isCell = cellIds[pixels] == cellId
+            cellHours = np.asarray(histograms[:,cellId],np.float32) @ directions[isCell].T # (month, pixel)
+            hours[:,roadClass,pixels[isCell]] = np.rint(cellHours).astype(np.uint16)
+    return(hours.reshape(N_MONTHS,N_CLASSES,TILE_SIZE,TILE_SIZE))
+
+# load the road index, histograms, and settings of a year, once per process
+# INPUTS:
+#    yearFolder (str) - created by getYearFolder
+# OUTPUTS:
+#    state (dict)
+def getWorkerState(yearFolder):
+    if yearFolder not in workerState:
+        with open(os.path.join(yearFolder,SIDECAR_FILENAME)) as f:
+            sidecar = json.load(f)
+        with np.load(os.path.join(yearFolder,PIECES_FILENAME)) as f:
+            pieces = {key:f[key] for key in f.files}
+        workerState[yearFolder] = {
+            'roadIndex':roadSectors.createRoadIndex(pieces),
+            'histograms':np.load(os.path.join(yearFolder,HISTOGRAM_FILENAME),mmap_mode='r'),
+            'halfWindow':sidecar['halfWindow'],
+            'radius':sidecar['radius']
+        }
+    return(workerState[yearFolder])
+
+# calculate and save one tile.  The tile is written to a temporary name and moved into place
+# INPUTS:
+#    task (tuple) - year folder, tile row, tile col
+# OUTPUTS:
+#    True if the tile has roads within the radius and was saved
+def processTile(task):
+    yearFolder, tileRow, tileCol = task
+    state = getWorkerState(yearFolder)
+    hours = calcTileSurface(state['roadIndex'],state['histograms'],tileRow,tileCol,state['halfWindow'],state['radius'])
+    if hours is None:
+        return(False)
+    tileFile = getTileFile(yearFolder,tileRow,tileCol)
+    with open(tileFile + ".tmp",'wb') as f:
+        np.savez_compressed(f,hours=hours)
+    os.replace(tileFile + ".tmp",tileFile)
+    return(True)
+
+
+
+################ Main functions ##############
+
+# calculate the surface for one year.  Completed tiles are skipped
+# INPUTS:
+#    year (int) - year of the wind and road data
+#    segments (dict) - road segments created by roadSectors.readRoadSegments
+#    cubeFolder (str) - folder containing the wind direction cubes
+#    surfaceFolder (str) - parent output folder
+#    maxDiff (float) - angular window in degrees
+#    radius (float) - distance from roads in meters
+#    nProcesses (int) - tiles processed in parallel
+# OUTPUTS:
+#    number of tiles saved (int)
+def buildSurface(year,segments,cubeFolder,surfaceFolder,maxDiff=windBackends.DOWNWIND_WINDOW,
+    radius=roadSectors.MAX_DIST,nProcesses=N_PROCESSES):
+    yearFolder = getYearFolder(surfaceFolder,year)
+    if not(os.path.exists(yearFolder)):
+        os.makedirs(yearFolder)
+    pieces = roadSectors.splitSegments(segments)
+    np.savez(os.path.join(yearFolder,PIECES_FILENAME),**pieces)
+    np.save(os.path.join(yearFolder,HISTOGRAM_FILENAME),calcMonthlyHistograms(cubeFolder,year))
+    sidecar = {
+        'year':int(year),
+        'north':SURFACE_NORTH,
+        'west':SURFACE_WEST,
+        'resolution':RESOLUTION,
+        'tileSize':TILE_SIZE,
+        'nTileRows':N_TILE_ROWS,
+        'nTileCols':N_TILE_COLS,
+        'roadFiles':roadSectors.ROAD_FILES,
+        'halfWindow':windBackends.getHalfWindow(maxDiff),
+        'radius':float(radius)
+    }
+    with open(os.path.join(yearFolder,SIDECAR_FILENAME),'w') as f:
+        json.dump(sidecar,f,indent=2)
+
+    tasks = [(yearFolder,tileRow,tileCol) for tileRow, tileCol in getRoadTiles(pieces,radius)
+        if not(os.path.exists(getTileFile(yearFolder,tileRow,tileCol)))]
+    print("calculating %i tiles for %i" %(len(tasks),year))
+    if nProcesses <= 1:
+        return(sum(map(processTile,tasks)))
+    with Pool(processes=nProcesses) as pool:
+        return(sum(pool.imap_unordered(processTile,tasks,chunksize=4)))
+
+# get the fraction of each month covered by inclusive [start, end] date windows
+# INPUTS:
+#    starts, ends (numpy datetime64 arrays) - first and last day of each window
+# OUTPUTS:
+#    months (numpy datetime64 array) - months covered by any window
+#    weights (numpy array) - fraction of each month's days in each window, organized by (window, month)
+def getMonthWeights(starts,ends):
+    months = np.arange(starts.astype('datetime64[M]').min(),ends.astype('datetime64[M]').max() + 1)
+    monthStarts = months.astype('datetime64[D]')
+    monthEnds = (months + 1).astype('datetime64[D]') - 1
+    overlap = (np.minimum(ends[:,np.newaxis],monthEnds) - np.maximum(starts[:,np.newaxis],monthStarts)).astype(np.int64) + 1
+    weights = np.maximum(overlap,0)/(monthEnds - monthStarts + 1).astype(np.int64)
+    return(months,weights)
+
+# sample the surface for a set of residences and pregnancy periods.  Months partly covered by a pregnancy
+# are weighted by the fraction of their days in the pregnancy
+# INPUTS:
+#    surfaceFolder (str) - parent folder
+#    lats, lons (array-like) - residence coordinates
+#    cdates (array-like) - conception dates
+#    bdates (array-like) - birth dates.  The pregnancy ends the day before birth
+# OUTPUTS:
+#    numpy array of hours downwind organized by (birth, road class)
+def sampleExposure(surfaceFolder,lats,lons,cdates,bdates):
+    starts = np.asarray(ps.to_datetime(np.asarray(cdates)).values.astype('datetime64[D]'))
+    ends = np.asarray(ps.to_datetime(np.asarray(bdates)).values.astype('datetime64[D]')) - 1
+    pixelRows, pixelCols = getPixelIndex(lats,lons)
+    if (pixelRows < 0).any():
+        raise ValueError("coordinates fall outside the surface")
+    months, weights = getMonthWeights(starts,ends)
+    monthYears = months.astype('datetime64[Y]').astype(np.int64) + 1970
+    tileKeys = (pixelRows//TILE_SIZE)*N_TILE_COLS + pixelCols//TILE_SIZE
+    exposure = np.zeros((len(starts),N_CLASSES),np.float64)
+    for year in np.unique(monthYears):
+        yearFolder = getYearFolder(surfaceFolder,int(year))
+        if not(os.path.exists(os.path.join(yearFolder,SIDECAR_FILENAME))):
+            raise FileNotFoundError("no exposure surface for %i in %s" %(year,surfaceFolder))
+        yearMonths = np.flatnonzero(monthYears == year)
+        monthIndex = (months[yearMonths].astype(np.int64) % N_MONTHS)
+        for tileKey in np.unique(tileKeys):
+            tileFile = getTileFile(yearFolder,int(tileKey//N_TILE_COLS),int(tileKey % N_TILE_COLS))
+            if not(os.path.exists(tileFile)):
+                continue
+            births = np.flatnonzero(tileKeys == tileKey)
+            with np.load(tileFile) as f:
+                hours = f['hours'][:,:,pixelRows[births] % TILE_SIZE,pixelCols[births] % TILE_SIZE] # (month, class, birth)
+            exposure[births] += np.einsum('bm,mcb->bc',weights[np.ix_(births,yearMonths)],hours[monthIndex].astype(np.float64))
+    return(exposure)
+
+
+
+################# Main function ######################
+
+if __name__ == '__main__':
+    import gConst as const
+    parser = argparse.ArgumentParser(description="precompute monthly hours downwind of each road class on a statewide grid")
+    parser.add_argument('years',type=int,nargs='+',help="years of wind and road data")
+    parser.add_argument('--processes',type=int,default=N_PROCESSES,help="tiles processed in parallel")
+    parser.add_argument('--window',type=float,default=windBackends.DOWNWIND_WINDOW,help="angular window in degrees")
+    args = parser.parse_args()
+    for year in args.years:
+        segments = roadSectors.readRoadSegments(const.WIND_FOLDER + "roads/" + str(year) + "/")
+        nTiles = buildSurface(year,segments,const.WIND_FOLDER + "wind_surfaces/wind_cubes/",
+            const.WIND_FOLDER + "exposureSurfaces/",args.window,nProcesses=args.processes)
+        print("saved %i tiles for %i" %(nTiles,year))
@@ -0,0 +1,306 @@
+############### roadSectors.py #############
+# Developed for HEI Transit Study
+# Summary: find the 1 degree wind sectors around each maternal residence that contain a road segment
+#          within 500m.  Only these sectors are used downstream (shieldingScript.createRoadIntersects and
+#          calcBufferAvgs.processShp), so wind roses are stored and converted to shapefile triangles for
+#          road-bearing sectors only.  Most residences have roads in fewer than 40 of the 360 sectors
+# Steps include:
+# 1) reading the yearly road files (aadt0, aadt1, taadt0, taadt1) as straight line segments
+# 2) splitting segments into short pieces and bucketing pieces by grid cell to find candidate roads
+# 3) projecting candidates to a local equirectangular plane around each residence and clipping them
+#    to the 500m circle
+# 4) converting the angular extent of each clipped piece to sectors.  Sector a covers bearings [a, a+1),
+#    the same as the triangles created by residentialWindParallel.calcAnnualShapefile
+# 5) storing sectors for all residences in compressed sparse row (CSR) format, with a bitmask of the
+#    road classes present in each sector
+
+
+############### Setup: import libraries and define constants ##############
+import os
+import numpy as np
+import pandas as ps
+
+N_ANGLES = 360
+MAX_DIST = 500.0 # meters, largest buffer used in the shielding analysis
+EARTH_RADIUS = 6378140.0 # same radius as roseGeometry.py
+METERS_PER_DEGREE = EARTH_RADIUS*np.pi/180.0
+PIECE_DEGREES = 0.0005 # segments are split into pieces no longer than ~50m before bucketing
+CELL_DEGREES = 0.01 # bucket size.  Must exceed (MAX_DIST + piece length) in degrees of longitude
+ROAD_FILES = ['aadt0.shp','aadt1.shp','taadt0.shp','taadt1.shp'] # road class is the index in this list
+STORE_FILENAME = "roadSectors.npz"
+
+
+
+################ Reading roads ##############
+
+# convert polyline vertex arrays into straight line segments
+# INPUTS:
+#    lines (list) - one (n,2) array of lon/lat vertices per polyline part
+#    roadClass (int) - road class of all lines
+# OUTPUTS:
+#    segments (dict) - 'x1', 'y1', 'x2', 'y2' (lon/lat) and 'roadClass' arrays
+def createSegments(lines,roadClass):
+    starts = [np.asarray(line,np.float64)[:-1] for line in lines if len(line) > 1]
+    ends = [np.asarray(line,np.float64)[1:] for line in lines if len(line) > 1]
+    starts = np.concatenate(starts) if len(starts) > 0 else np.zeros((0,2))
+    ends = np.concatenate(ends) if len(ends) > 0 else np.zeros((0,2))
+    segments = {
+        'x1':starts[:,0],'y1':starts[:,1],'x2':ends[:,0],'y2':ends[:,1],
+        'roadClass':np.full(len(starts),roadClass,np.uint8)
+    }
+    return(segments)
+
+# combine segment dicts
+# INPUTS:
+#    segmentList (list) - segment dicts created by createSegments
+# OUTPUTS:
+#    segments (dict)
+def mergeSegments(segmentList):
+    return({key:np.concatenate([segments[key] for segments in segmentList]) for key in segmentList[0]})
+
+# read yearly road files as line segments in WGS84 coordinates
+# INPUTS:
+#    roadFolder (str) - folder containing the files in ROAD_FILES
+# OUTPUTS:
+#    segments (dict)
+def readRoadSegments(roadFolder):
+    import arcpy
+    wgs84 = arcpy.SpatialReference(4326)
+    segmentList = []
+    for roadClass, roadFile in enumerate(ROAD_FILES):
+        lines = []
+        with arcpy.da.SearchCursor(os.path.join(roadFolder,roadFile),['SHAPE@'],spatial_reference=wgs84) as cursor:
+            for row in cursor:
+                if row[0] is None:
+                    continue
+                for part in row[0]:
+                    lines.append([(point.X,point.Y) for point in part if point is not None])
+        segmentList.append(createSegments(lines,roadClass))
+    return(mergeSegments(segmentList))
+
+# split segments into pieces no longer than PIECE_DEGREES so each piece falls in at most two buckets
+# INPUTS:
+#    segments (dict) - created by createSegments
+# OUTPUTS:
+#    pieces (dict) - same keys as segments
+def splitSegments(segments):
+    dx, dy = segments['x2'] - segments['x1'], segments['y2'] - segments['y1']
+    nPieces = np.maximum(np.ceil(np.maximum(np.abs(dx),np.abs(dy))/PIECE_DEGREES),1).astype(np.int64)
+    segmentIndex = np.repeat(np.arange(len(nPieces)),nPieces)
+    pieceIndex = np.arange(nPieces.sum()) - np.repeat(np.cumsum(nPieces) - nPieces,nPieces)
+    t1, t2 = pieceIndex/nPieces[segmentIndex], (pieceIndex+1)/nPieces[segmentIndex]
+    pieces = {
+        'x1':segments['x1'][segmentIndex] + t1*dx[segmentIndex],
+        'y1':segments['y1'][segmentIndex] + t1*dy[segmentIndex],
+        'x2':segments['x1'][segmentIndex] + t2*dx[segmentIndex],
+        'y2':segments['y1'][segmentIndex] + t2*dy[segmentIndex],
+        'roadClass':segments['roadClass'][segmentIndex]
+    }
+    return(pieces)
+
+# bucket pieces by the grid cell of their midpoint
+# INPUTS:
+#    pieces (dict) - created by splitSegments
+# OUTPUTS:
+#    roadIndex (dict) - pieces sorted by cell, with sorted cell keys for searchsorted lookups
+def createRoadIndex(pieces):
+    row = np.floor((pieces['y1'] + pieces['y2'])/2/CELL_DEGREES).astype(np.int64)
+    col = np.floor((pieces['x1'] + pieces['x2'])/2/CELL_DEGREES).astype(np.int64)
+    keys = row*100000 + col
+    order = np.argsort(keys,kind='stable')
+    roadIndex = {key:values[order] for key, values in pieces.items()}
+    roadIndex['keys'] = keys[order]
+    return(roadIndex)
+
+# get pieces in the 3x3 block of cells around a coordinate
+# INPUTS:
+#    roadIndex (dict) - created by createRoadIndex
+#    lat, lon (float) - residence coordinates
+# OUTPUTS:
+#    numpy array of piece indeces
+def getCandidatePieces(roadIndex,lat,lon):
+    row, col = int(np.floor(lat/CELL_DEGREES)), int(np.floor(lon/CELL_DEGREES))
+    candidates = []
+    for curRow in range(row-1,row+2):
+        start = np.searchsorted(roadIndex['keys'],curRow*100000 + col-1,side='left')
+        end = np.searchsorted(roadIndex['keys'],curRow*100000 + col+1,side='right')
+        candidates.append(np.arange(start,end))
+    return(np.concatenate(candidates))
+
+# get pieces bucketed in the cells overlapping a lon/lat box
+# INPUTS:
+#    roadIndex (dict) - created by createRoadIndex
+#    south, north, west, east (float) - box bounds in degrees
+# OUTPUTS:
+#    numpy array of piece indeces
+def getBoxPieces(roadIndex,south,north,west,east):
+    firstCol, lastCol = int(np.floor(west/CELL_DEGREES)), int(np.floor(east/CELL_DEGREES))
+    candidates = []
+    for curRow in range(int(np.floor(south/CELL_DEGREES)),int(np.floor(north/CELL_DEGREES))+1):
+        start = np.searchsorted(roadIndex['keys'],curRow*100000 + firstCol,side='left')
+        end = np.searchsorted(roadIndex['keys'],curRow*100000 + lastCol,side='right')
+        candidates.append(np.arange(start,end))
+    return(np.concatenate(candidates))
+
+
+
+################ Sector geometry ##############
+
+# clip pieces to a circle centered on the origin and get the 1 degree sectors they cross
+# INPUTS:
+#    x1, y1, x2, y2 (numpy arrays) - piece endpoints in meters, relative to the residence
+#    radius (float) - circle radius in meters
+# OUTPUTS:
+#    pieceIndex (numpy array) - index of the piece for each sector
+#    sectors (numpy array) - sector crossed by the piece
+def calcPieceSectors(x1,y1,x2,y2,radius=MAX_DIST):
+    dx, dy = x2 - x1, y2 - y1
+    a = dx*dx + dy*dy
+    b = 2*(x1*dx + y1*dy)
+    c = x1*x1 + y1*y1 - radius*radius
+    disc = b*b - 4*a*c
+    isHit = (disc >= 0) & (a > 0)
+    root = np.sqrt(np.where(isHit,disc,0))
+    safeA = np.where(a > 0,a,1)
+    tStart = np.clip((-b - root)/(2*safeA),0,1)
+    tEnd = np.clip((-b + root)/(2*safeA),0,1)
+    isHit &= tEnd > tStart
+
+    # split at the point closest to the residence so each half spans less than 180 degrees
+    tClose = np.clip(-b/(2*safeA),tStart,tEnd)
+    pieceIndex = np.flatnonzero(isHit)
+    halves = [(tStart,tClose),(tClose,tEnd)]
+    allPieces, allSectors = [], []
+    for tA, tB in halves:
+        xA, yA = x1[pieceIndex] + tA[pieceIndex]*dx[pieceIndex], y1[pieceIndex] + tA[pieceIndex]*dy[pieceIndex]
+        xB, yB = x1[pieceIndex] + tB[pieceIndex]*dx[pieceIndex], y1[pieceIndex] + tB[pieceIndex]*dy[pieceIndex]
+        bearingA = np.degrees(np.arctan2(xA,yA)) % N_ANGLES
+        bearingB = np.degrees(np.arctan2(xB,yB)) % N_ANGLES
+        sweep = (bearingB - bearingA) % N_ANGLES
+        isReversed = sweep > 180
+        start = np.where(isReversed,bearingB,bearingA)
+        sweep = np.where(isReversed,N_ANGLES - sweep,sweep)
+        firstSector = np.floor(start).astype(np.int64)
+        nSectors = np.floor(start + sweep).astype(np.int64) - firstSector + 1
+        offsets = np.arange(nSectors.sum()) - np.repeat(np.cumsum(nSectors) - nSectors,nSectors)
+        allPieces.append(np.repeat(pieceIndex,nSectors))
+        allSectors.append((np.repeat(firstSector,nSectors) + offsets) % N_ANGLES)
+    return(np.concatenate(allPieces),np.concatenate(allSectors))
+
+# get road-bearing sectors for one residence
+# INPUTS:
+#    roadIndex (dict) - created by createRoadIndex
+#    lat, lon (float) - residence coordinates
+#    radius (float) - search radius in meters
+# OUTPUTS:
+#    sectors (numpy uint16 array) - sorted unique sectors
+#    classMask (numpy uint8 array) - bitmask of the road classes in each sector (bit i = ROAD_FILES[i])
+def getResidenceSectors(roadIndex,lat,lon,radius=MAX_DIST):
+    candidates = getCandidatePieces(roadIndex,lat,lon)
+    lonScale = METERS_PER_DEGREE*np.cos(np.radians(lat))
+    pieceIndex, sectors = calcPieceSectors(
+        (roadIndex['x1'][candidates] - lon)*lonScale,(roadIndex['y1'][candidates] - lat)*METERS_PER_DEGREE,
+        (roadIndex['x2'][candidates] - lon)*lonScale,(roadIndex['y2'][candidates] - lat)*METERS_PER_DEGREE,radius
+    )
+    uniqueSectors, inverse = np.unique(sectors,return_inverse=True)
+    classMask = np.zeros(len(uniqueSectors),np.uint8)
+    np.bitwise_or.at(classMask,inverse,(1 << roadIndex['roadClass'][candidates][pieceIndex]).astype(np.uint8))
+    return(uniqueSectors.astype(np.uint16),classMask)
+
+
+
+################ Sector store ##############
+
+# find road-bearing sectors for all maternal residences
+# INPUTS:
+#    birthData (pandas dataframe) - uniqueid, b_lat, and b_long columns
+#    segments (dict) - road segments created by readRoadSegments
+# OUTPUTS:
+#    store (dict) - ids, CSR row pointers ('indptr'), 'sectors', and 'classMask'
+def createSectorStore(birthData,segments):
+    roadIndex = createRoadIndex(splitSegments(segments))
+    indptr = np.zeros(len(birthData)+1,np.int64)
+    sectorList, maskList = [], []
+    for i, (lat, lon) in enumerate(zip(birthData['b_lat'],birthData['b_long'])):
+        sectors, classMask = getResidenceSectors(roadIndex,float(lat),float(lon))
+        sectorList.append(sectors)
+        maskList.append(classMask)
+        indptr[i+1] = indptr[i] + len(sectors)
+    store = {
+        'ids':np.asarray(birthData['uniqueid']).astype(str),
+        'indptr':indptr,
+        'sectors':np.concatenate(sectorList) if len(sectorList) > 0 else np.zeros(0,np.uint16),
+        'classMask':np.concatenate(maskList) if len(maskList) > 0 else np.zeros(0,np.uint8)
+    }
+    return(store)
+
+# save a sector store
+# INPUTS:
+#    store (dict) - created by createSectorStore
+#    outputFolder (str) - folder to save roadSectors.npz in
+def saveSectorStore(store,outputFolder):
+    if not(os.path.exists(outputFolder)):
+        os.makedirs(outputFolder)
+    np.savez(os.path.join(outputFolder,STORE_FILENAME),**store)
+
+# load a sector store
+# INPUTS:
+#    outputFolder (str) - folder containing roadSectors.npz
+# OUTPUTS:
+#    store (dict) with an id lookup, None if no store exists
+def loadSectorStore(outputFolder):
+    filepath = os.path.join(outputFolder,STORE_FILENAME)
+    if not(os.path.exists(filepath)):
+        return(None)
+    with np.load(filepath) as f:
+        store = {key:f[key] for key in f.files}
+    store['lookup'] = ps.Index(store['ids'])
+    return(store)
+
+# get the road-bearing sectors of one residence
+# INPUTS:
+#    store (dict) - loaded with loadSectorStore
+#    uniqueId (str) - unique birth id
+# OUTPUTS:
+#    sectors (numpy uint16 array), classMask (numpy uint8 array)
+def getSectors(store,uniqueId):
+    row = store['lookup'].get_loc(str(uniqueId))
+    start, end = store['indptr'][row], store['indptr'][row+1]
+    return(store['sectors'][start:end],store['classMask'][start:end])
+
+# restrict dense wind roses to road-bearing sectors
+# INPUTS:
+#    store (dict) - loaded with loadSectorStore
+#    ids (array-like) - unique birth ids
+#    roses (numpy array) - hours downwind organized by (birth, angle)
+# OUTPUTS:
+#    sparseRoses (dict) - ids, CSR 'indptr', 'sectors', and 'values'
+def getSparseRoses(store,ids,roses):
+    ids = np.asarray(ids).astype(str)
+    rows = store['lookup'].get_indexer(ps.Index(ids))
+    if (rows < 0).any():
+        raise KeyError("ids not found in road sector store: %s" %(str(list(ids[rows < 0][:5]))))
+    starts, ends = store['indptr'][rows], store['indptr'][rows+1]
+    lengths = ends - starts
+    sectorIndex = np.repeat(starts,lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths,lengths)
+    sectors = store['sectors'][sectorIndex]
+    sparseRoses = {
+        'ids':ids,
+        'indptr':np.concatenate([[0],np.cumsum(lengths)]),
+        'sectors':sectors,
+        'values':np.asarray(roses)[np.repeat(np.arange(len(ids)),lengths),sectors]
+    }
+    return(sparseRoses)
+
+
+if __name__ == '__main__':
+    import argparse
+    import gConst as const
+    parser = argparse.ArgumentParser(description="find road-bearing wind sectors for each maternal residence")
+    parser.add_argument('year',type=int,help="birth year")
+    args = parser.parse_args()
+    birthData = ps.read_csv(const.WIND_FOLDER + "Birth_Addresses_Wind/births_by_year/csvs/births_" + str(args.year) + ".csv")
+    segments = readRoadSegments(const.WIND_FOLDER + "roads/" + str(args.year) + "/")
+    store = createSectorStore(birthData,segments)
+    saveSectorStore(store,const.WIND_FOLDER + "roadSectors/" + str(args.year) + "/")
+    print("%i residences, %.1f road-bearing sectors per residence" %(len(store['ids']),len(store['sectors'])/max(len(store['ids']),1)))
@@ -0,0 +1,221 @@
+############### roseGeometry.py #############
+# Developed for HEI Transit Study
+# Summary: vectorized wind rose triangles for batches of maternal residences, saved as one GeoParquet
+#          dataset per birth year instead of one shapefile per residence
+# Layout: roses_<year>/part-<partition>.parquet, one row per (residence, sector) with uniqueid, angle,
+# sum_<year> (hours downwind during pregnancy), and a WKB polygon geometry in lon/lat (OGC:CRS84)
+# Steps include:
+# 1) calculating the 360 points 55km from each residence with the destination point formula, for all
+#    residences at once.  Neighbouring triangles share an edge, so each point is calculated once
+# 2) assembling sector a as the triangle (residence, bearing a+1, bearing a), the same triangles as
+#    residentialWindParallel.calcAnnualShapefile
+# 3) encoding all triangles as WKB with a fixed-size numpy record, without per-triangle python objects
+# 4) writing one parquet file per partition, so interrupted runs resume at the next partition.  Residences
+#    are sorted by uniqueid and written in small row groups, so the roses of one residence are read
+#    without scanning the dataset (see readResidenceRose)
+
+
+############### Setup: import libraries and define constants ##############
+import os
+import json
+import numpy as np
+
+# the following components are used for the Haversine formula.  For more details go to
+# http://www.movable-type.co.uk/scripts/latlong.html
+# https://www.eol.ucar.edu/content/wind-direction-quick-reference
+EARTH_RADIUS = 6378140.0
+DISTANCE = 55000.0/EARTH_RADIUS # angular distance from the residence to the outer edge of the rose
+DEG_TO_RAD = 0.0174533 # same conversion as the original arcpy triangles
+N_ANGLES = 360
+FOLDER_PREFIX = "roses_"
+WKB_POLYGON = 3
+ROW_GROUP_RESIDENCES = 64 # residences per parquet row group
+WKB_TRIANGLE = np.dtype([('byteOrder','u1'),('geomType','<u4'),('nRings','<u4'),('nPoints','<u4'),('coords','<f8',(8,))]) # closed 4 point ring
+
+# pyarrow is only required when roses are written or read
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+
+
+################ Geometry ##############
+
+# calculate points a fixed distance from a set of origins (destination point formula)
+# INPUTS:
+#    lats, lons (numpy arrays) - origin coordinates in degrees, shape (n,1) or broadcastable with bearings
+#    bearings (numpy array) - bearings in radians relative to true north
+#    distance (float) - angular distance (distance / earth radius)
+# OUTPUTS:
+#    newLats, newLons (numpy arrays) - destination coordinates in degrees
+def calcCoords(lats,lons,bearings,distance=DISTANCE):
+    latRadians = np.asarray(lats,np.float64)*DEG_TO_RAD
+    lonRadians = np.asarray(lons,np.float64)*DEG_TO_RAD
+    newLats = np.arcsin(np.sin(latRadians)*np.cos(distance) + np.cos(latRadians)*np.sin(distance)*np.cos(bearings))/DEG_TO_RAD
+    lonP1 = np.sin(bearings)*np.sin(distance)*np.cos(latRadians)
+    lonP2 = np.cos(distance) - np.sin(latRadians)*np.sin(newLats*DEG_TO_RAD)
+    newLons = (lonRadians + np.arctan2(lonP1,lonP2))/DEG_TO_RAD
+    return(newLats,newLons)
+
+# calculate the closed ring of each wind rose triangle.  Sector a spans bearings [a, a+1]
+# INPUTS:
+#    lats, lons (numpy arrays) - residence coordinates in degrees, one per residence
+#    distance (float) - angular distance (distance / earth radius)
+# OUTPUTS:
+#    numpy array organized by (residence, sector, vertex, lon/lat), vertices are residence, bearing a+1,
+#    bearing a, residence
+def calcRoseTriangles(lats,lons,distance=DISTANCE):
+    lats = np.asarray(lats,np.float64).reshape(-1,1)
+    lons = np.asarray(lons,np.float64).reshape(-1,1)
+    bearings = np.arange(N_ANGLES,dtype=np.float64)*DEG_TO_RAD
+    edgeLats, edgeLons = calcCoords(lats,lons,bearings[np.newaxis,:],distance) # (residence, bearing)
+    nextBearing = (np.arange(N_ANGLES) + 1) % N_ANGLES
+    triangles = np.empty((len(lats),N_ANGLES,4,2),np.float64)
+    triangles[:,:,0,0], triangles[:,:,0,1] = lons, lats
+    triangles[:,:,1,0], triangles[:,:,1,1] = edgeLons[:,nextBearing], edgeLats[:,nextBearing]
+    triangles[:,:,2,0], triangles[:,:,2,1] = edgeLons, edgeLats
+    triangles[:,:,3] = triangles[:,:,0]
+    return(triangles)
+
+# encode triangle rings as little endian WKB polygons
+# INPUTS:
+#    rings (numpy array) - organized by (triangle, vertex, lon/lat), see calcRoseTriangles
+# OUTPUTS:
+#    uint8 numpy array of the concatenated WKB records, WKB_TRIANGLE.itemsize bytes per triangle
+def encodeTriangles(rings):
+    records = np.empty(len(rings),WKB_TRIANGLE)
+    records['byteOrder'] = 1
+    records['geomType'] = WKB_POLYGON
+    records['nRings'] = 1
+    records['nPoints'] = 4
+    records['coords'] = np.asarray(rings,np.float64).reshape(len(rings),8)
+    return(records.view(np.uint8))
+
+# convert optional per-residence sector lists into a (residence, sector) mask
+# INPUTS:
+#    sectorLists (list) - one array of road-bearing sectors per residence (see roadSectors.py), or None
+#                         to keep all sectors
+# OUTPUTS:
+#    bool numpy array organized by (residence, sector)
+def getSectorMask(sectorLists):
+    sectorMask = np.ones((len(sectorLists),N_ANGLES),dtype=bool)
+    for index, sectors in enumerate(sectorLists):
+        if sectors is not None:
+            sectorMask[index] = False
+            sectorMask[index,np.asarray(sectors,np.int64)] = True
+    return(sectorMask)
+
+
+
+################ GeoParquet storage ##############
+
+# get the dataset folder for a birth year
+# INPUTS:
+#    outputFolder (str) - parent output folder
+#    year (int) - birth year
+# OUTPUTS:
+#    folder (str)
+def getRoseFolder(outputFolder,year):
+    return(os.path.join(outputFolder,FOLDER_PREFIX + str(year)))
+
+# get the filepath of one partition of a rose dataset
+# INPUTS:
+#    roseFolder (str) - created by getRoseFolder
+#    index (int) - partition index
+# OUTPUTS:
+#    filepath (str)
+def getPartFile(roseFolder,index):
+    return(os.path.join(roseFolder,"part-" + str(index) + ".parquet"))
+
+# create a table of wind rose triangles for a batch of residences, sorted by uniqueid
+# INPUTS:
+#    ids (array-like) - unique id of each residence
+#    lats, lons (array-like) - residence coordinates in degrees
+#    roses (numpy array) - hours downwind organized by (residence, sector)
+#    year (int) - birth year, used to name the sum_<year> column
+#    sectorMask (numpy array) - optional (residence, sector) mask of triangles to keep, see getSectorMask
+# OUTPUTS:
+#    pyarrow table with uniqueid, angle, sum_<year>, and geometry columns
+def createRoseTable(ids,lats,lons,roses,year,sectorMask=None):
+    roses = np.asarray(roses)
+    if sectorMask is None:
+        sectorMask = np.ones(roses.shape,dtype=bool)
+    ids = np.asarray(ids).astype(str)
+    order = np.argsort(ids,kind='stable')
+    ids, roses, sectorMask = ids[order], roses[order], np.asarray(sectorMask)[order]
+    lats, lons = np.asarray(lats,np.float64)[order], np.asarray(lons,np.float64)[order]
+    residences, angles = np.nonzero(sectorMask)
+    rings = calcRoseTriangles(lats,lons)[residences,angles]
+    wkb = encodeTriangles(rings)
+    offsets = np.arange(len(rings)+1,dtype=np.int64)*WKB_TRIANGLE.itemsize # 64-bit, large partitions pass 2GB of WKB
+    geometry = pa.Array.from_buffers(pa.large_binary(),len(rings),[None,pa.py_buffer(offsets),pa.py_buffer(wkb)])
+    geometry.validate(full=True)
+    table = pa.table({
+        'uniqueid':pa.DictionaryArray.from_arrays(residences.astype(np.int32),pa.array(ids,pa.string())),
+        'angle':angles.astype(np.uint16),
+        'sum_' + str(year):np.rint(roses[residences,angles]).astype(np.int32),
+        'geometry':geometry
+    })
+    return(table.replace_schema_metadata({'geo':json.dumps(getGeoMetadata(rings))}))
+
+# create GeoParquet metadata for a set of triangles.  No crs is given, meaning OGC:CRS84 (WGS84 lon/lat)
+# INPUTS:
+#    rings (numpy array) - organized by (triangle, vertex, lon/lat)
+# OUTPUTS:
+#    metadata (dict)
+def getGeoMetadata(rings):
+    geometryMeta = {'encoding':'WKB','geometry_types':['Polygon']}
+    if len(rings) > 0:
+        geometryMeta['bbox'] = [float(rings[...,0].min()),float(rings[...,1].min()),
+            float(rings[...,0].max()),float(rings[...,1].max())]
+    return({'version':'1.0.0','primary_column':'geometry','columns':{'geometry':geometryMeta}})
+
+# save one partition of a rose dataset.  The file is written to a temporary name and moved into place,
+# so partially written partitions are never read
+# INPUTS:
+#    table (pyarrow table) - created by createRoseTable
+#    roseFolder (str) - created by getRoseFolder
+#    index (int) - partition index
+def saveRosePartition(table,roseFolder,index):
+    if not(os.path.exists(roseFolder)):
+        os.makedirs(roseFolder)
+    partFile = getPartFile(roseFolder,index)
+    pq.write_table(table,partFile + ".tmp",row_group_size=ROW_GROUP_RESIDENCES*N_ANGLES)
+    os.replace(partFile + ".tmp",partFile)
+
+# check if a partition of a rose dataset has been saved
+# INPUTS:
+#    roseFolder (str) - created by getRoseFolder
+#    index (int) - partition index
+# OUTPUTS:
+#    bool
+def isPartitionSaved(roseFolder,index):
+    return(os.path.exists(getPartFile(roseFolder,index)))
+
+# open the saved partitions of a rose dataset for reading.  Part footers are read once, so later lookups
+# only read the row groups that can hold the requested residence
+# INPUTS:
+#    roseFolder (str) - created by getRoseFolder
+# OUTPUTS:
+#    pyarrow dataset
+def openRoseDataset(roseFolder):
+    if not PYARROW_AVAILABLE:
+        raise RuntimeError("reading GeoParquet roses requires pyarrow")
+    partFiles = sorted(os.path.join(roseFolder,filename) for filename in os.listdir(roseFolder) if filename.endswith(".parquet"))
+    return(ds.dataset(partFiles,format='parquet'))
+
+# read the sectors and hours downwind of one residence from a rose dataset
+# INPUTS:
+#    roseDataset (pyarrow dataset) - created by openRoseDataset
+#    year (int) - birth year, names the sum_<year> column
+#    uniqueId (str) - unique id of the residence
+# OUTPUTS:
+#    angles, sums (numpy arrays) - sector and hours downwind of each triangle, empty if the residence has
+#                                  no roses
+def readResidenceRose(roseDataset,year,uniqueId):
+    table = roseDataset.to_table(columns=['angle','sum_' + str(year)],filter=ds.field('uniqueid') == str(uniqueId))
+    return(table.column('angle').to_numpy().astype(np.int64),table.column('sum_' + str(year)).to_numpy())
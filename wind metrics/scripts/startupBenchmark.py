@@ -0,0 +1,117 @@
+############### startupBenchmark.py #############
+# Developed for HEI Transit Study
+# Summary: measure how long the pipeline scripts take to import and how long a pool of spawned workers
+#          takes to start with each script imported.  Workers are spawned, as on Windows, so every
+#          worker re-imports the script that created the pool.  Scripts should import in well under a
+#          second: birth records, arcpy, and other heavy resources are loaded on first use
+# Steps include:
+# 1) importing each script in a fresh interpreter, repeated to report the median
+# 2) starting a spawned pool whose workers import the script, and waiting until every worker is ready
+# 3) comparing against a pool whose workers import nothing
+
+
+############### Setup: import libraries and define constants ##############
+import os
+import sys
+import time
+import argparse
+import importlib
+import subprocess
+import multiprocessing
+
+REPO_FOLDER = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)),"..",".."))
+SCRIPTS = [
+    ("wind metrics/scripts","residentialWindParallel"),
+    ("wind metrics/scripts","createWindMarix"),
+    ("wind metrics/scripts","partitionWindByYear"),
+    ("building and tree shielding/scripts","shieldingScript"),
+    ("building and tree shielding/scripts","calcBufferAvgs"),
+    ("matching/scripts","deriveMatchParallel")
+]
+IMPORT_CODE = "import sys,time,importlib; sys.path.insert(0,'.'); start=time.perf_counter(); importlib.import_module('%s'); print(time.perf_counter()-start)"
+N_WORKERS = 8
+N_REPEATS = 3
+
+
+
+################ Helper functions ##############
+
+# time importing one script in a fresh interpreter
+# INPUTS:
+#    folder (str) - script folder, relative to the repository
+#    module (str) - script name without the .py extension
+#    nRepeats (int) - number of fresh interpreters
+# OUTPUTS:
+#    median import time in seconds (float), or the error message (str) if the import failed
+def timeImport(folder,module,nRepeats=N_REPEATS):
+    times = []
+    for repeat in range(nRepeats):
+        result = subprocess.run([sys.executable,"-c",IMPORT_CODE %(module)],cwd=os.path.join(REPO_FOLDER,folder),
+            capture_output=True,text=True,timeout=600)
+        if result.returncode != 0:
+            return(result.stderr.strip().split("\n")[-1])
+        times.append(float(result.stdout.strip().split("\n")[-1]))
+    return(sorted(times)[len(times)//2])
+
+# pool initializer.  Imports a script and reports when the worker is ready
+# INPUTS:
+#    folder (str) - absolute script folder, or None to import nothing
+#    module (str) - script name
+#    readyQueue (multiprocessing Queue) - receives None when ready, or the error message
+def initWorker(folder,module,readyQueue):
+    try:
+        if folder is not None:
+            sys.path.insert(0,folder)
+            importlib.import_module(module)
+        readyQueue.put(None)
+    except Exception as e:
+        readyQueue.put("%s: %s" %(type(e).__name__,str(e)))
+
+# time starting a spawned pool whose workers import one script
+# INPUTS:
+#    folder (str) - script folder relative to the repository, or None to import nothing
+#    module (str) - script name
+#    nWorkers (int) - number of pool workers
+# OUTPUTS:
+#    seconds until all workers are ready (float), or the error message (str) if a worker failed
+def timePoolStartup(folder,module,nWorkers=N_WORKERS):
+    context = multiprocessing.get_context('spawn')
+    readyQueue = context.Queue()
+    scriptFolder = None if folder is None else os.path.join(REPO_FOLDER,folder)
+    start = time.perf_counter()
+    pool = context.Pool(processes=nWorkers,initializer=initWorker,initargs=(scriptFolder,module,readyQueue))
+    try:
+        for worker in range(nWorkers):
+            message = readyQueue.get(timeout=600)
+            if message is not None:
+                return(message)
+        return(time.perf_counter() - start)
+    finally:
+        pool.terminate()
+        pool.join()
+
+# format a time or error message for printing
+# INPUTS:
+#    value (float or str) - created by timeImport or timePoolStartup
+# OUTPUTS:
+#    str
+def formatResult(value):
+    if isinstance(value,str):
+        return("failed (" + value + ")")
+    return("%.3fs" %(value))
+
+
+
+################# Main function ######################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="measure script import and pool worker startup times")
+    parser.add_argument('--workers',type=int,default=N_WORKERS,help="pool workers to start per script")
+    parser.add_argument('--repeats',type=int,default=N_REPEATS,help="fresh interpreters per import timing")
+    args = parser.parse_args()
+
+    print("pool of %i workers, no script imported: %s" %(args.workers,formatResult(timePoolStartup(None,None,args.workers))))
+    for folder, module in SCRIPTS:
+        importTime = timeImport(folder,module,args.repeats)
+        poolTime = timePoolStartup(folder,module,args.workers) if not isinstance(importTime,str) else importTime
+        print("%s: import %s, pool startup %s" %(module,formatResult(importTime),formatResult(poolTime)))
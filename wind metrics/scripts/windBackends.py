@@ -0,0 +1,715 @@
+############### windBackends.py #############
+# Developed for HEI Transit Study
+# Summary: interchangeable compute backends for the wind matrix stage (createWindMatrix.py)
+# Each backend performs the same two operations as the original GPU implementation:
+# 1) rearrange long-format hourly wind records into a matrix organized by hour, day, month, and unique id
+# 2) calculate the daily number of hours each of 360 radial degrees is downwind of each maternal residence
+# The cpu backends bin each day's hourly wind directions into a 360 degree histogram and derive the
+# +/- 15 degree window count for every radial degree from a circular prefix sum, O(360) per day instead
+# of the O(24*360) pairwise comparisons used by the cuda kernel
+# Available backends:
+#    cuda  - numba cuda kernels.  Requires an NVIDIA GPU (original implementation)
+#    numba - numba cpu kernels, parallelized across all cores with prange
+#    numpy - pure numpy implementation, parallelized across all cores with a thread pool
+# All backends produce bit-identical output, including the -999 handling for missing hours
+# For sensitivity analyses, calcWindMatrixMulti evaluates several downwind kernels (angular window and
+# hours of the day) in one pass over the hourly data, adding a leading kernel axis to the output
+
+
+############### Setup: import libraries and define constants ##############
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+N_ANGLES = 360
+N_HOURS = 24
+N_MONTHS = 24 # months in 2 years, one of the dimensions of the output wind matrix
+N_DAYS = 31 # max days in month, one of the dimensions of the output wind matrix
+MISSING = -999 # sentinel for missing wind direction and for days with missing hours
+DOWNWIND_WINDOW = 15 # radial degree is downwind if it is within +/- 15 degrees of the wind direction
+STATIONS_PER_CHUNK = 32 # number of maternal residences processed by a cpu thread at a time
+MAX_KERNELS = 16 # largest number of downwind kernels evaluated in one pass
+
+# numba is optional.  The numpy backend is always available
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+################ Helper functions ##############
+
+# get number of cpu cores available to the current process
+# OUTPUTS:
+#    number of cores (int)
+def getNumCores():
+    try:
+        return(len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return(os.cpu_count() or 1)
+
+# test if an nvidia gpu can be used through numba
+# OUTPUTS:
+#    True if the cuda backend can be used, False otherwise
+def isCudaAvailable():
+    if not NUMBA_AVAILABLE:
+        return(False)
+    try:
+        from numba import cuda
+        return(cuda.is_available())
+    except Exception:
+        return(False)
+
+# create a lookup table equivalent to the isDownwind function in the cuda kernel.
+# Row index is the wind direction, column index is the radial degree
+# INPUTS:
+#    maxWind (int) - largest wind direction in the dataset (360 for ERA5 derived directions)
+# OUTPUTS:
+#    table (numpy array) - 1 if radial degree is downwind of the wind direction, 0 otherwise
+def createDownwindTable(maxWind=N_ANGLES):
+    angles = np.arange(N_ANGLES,dtype=np.int32)[np.newaxis,:]
+    wind = np.arange(max(maxWind,N_ANGLES)+1,dtype=np.int32)[:,np.newaxis]
+    diff1 = np.where(angles - wind > 0, angles - wind, angles - wind + 360)
+    diff2 = np.where(wind - angles > 0, wind - angles, wind - angles + 360)
+    table = (np.minimum(diff1,diff2) < DOWNWIND_WINDOW).astype(np.int16)
+    return(table)
+
+# number of whole degrees on either side of the wind direction that are downwind.  Matches the
+# strict less-than test used by isDownwind (e.g. a 15 degree window covers differences of 1 to 14 degrees)
+# INPUTS:
+#    maxDiff (float) - angular window, in degrees
+# OUTPUTS:
+#    halfWindow (int) - largest integer angular difference that is downwind
+def getHalfWindow(maxDiff=DOWNWIND_WINDOW):
+    if maxDiff <= 0 or maxDiff > 180:
+        raise ValueError("downwind window must be in (0,180] degrees: %s" %(str(maxDiff)))
+    return(int(math.ceil(maxDiff)) - 1)
+
+# split the maternal residences in a batch into chunks that can be processed by independent threads
+# INPUTS:
+#    nBirths (int) - number of maternal residences in the batch
+# OUTPUTS:
+#    list of slices, one for each chunk
+def createStationChunks(nBirths):
+    return([slice(start,min(start+STATIONS_PER_CHUNK,nBirths)) for start in range(0,nBirths,STATIONS_PER_CHUNK)])
+
+# define a downwind kernel: the angular window and the hours of the day that are counted
+# INPUTS:
+#    name (str) - label for the kernel, used to name output folders
+#    maxDiff (float) - angular window in degrees (see getHalfWindow)
+#    hourMask (array-like) - 24 booleans, True for hours of the hourly records (UTC for ERA5) that are counted.
+#                            All hours by default
+# OUTPUTS:
+#    kernel (dict) - name, maxDiff, halfWindow, and hourMask
+def createKernel(name,maxDiff=DOWNWIND_WINDOW,hourMask=None):
+    hourMask = np.ones(N_HOURS,bool) if hourMask is None else np.asarray(hourMask,bool)
+    if hourMask.shape != (N_HOURS,):
+        raise ValueError("hour mask must have %i values" %(N_HOURS))
+    kernel = {
+        'name':name,
+        'maxDiff':float(maxDiff),
+        'halfWindow':getHalfWindow(maxDiff),
+        'hourMask':hourMask
+    }
+    return(kernel)
+
+# create an hour mask for a range of local hours
+# INPUTS:
+#    startHour (int) - first local hour included (0-23)
+#    endHour (int) - local hour where the range ends, exclusive (1-24).  Ranges may wrap past midnight (e.g. 19-7)
+#    utcOffset (int) - local time minus UTC, in hours (-6 for central standard time)
+# OUTPUTS:
+#    numpy bool array, one value per UTC hour
+def localHourMask(startHour,endHour,utcOffset):
+    localHours = (np.arange(N_HOURS) + utcOffset) % N_HOURS
+    if startHour <= endHour:
+        return((localHours >= startHour) & (localHours < endHour))
+    return((localHours >= startHour) | (localHours < endHour))
+
+# check that a set of kernels can be evaluated in one pass
+# INPUTS:
+#    kernels (list) - kernels created by createKernel
+def validateKernels(kernels):
+    if len(kernels) == 0 or len(kernels) > MAX_KERNELS:
+        raise ValueError("between 1 and %i downwind kernels can be evaluated at once" %(MAX_KERNELS))
+    names = [kernel['name'] for kernel in kernels]
+    if len(set(names)) != len(names):
+        raise ValueError("downwind kernel names must be unique: %s" %(str(names)))
+
+
+
+################ numpy backend ##############
+
+# rearrange data so hourly records in the matrix are organized by:
+#      matrix[hourIndex][dayIndex][monthIndex][uniqueIdIndex]
+# INPUTS:
+#    idList (numpy array) - indeces for unique ids
+#    hour (numpy arrray) - hour of the wind direction measures
+#    day (numpy array) - day of the wind direction measures
+#    month (numpy array) - month of the wind direction measures
+#    wnd_dir (numpy array) - wind direction measures
+#    nBirths (int) - number of unique ids in the batch
+# OUTPUTS:
+#    outData (numpy array) - reorganized wind direction measures, missing values are -999
+def rearrangeDataNumpy(idList,hour,day,month,wnd_dir,nBirths):
+    outData = np.full((N_HOURS,N_DAYS,N_MONTHS,nBirths),MISSING,np.int16)
+    outData[np.asarray(hour),np.asarray(day)-1,np.asarray(month)-1,np.asarray(idList)] = np.asarray(wnd_dir)
+    return(outData)
+
+# calculate number of hours each radial degree is downwind for a chunk of maternal residences by
+# comparing every hour to every radial degree.  Hours are processed in the same order as the cuda kernel
+# so that a missing hour resets the count to -999 exactly as it does on the GPU.  Only used when wind
+# directions fall outside of [0,360], where the histogram algorithm does not apply
+# INPUTS:
+#    inputData (numpy array) - hourly wind direction matrix for the chunk (hour, day, month, id)
+#    table (numpy array) - downwind lookup table created by createDownwindTable
+# OUTPUTS:
+#    hoursDownwind (numpy array) - hours downwind organized by (id, month, day, angle)
+def calcDailyDownwindChunk(inputData,table):
+    nStations = inputData.shape[3]
+    hoursDownwind = np.zeros((nStations,N_MONTHS,N_DAYS,N_ANGLES),np.int16)
+    for hourIndex in range(N_HOURS):
+        wndAngle = inputData[hourIndex].transpose(2,1,0) # (id, month, day)
+        isValid = wndAngle >= 0
+        hoursDownwind += np.take(table,np.where(isValid,wndAngle,0),axis=0)
+        hoursDownwind[~isValid] = MISSING
+    return(hoursDownwind)
+
+# bin the hourly wind directions of each day into a histogram with one bin per degree (0-360).
+# In the cuda kernel a missing hour resets the daily count to -999 and later hours are added to -999,
+# so only hours after the last missing hour of the day are binned
+# INPUTS:
+#    hourly (numpy array) - wind directions organized by (day, hour), missing values are negative
+#    hourMask (numpy array) - optional, True for hours that are counted.  Other hours are ignored,
+#                             including when they are missing
+# OUTPUTS:
+#    hist (numpy array) - hourly counts organized by (day, wind direction), 361 bins
+#    hasMissing (numpy array) - True for days with at least one missing hour
+def calcDailyHistograms(hourly,hourMask=None):
+    nDays, nHours = hourly.shape
+    isCounted = np.ones(nHours,bool) if hourMask is None else np.asarray(hourMask,bool)
+    isMissing = (hourly < 0) & isCounted
+    hasMissing = isMissing.any(axis=1)
+    lastMissing = np.where(hasMissing,nHours - 1 - np.argmax(isMissing[:,::-1],axis=1),-1)
+    isIncluded = (np.arange(nHours)[np.newaxis,:] > lastMissing[:,np.newaxis]) & isCounted
+    dayIndex = np.broadcast_to(np.arange(nDays)[:,np.newaxis],hourly.shape)
+    binIndex = dayIndex[isIncluded]*(N_ANGLES+1) + hourly[isIncluded]
+    hist = np.bincount(binIndex,minlength=nDays*(N_ANGLES+1)).reshape(nDays,N_ANGLES+1)
+    return(hist,hasMissing)
+
+# given histograms of wind directions, calculate the number of hours each radial degree is downwind
+# using a circular prefix sum over the histogram.  Equivalent to summing isDownwind over all hours:
+# a direction of 360 is treated as 0, except that isDownwind also counts it for radial degree 0
+# INPUTS:
+#    hist (numpy array) - wind direction counts, last axis has 361 bins (0-360 degrees)
+#    halfWindow (int) - largest angular difference that is downwind (see getHalfWindow)
+#    dtype (numpy dtype) - integer type of the result.  int16 is enough for daily histograms (at most
+#                          24 hours), multi-day histograms need a wider type
+# OUTPUTS:
+#    number of hours downwind (numpy array), last axis has 360 radial degrees
+def histogramToDownwind(hist,halfWindow,dtype=np.int16):
+    combined = hist[...,:N_ANGLES].astype(dtype)
+    combined[...,0] += hist[...,N_ANGLES]
+
+    # circular extension of the histogram, preceded by a zero so that the prefix sum starts at 0
+    cumulative = np.empty(combined.shape[:-1] + (N_ANGLES+2*halfWindow+1,),dtype)
+    cumulative[...,0] = 0
+    cumulative[...,1:halfWindow+1] = combined[...,N_ANGLES-halfWindow:]
+    cumulative[...,halfWindow+1:halfWindow+N_ANGLES+1] = combined
+    cumulative[...,halfWindow+N_ANGLES+1:] = combined[...,:halfWindow]
+    np.cumsum(cumulative,axis=-1,out=cumulative)
+    windowSum = cumulative[...,2*halfWindow+1:] - cumulative[...,:N_ANGLES]
+
+    # isDownwind does not count a radial degree that exactly matches the wind direction
+    windowSum -= hist[...,:N_ANGLES].astype(dtype)
+    return(windowSum)
+
+# calculate number of hours each radial degree is downwind for a chunk of maternal residences using
+# daily wind direction histograms and circular prefix sums
+# INPUTS:
+#    inputData (numpy array) - hourly wind direction matrix for the chunk (hour, day, month, id)
+#    halfWindow (int) - largest angular difference that is downwind (see getHalfWindow)
+# OUTPUTS:
+#    hoursDownwind (numpy array) - hours downwind organized by (id, month, day, angle)
+def calcDailyDownwindHistogramChunk(inputData,halfWindow):
+    nStations = inputData.shape[3]
+    hourly = inputData.transpose(3,2,1,0).reshape(-1,N_HOURS) # (id*month*day, hour)
+    hist, hasMissing = calcDailyHistograms(hourly)
+    hoursDownwind = histogramToDownwind(hist,halfWindow)
+    hoursDownwind[hasMissing] += MISSING
+    return(hoursDownwind.reshape(nStations,N_MONTHS,N_DAYS,N_ANGLES))
+
+# calculate number of hours each radial degree is upwind of each maternal residence, for each day.
+# Chunks of maternal residences are processed in parallel threads (numpy releases the GIL)
+# INPUTS:
+#    inputData (numpy array) - hourly wind direction matrix (hour, day, month, id)
+# OUTPUTS:
+#    outputData (numpy array) - hours downwind organized by (id, month, day, angle)
+def calcDailyDownwindNumpy(inputData):
+    nBirths = inputData.shape[3]
+    outputData = np.empty((nBirths,N_MONTHS,N_DAYS,N_ANGLES),np.float64)
+    maxWind = int(inputData.max()) if inputData.size > 0 else N_ANGLES
+    if maxWind <= N_ANGLES:
+        halfWindow = getHalfWindow()
+        calcChunk = lambda chunkData: calcDailyDownwindHistogramChunk(chunkData,halfWindow)
+    else:
+        table = createDownwindTable(maxWind)
+        calcChunk = lambda chunkData: calcDailyDownwindChunk(chunkData,table)
+
+    def processChunk(chunk):
+        outputData[chunk] = calcChunk(inputData[:,:,:,chunk])
+
+    with ThreadPoolExecutor(max_workers=getNumCores()) as executor:
+        list(executor.map(processChunk,createStationChunks(nBirths)))
+    return(outputData)
+
+# rearrange hourly records and calculate hours downwind using numpy
+# INPUTS:
+#    idList, hour, day, month, wnd_dir (numpy arrays) - long-format hourly wind records
+#    nBirths (int) - number of unique ids in the batch
+# OUTPUTS:
+#    hours downwind organized by (id, month, day, angle)
+def calcWindMatrixNumpy(idList,hour,day,month,wnd_dir,nBirths):
+    hourlyData = rearrangeDataNumpy(idList,hour,day,month,wnd_dir,nBirths)
+    return(calcDailyDownwindNumpy(hourlyData))
+
+# calculate hours downwind for several kernels for a chunk of maternal residences.  Days are read and
+# binned once per distinct hour mask, and each kernel's window sum is derived from the shared histograms
+# INPUTS:
+#    inputData (numpy array) - hourly wind direction matrix for the chunk (hour, day, month, id), values <= 360
+#    kernels (list) - kernels created by createKernel
+# OUTPUTS:
+#    hoursDownwind (numpy array) - hours downwind organized by (kernel, id, month, day, angle)
+def calcDailyDownwindMultiChunk(inputData,kernels):
+    nStations = inputData.shape[3]
+    hourly = inputData.transpose(3,2,1,0).reshape(-1,N_HOURS) # (id*month*day, hour)
+    hoursDownwind = np.empty((len(kernels),hourly.shape[0],N_ANGLES),np.int16)
+    histograms = {}
+    for kernelIndex, kernel in enumerate(kernels):
+        maskKey = kernel['hourMask'].tobytes()
+        if maskKey not in histograms:
+            histograms[maskKey] = calcDailyHistograms(hourly,kernel['hourMask'])
+        hist, hasMissing = histograms[maskKey]
+        hoursDownwind[kernelIndex] = histogramToDownwind(hist,kernel['halfWindow'])
+        hoursDownwind[kernelIndex][hasMissing] += MISSING
+    return(hoursDownwind.reshape(len(kernels),nStations,N_MONTHS,N_DAYS,N_ANGLES))
+
+# calculate hours downwind for several kernels in one pass, with chunks of maternal residences
+# processed in parallel threads
+# INPUTS:
+#    inputData (numpy array) - hourly wind direction matrix (hour, day, month, id)
+#    kernels (list) - kernels created by createKernel
+# OUTPUTS:
+#    outputData (numpy array) - hours downwind organized by (kernel, id, month, day, angle)
+def calcDailyDownwindMultiNumpy(inputData,kernels):
+    nBirths = inputData.shape[3]
+    if inputData.size > 0 and inputData.max() > N_ANGLES:
+        raise ValueError("wind directions must be in [0,360] to evaluate multiple downwind kernels")
+    outputData = np.empty((len(kernels),nBirths,N_MONTHS,N_DAYS,N_ANGLES),np.float64)
+
+    def processChunk(chunk):
+        outputData[:,chunk] = calcDailyDownwindMultiChunk(inputData[:,:,:,chunk],kernels)
+
+    with ThreadPoolExecutor(max_workers=getNumCores()) as executor:
+        list(executor.map(processChunk,createStationChunks(nBirths)))
+    return(outputData)
+
+# rearrange hourly records and calculate hours downwind for several kernels using numpy
+# INPUTS:
+#    idList, hour, day, month, wnd_dir (numpy arrays) - long-format hourly wind records
+#    nBirths (int) - number of unique ids in the batch
+#    kernels (list) - kernels created by createKernel
+# OUTPUTS:
+#    hours downwind organized by (kernel, id, month, day, angle)
+def calcWindMatrixMultiNumpy(idList,hour,day,month,wnd_dir,nBirths,kernels):
+    hourlyData = rearrangeDataNumpy(idList,hour,day,month,wnd_dir,nBirths)
+    return(calcDailyDownwindMultiNumpy(hourlyData,kernels))
+
+
+
+################ numba cpu backend ##############
+
+if NUMBA_AVAILABLE:
+
+    # cpu version of the isDownwind function in the cuda kernel.
+    # INPUTS:
+    #    val1 (int) - radial degree
+    #    val2 (int) - wind direction
+    # OUTPUTS:
+    #     1 if radial degree is within 15 degrees of wind direction. 0 otherwise.
+    @numba.njit(cache=True)
+    def isDownwindCpu(val1,val2):
+        diff1 = val1 - val2 if val1-val2 > 0 else (val1-val2 + 360)
+        diff2 = val2 - val1 if val2-val1 >0 else (val2 - val1 + 360)
+        minDiff = min(diff1,diff2)
+        if(minDiff < DOWNWIND_WINDOW):
+            return 1
+        return 0
+
+    # cpu version of calcDailyDownwind.  Each maternal residence is assigned to a core with prange
+    # INPUTS:
+    #    inputData (numpy array) - hourly wind direction matrix (hour, day, month, id)
+    #    outputData (numpy array) - where results are stored in place (id, month, day, angle)
+    @numba.njit(parallel=True,cache=True)
+    def calcDailyDownwindCpu(inputData,outputData):
+        for station in numba.prange(inputData.shape[3]):
+            for month in range(N_MONTHS):
+                for day in range(N_DAYS):
+                    for angle in range(N_ANGLES):
+                        hoursDownwind = 0
+                        for hourIndex in range(N_HOURS):
+                            wndAngle = inputData[hourIndex,day,month,station]
+                            if(wndAngle>=0):
+                                hoursDownwind += isDownwindCpu(angle,wndAngle)
+                            else:
+                                hoursDownwind = -999
+                        outputData[station,month,day,angle] = hoursDownwind
+
+    # cpu version of the histogram algorithm.  For each day, hourly wind directions after the last
+    # missing hour are binned into a 361 bin histogram and the hours downwind of every radial degree
+    # are derived from a circular prefix sum of the histogram
+    # INPUTS:
+    #    inputData (numpy array) - hourly wind direction matrix (hour, day, month, id), values <= 360
+    #    outputData (numpy array) - where results are stored in place (id, month, day, angle)
+    #    halfWindow (int) - largest angular difference that is downwind (see getHalfWindow)
+    @numba.njit(parallel=True,cache=True)
+    def calcDailyDownwindHistogramCpu(inputData,outputData,halfWindow):
+        for station in numba.prange(inputData.shape[3]):
+            hist = np.zeros(N_ANGLES+1,np.int32)
+            cumulative = np.zeros(N_ANGLES+2*halfWindow+1,np.int32)
+            for month in range(N_MONTHS):
+                for day in range(N_DAYS):
+                    hist[:] = 0
+                    offset = 0
+                    for hourIndex in range(N_HOURS):
+                        wndAngle = inputData[hourIndex,day,month,station]
+                        if(wndAngle>=0):
+                            hist[wndAngle] += 1
+                        else:
+                            hist[:] = 0
+                            offset = -999
+                    center = hist[0]
+                    hist[0] += hist[N_ANGLES]
+                    for binIndex in range(N_ANGLES+2*halfWindow):
+                        cumulative[binIndex+1] = cumulative[binIndex] + hist[(binIndex-halfWindow)%N_ANGLES]
+                    hist[0] = center
+                    for angle in range(N_ANGLES):
+                        windowSum = cumulative[angle+2*halfWindow+1] - cumulative[angle]
+                        outputData[station,month,day,angle] = offset + windowSum - hist[angle]
+
+    # cpu version of the histogram algorithm for several kernels.  Each day's hourly wind directions are
+    # read once, then binned and summed for each kernel's hour mask and angular window
+    # INPUTS:
+    #    inputData (numpy array) - hourly wind direction matrix (hour, day, month, id), values <= 360
+    #    outputData (numpy array) - where results are stored in place (kernel, id, month, day, angle)
+    #    halfWindows (numpy array) - largest angular difference that is downwind, for each kernel
+    #    hourMasks (numpy array) - hours counted by each kernel (kernel, hour)
+    @numba.njit(parallel=True,cache=True)
+    def calcDailyDownwindMultiCpu(inputData,outputData,halfWindows,hourMasks):
+        nKernels = halfWindows.shape[0]
+        maxHalfWindow = halfWindows.max()
+        for station in numba.prange(inputData.shape[3]):
+            hourly = np.zeros(N_HOURS,np.int32)
+            hist = np.zeros(N_ANGLES+1,np.int32)
+            cumulative = np.zeros(N_ANGLES+2*maxHalfWindow+1,np.int32)
+            for month in range(N_MONTHS):
+                for day in range(N_DAYS):
+                    for hourIndex in range(N_HOURS):
+                        hourly[hourIndex] = inputData[hourIndex,day,month,station]
+                    for kernelIndex in range(nKernels):
+                        halfWindow = halfWindows[kernelIndex]
+                        hist[:] = 0
+                        offset = 0
+                        for hourIndex in range(N_HOURS):
+                            if hourMasks[kernelIndex,hourIndex]:
+                                if(hourly[hourIndex]>=0):
+                                    hist[hourly[hourIndex]] += 1
+                                else:
+                                    hist[:] = 0
+                                    offset = -999
+                        center = hist[0]
+                        hist[0] += hist[N_ANGLES]
+                        for binIndex in range(N_ANGLES+2*halfWindow):
+                            cumulative[binIndex+1] = cumulative[binIndex] + hist[(binIndex-halfWindow)%N_ANGLES]
+                        hist[0] = center
+                        for angle in range(N_ANGLES):
+                            windowSum = cumulative[angle+2*halfWindow+1] - cumulative[angle]
+                            outputData[kernelIndex,station,month,day,angle] = offset + windowSum - hist[angle]
+
+# rearrange hourly records and calculate hours downwind using numba compiled cpu kernels
+# INPUTS:
+#    idList, hour, day, month, wnd_dir (numpy arrays) - long-format hourly wind records
+#    nBirths (int) - number of unique ids in the batch
+# OUTPUTS:
+#    hours downwind organized by (id, month, day, angle)
+def calcWindMatrixNumba(idList,hour,day,month,wnd_dir,nBirths):
+    hourlyData = rearrangeDataNumpy(idList,hour,day,month,wnd_dir,nBirths)
+    outputData = np.full((nBirths,N_MONTHS,N_DAYS,N_ANGLES),MISSING,np.float64)
+    if hourlyData.size == 0 or hourlyData.max() <= N_ANGLES:
+        calcDailyDownwindHistogramCpu(hourlyData,outputData,getHalfWindow())
+    else:
+        calcDailyDownwindCpu(hourlyData,outputData)
+    return(outputData)
+
+# rearrange hourly records and calculate hours downwind for several kernels using numba compiled cpu kernels
+# INPUTS:
+#    idList, hour, day, month, wnd_dir (numpy arrays) - long-format hourly wind records
+#    nBirths (int) - number of unique ids in the batch
+#    kernels (list) - kernels created by createKernel
+# OUTPUTS:
+#    hours downwind organized by (kernel, id, month, day, angle)
+def calcWindMatrixMultiNumba(idList,hour,day,month,wnd_dir,nBirths,kernels):
+    hourlyData = rearrangeDataNumpy(idList,hour,day,month,wnd_dir,nBirths)
+    if hourlyData.size > 0 and hourlyData.max() > N_ANGLES:
+        raise ValueError("wind directions must be in [0,360] to evaluate multiple downwind kernels")
+    outputData = np.full((len(kernels),nBirths,N_MONTHS,N_DAYS,N_ANGLES),MISSING,np.float64)
+    halfWindows = np.array([kernel['halfWindow'] for kernel in kernels],np.int32)
+    hourMasks = np.array([kernel['hourMask'] for kernel in kernels],np.bool_)
+    calcDailyDownwindMultiCpu(hourlyData,outputData,halfWindows,hourMasks)
+    return(outputData)
+
+
+
+################### cuda backend #####################
+# cuda functions.  Must be compiled before runtime (@cuda.jit decorator).
+# Only defined when numba can be imported so that this module loads on GPU-less nodes
+
+thread_x_dim = math.ceil(360/128)*128 # number of threads per streaming multiprocessor
+thread_dim = (thread_x_dim,1) # cuda requires 2d tuple
+
+if NUMBA_AVAILABLE:
+    from numba import cuda
+
+    # rearrange data so hourly records in the matrix are organized by:
+    #      matrix[hourIndex][dayIndex][monthIndex][uniqueIdIndex]
+    # INPUTS:
+    #    idList (numpy array) - indeces for unique ids
+    #    hour (numpy arrray) - hour of the wind direction measures
+    #    day (numpy array) - day of the wind direction measures
+    #    month (numpy array) - month of the wind direction measures
+    #    wind_dir (numpy array) - wind direction measures
+    #    outData (numpy array) - stores reorganized wind direction measures
+    #    maxThread (int) - number of wind direction measures
+    @cuda.jit
+    def rearrangeData(idList,hour,day,month,wnd_dir,outData,maxThread):
+        tid = cuda.blockIdx.x*cuda.blockDim.x + cuda.threadIdx.x
+        if(tid < maxThread):
+            outData[hour[tid],day[tid]-1,month[tid]-1,idList[tid]] = wnd_dir[tid]
+
+    # calculate number of hours each radial degree is upwind of the maternal residence
+    # results are stored in place in the output dataset
+    # INPUTS:
+    #    inputData (numpy array) - hourly wnd direction matrix
+    #    outputData (numpy array) - where results are stored in place
+    @cuda.jit
+    def calcDailyDownwind(inputData,outputData):
+
+        # inline function.  Must be within compiled function so it can be sent to the
+        # GPU driver and implemented by each streaming multiprocessor at runtime
+        # test if a radial degree is within the +/- 15 degree angular window for being downwind
+        # INPUTS:
+        #    val1 (int) - radial degree
+        #    val2 (int) - wind direction
+        # OUTPUTS:
+        #     True if radial degree is within 15 degrees of wind direction. False otherwise.
+        def isDownwind(val1,val2):
+            diff1 = val1 - val2 if val1-val2 > 0 else (val1-val2 + 360)
+            diff2 = val2 - val1 if val2-val1 >0 else (val2 - val1 + 360)
+            minDiff = min(diff1,diff2)
+            if(minDiff < 15):
+                return 1
+            return 0
+
+        # each of the 360 degrees is assigned a unique thread id along the x axis of the cuda block
+        angle = cuda.threadIdx.x
+
+        # cuda has thousands of threads per sm along the x axis.  No need to go beyond 360
+        if(angle >= 360):
+            return
+
+        # important that these dimensions/indeces match those assigned in the funtion 'rearrange data'
+        day = cuda.blockIdx.y
+        month = cuda.blockIdx.x
+        station = cuda.blockIdx.z
+
+        # for each hour in 24 hours of a day, test if the current radial degree is downwind of the wind direction
+        # add to the hours downwind if yes, do not change hoursDownwind otherwise
+        hoursDownwind = 0
+        for hourIndex in range(24):
+            wndAngle = inputData[hourIndex,day,month,station]
+            if(wndAngle>=0):
+                hoursDownwind += isDownwind(angle,wndAngle)
+            else:
+                hoursDownwind = -999
+
+        # WARNING: IT IS ESSENTIAL THAT EACH THREAD HAS GUARANTEED EXCLUSIVE ACCESS TO IT's INDEX IN THE
+        # outputData matrix.  One thread, one index exactly.
+
+        # update the output dataset in place
+        outputData[station,month,day,angle] = hoursDownwind
+
+    # calculate hours downwind for several kernels in one pass.  Each thread reads the 24 hourly wind
+    # directions of its day once and updates one accumulator per kernel
+    # INPUTS:
+    #    inputData (numpy array) - hourly wnd direction matrix
+    #    outputData (numpy array) - where results are stored in place (kernel, id, month, day, angle)
+    #    maxDiffs (numpy array) - angular window of each kernel, in degrees
+    #    hourMasks (numpy array) - hours counted by each kernel (kernel, hour)
+    @cuda.jit
+    def calcDailyDownwindMulti(inputData,outputData,maxDiffs,hourMasks):
+
+        # same test as isDownwind in calcDailyDownwind, with the angular window as a parameter
+        def isDownwindWindow(val1,val2,maxDiff):
+            diff1 = val1 - val2 if val1-val2 > 0 else (val1-val2 + 360)
+            diff2 = val2 - val1 if val2-val1 >0 else (val2 - val1 + 360)
+            minDiff = min(diff1,diff2)
+            if(minDiff < maxDiff):
+                return 1
+            return 0
+
+        angle = cuda.threadIdx.x
+        if(angle >= 360):
+            return
+        day = cuda.blockIdx.y
+        month = cuda.blockIdx.x
+        station = cuda.blockIdx.z
+        nKernels = maxDiffs.shape[0]
+
+        hoursDownwind = cuda.local.array(MAX_KERNELS,numba.int32)
+        for kernelIndex in range(nKernels):
+            hoursDownwind[kernelIndex] = 0
+        for hourIndex in range(24):
+            wndAngle = inputData[hourIndex,day,month,station]
+            for kernelIndex in range(nKernels):
+                if hourMasks[kernelIndex,hourIndex]:
+                    if(wndAngle>=0):
+                        hoursDownwind[kernelIndex] += isDownwindWindow(angle,wndAngle,maxDiffs[kernelIndex])
+                    else:
+                        hoursDownwind[kernelIndex] = -999
+
+        # one thread, one (month, day, station, angle) index for every kernel
+        for kernelIndex in range(nKernels):
+            outputData[kernelIndex,station,month,day,angle] = hoursDownwind[kernelIndex]
+
+# transfer long-format hourly records to the GPU and rearrange them into a (hour, day, month, id) matrix
+# INPUTS:
+#    idList, hour, day, month, wnd_dir (numpy arrays) - long-format hourly wind records
+#    nBirths (int) - number of unique ids in the batch
+# OUTPUTS:
+#    hourly wind direction matrix in GPU memory
+def rearrangeDataCuda(idList,hour,day,month,wnd_dir,nBirths):
+
+    # transfer data from RAM to GPU memory.  Part of this process
+    # includes creating variables on the GPU
+    inputList = cuda.to_device(np.asarray(idList))
+    inputHour = cuda.to_device(np.asarray(hour))
+    inputDay = cuda.to_device(np.asarray(day))
+    inputMonth = cuda.to_device(np.asarray(month))
+    inputDir = cuda.to_device(np.asarray(wnd_dir))
+    outData = cuda.to_device(np.full((N_HOURS,N_DAYS,N_MONTHS,nBirths),MISSING,np.int16))
+    cuda.synchronize()
+    nThreads = len(hour)
+    nBlocks = math.ceil(nThreads/thread_x_dim)
+
+    # rearrange wind direction so its organized in a matrix by day,month,year,unique id
+    rearrangeData[(nBlocks,1),(thread_x_dim,1)](inputList,inputHour,inputDay,inputMonth,inputDir,outData,nThreads)
+    cuda.synchronize()
+    return(outData)
+
+# rearrange hourly records and calculate hours downwind on the GPU
+# INPUTS:
+#    idList, hour, day, month, wnd_dir (numpy arrays) - long-format hourly wind records
+#    nBirths (int) - number of unique ids in the batch
+# OUTPUTS:
+#    hours downwind organized by (id, month, day, angle)
+def calcWindMatrixCuda(idList,hour,day,month,wnd_dir,nBirths):
+    outData = rearrangeDataCuda(idList,hour,day,month,wnd_dir,nBirths)
+
+    # blank output matrix.  CUDA writes in place
+    station_mem = cuda.to_device(np.full((nBirths,N_MONTHS,N_DAYS,N_ANGLES),MISSING,np.float64))
+    cuda.synchronize()
+
+    # calcualte number or hours downwind for each of 360 degrees, for each day, each maternal residence
+    calcDailyDownwind[(N_MONTHS,N_DAYS,nBirths),thread_dim](outData,station_mem)
+    cuda.synchronize()
+
+    # transfer results from GPU to RAM
+    return(station_mem.copy_to_host())
+
+# rearrange hourly records and calculate hours downwind for several kernels on the GPU
+# INPUTS:
+#    idList, hour, day, month, wnd_dir (numpy arrays) - long-format hourly wind records
+#    nBirths (int) - number of unique ids in the batch
+#    kernels (list) - kernels created by createKernel
+# OUTPUTS:
+#    hours downwind organized by (kernel, id, month, day, angle)
+def calcWindMatrixMultiCuda(idList,hour,day,month,wnd_dir,nBirths,kernels):
+    outData = rearrangeDataCuda(idList,hour,day,month,wnd_dir,nBirths)
+    maxDiffs = cuda.to_device(np.array([kernel['maxDiff'] for kernel in kernels],np.float64))
+    hourMasks = cuda.to_device(np.array([kernel['hourMask'] for kernel in kernels],np.bool_))
+    station_mem = cuda.to_device(np.full((len(kernels),nBirths,N_MONTHS,N_DAYS,N_ANGLES),MISSING,np.float64))
+    cuda.synchronize()
+    calcDailyDownwindMulti[(N_MONTHS,N_DAYS,nBirths),thread_dim](outData,station_mem,maxDiffs,hourMasks)
+    cuda.synchronize()
+    return(station_mem.copy_to_host())
+
+
+
+################ backend selection ##############
+
+BACKENDS = {
+    'cuda': calcWindMatrixCuda,
+    'numba': calcWindMatrixNumba,
+    'numpy': calcWindMatrixNumpy
+}
+
+MULTI_BACKENDS = {
+    'cuda': calcWindMatrixMultiCuda,
+    'numba': calcWindMatrixMultiNumba,
+    'numpy': calcWindMatrixMultiNumpy
+}
+
+# choose a backend for the wind matrix calculations.  When set to 'auto', the
+# GPU is preferred, then numba compiled cpu kernels, then pure numpy
+# INPUTS:
+#    preferred (str) - 'auto', 'cuda', 'numba', or 'numpy'
+# OUTPUTS:
+#    name of the selected backend (str)
+def selectBackend(preferred='auto'):
+    if preferred == 'auto':
+        if isCudaAvailable():
+            return('cuda')
+        if NUMBA_AVAILABLE:
+            return('numba')
+        return('numpy')
+    if preferred not in BACKENDS:
+        raise ValueError("unknown wind matrix backend: %s" %(preferred))
+    if preferred == 'cuda' and not isCudaAvailable():
+        raise RuntimeError("cuda backend requested but no GPU is available through numba")
+    if preferred == 'numba' and not NUMBA_AVAILABLE:
+        raise RuntimeError("numba backend requested but numba is not installed")
+    return(preferred)
+
+# rearrange hourly records and calculate daily hours downwind with the selected backend
+# INPUTS:
+#    backend (str) - name of the backend returned by selectBackend
+#    idList, hour, day, month, wnd_dir (numpy arrays) - long-format hourly wind records
+#    nBirths (int) - number of unique ids in the batch
+# OUTPUTS:
+#    hours downwind (float64 numpy array) organized by (id, month, day, angle)
+def calcWindMatrix(backend,idList,hour,day,month,wnd_dir,nBirths):
+    return(BACKENDS[backend](idList,hour,day,month,wnd_dir,nBirths))
+
+# rearrange hourly records and calculate daily hours downwind for several kernels in one pass
+# INPUTS:
+#    backend (str) - name of the backend returned by selectBackend
+#    idList, hour, day, month, wnd_dir (numpy arrays) - long-format hourly wind records
+#    nBirths (int) - number of unique ids in the batch
+#    kernels (list) - kernels created by createKernel
+# OUTPUTS:
+#    hours downwind (float64 numpy array) organized by (kernel, id, month, day, angle)
+def calcWindMatrixMulti(backend,idList,hour,day,month,wnd_dir,nBirths,kernels):
+    validateKernels(kernels)
+    return(MULTI_BACKENDS[backend](idList,hour,day,month,wnd_dir,nBirths,kernels))
@@ -0,0 +1,431 @@
+############### windCube.py #############
+# Developed for HEI Transit Study
+# Summary: store one year of hourly ERA5 wind direction as a single time-indexed cube rather than
+#          8,760 hourly .tif files.  Whole grib files (a day or a month of u- and v- components) are decoded
+#          at once and wind direction is calculated for the full time block in one vectorized operation
+# File layout for each year (windCube_<year>.*):
+# 1) .npy - int16 memory mapped array organized by (hour of year, grid row, grid column).  Directions are
+#    truncated to whole degrees, as when hourly raster values are converted to integers in
+#    partitionWindByYear.py.  -999 marks hours that have not been converted
+# 2) _mask.npy - bool array with one value per hour of the year, True once the hour has been written
+# 3) .json - year, first hour (UTC), and grid geometry.  Rows run north to south and columns west to
+#    east, so eraGrid cell ids index the cube directly (cube[hour,row,col])
+# Grib files are decoded with xarray/cfgrib when installed, and with arcpy otherwise
+# Existing archives of hourly wind direction .tifs (wind_surfaces/wind_direction/<year>/<Y>_<MM>_<DD>_<HH>.tif,
+# HH = 01-24 for UTC hours 00-23) can be packed into cubes with importTifYear.  Hours without a .tif stay
+# unset in the mask
+
+
+############### Setup: import libraries and define constants ##############
+import argparse
+import calendar
+import json
+import math
+import os
+from multiprocessing import Pool
+import numpy as np
+import eraGrid
+
+CUBE_PREFIX = "windCube_"
+MISSING = -999
+N_HOURS = 24
+N_PROCESSES = 16 # grib files decoded in parallel
+COMPONENT_NAMES = {
+    'u_comp': ['u10','10u'], # variable names used by cfgrib for 10m wind components
+    'v_comp': ['v10','10v']
+}
+ARCPY_COMPONENTS = {
+    'u_comp': '10U@SFC',
+    'v_comp': '10V@SFC'
+}
+
+# xarray, cfgrib, and rasterio are optional.  Files are read with arcpy when they are not installed
+try:
+    import xarray
+    import cfgrib
+    XARRAY_AVAILABLE = True
+except ImportError:
+    XARRAY_AVAILABLE = False
+try:
+    import rasterio
+    RASTERIO_AVAILABLE = True
+except ImportError:
+    RASTERIO_AVAILABLE = False
+
+
+
+################ Helper functions ##############
+
+# calculate wind direction (degrees the wind is blowing from) from u- and v- wind components
+# INPUTS:
+#    uArr (numpy array) - u-components, any shape
+#    vArr (numpy array) - v-components, same shape as uArr
+# OUTPUTS:
+#    int16 numpy array of the same shape, whole degrees in [0,360], -999 where a component is missing
+def calcWindDirection(uArr,vArr):
+    direction = 180 + (180/math.pi)*np.arctan2(uArr,vArr)
+    isMissing = ~np.isfinite(direction)
+    direction = np.where(isMissing,MISSING,direction)
+    return(direction.astype(np.int16))
+
+# get the number of hours in a year
+# INPUTS:
+#    year (int) - year of interest
+# OUTPUTS:
+#    int
+def getHoursInYear(year):
+    return((366 if calendar.isleap(year) else 365)*N_HOURS)
+
+# get the first hour (UTC) covered by a cube
+# INPUTS:
+#    year (int) - year of interest
+# OUTPUTS:
+#    numpy datetime64 with hour precision
+def getOrigin(year):
+    return(np.datetime64(str(year) + "-01-01T00",'h'))
+
+# get the hour of year index for timestamps
+# INPUTS:
+#    cube (dict) - opened with openCube
+#    timestamps (array-like) - UTC timestamps
+# OUTPUTS:
+#    int64 numpy array
+def getHourIndex(cube,timestamps):
+    return((np.asarray(timestamps,dtype='datetime64[h]') - cube['origin']).astype(np.int64))
+
+# get the file prefix shared by the files of a cube
+# INPUTS:
+#    cubeFolder (str) - folder containing the cubes
+#    year (int) - year of interest
+# OUTPUTS:
+#    filepath prefix (str)
+def getCubePrefix(cubeFolder,year):
+    return(os.path.join(cubeFolder,CUBE_PREFIX + str(year)))
+
+# get the UTC hours covered by a grib file, from its name (<year>_<MM>_<DD>.grib for daily downloads,
+# <year>_<MM>.grib for monthly downloads)
+# INPUTS:
+#    gribFile (str) - filepath to the grib file
+# OUTPUTS:
+#    numpy datetime64 array of UTC hours
+def getFileHours(gribFile):
+    dateParts = os.path.splitext(os.path.basename(gribFile))[0].split("_")
+    start = np.datetime64("-".join(dateParts),'D')
+    end = start + 1 if len(dateParts) == 3 else np.datetime64("-".join(dateParts),'M') + 1
+    return(np.arange(start.astype('datetime64[h]'),np.datetime64(end,'D').astype('datetime64[h]')))
+
+# get the coordinates of the cell centers of a north-up raster
+# INPUTS:
+#    xMin (float) - western edge of the raster
+#    yMax (float) - northern edge of the raster
+#    cellWidth, cellHeight (float) - cell size in degrees
+#    nRows, nCols (int) - raster dimensions
+# OUTPUTS:
+#    lats (numpy array) - latitude of each row, lons (numpy array) - longitude of each column
+def getRasterCenters(xMin,yMax,cellWidth,cellHeight,nRows,nCols):
+    return(yMax - (np.arange(nRows) + 0.5)*cellHeight,xMin + (np.arange(nCols) + 0.5)*cellWidth)
+
+# check that a grid matches the ERA5 grid used throughout the wind pipeline
+# INPUTS:
+#    lats (numpy array) - latitude of each grid row
+#    lons (numpy array) - longitude of each grid column
+#    source (str) - name of the file the grid was read from, used in error messages
+def verifyGrid(lats,lons,source):
+    lats, lons = np.asarray(lats,np.float64), np.asarray(lons,np.float64)
+    expectedLats = eraGrid.GRID_NORTH - np.arange(eraGrid.N_ROWS)*eraGrid.RESOLUTION
+    expectedLons = eraGrid.GRID_WEST + np.arange(eraGrid.N_COLS)*eraGrid.RESOLUTION
+    if lats.shape != expectedLats.shape or lons.shape != expectedLons.shape:
+        raise ValueError("grid in %s is %i x %i, expected %i x %i" %(source,len(lats),len(lons),eraGrid.N_ROWS,eraGrid.N_COLS))
+    if not(np.allclose(lats,expectedLats,atol=1e-4) and np.allclose(lons,expectedLons,atol=1e-4)):
+        raise ValueError("grid coordinates in %s do not match the ERA5 grid in eraGrid.py" %(source))
+
+
+
+################ Cube storage ##############
+
+# create the files for a cube, or open an existing cube so interrupted conversions resume
+# INPUTS:
+#    cubeFolder (str) - folder containing the cubes
+#    year (int) - year of interest
+# OUTPUTS:
+#    cube (dict) - opened for writing (see openCube)
+def createCube(cubeFolder,year):
+    prefix = getCubePrefix(cubeFolder,year)
+    if os.path.exists(prefix + ".json"):
+        return(openCube(cubeFolder,year,'r+'))
+    if not(os.path.exists(cubeFolder)):
+        os.makedirs(cubeFolder)
+    nHours = getHoursInYear(year)
+    direction = np.lib.format.open_memmap(prefix + ".npy",mode='w+',dtype=np.int16,
+        shape=(nHours,eraGrid.N_ROWS,eraGrid.N_COLS))
+    direction[:] = MISSING
+    direction.flush()
+    mask = np.lib.format.open_memmap(prefix + "_mask.npy",mode='w+',dtype=np.bool_,shape=(nHours,))
+    mask.flush()
+    del direction, mask
+
+    # the geometry sidecar is written last, so a cube exists once its sidecar exists
+    geometry = {
+        'year':int(year),
+        'origin':str(getOrigin(year)),
+        'nHours':nHours,
+        'nRows':eraGrid.N_ROWS,
+        'nCols':eraGrid.N_COLS,
+        'north':eraGrid.GRID_NORTH,
+        'west':eraGrid.GRID_WEST,
+        'resolution':eraGrid.RESOLUTION
+    }
+    with open(prefix + ".json",'w') as f:
+        json.dump(geometry,f,indent=2)
+    return(openCube(cubeFolder,year,'r+'))
+
+# open a cube.  Direction and mask arrays are memory mapped
+# INPUTS:
+#    cubeFolder (str) - folder containing the cubes
+#    year (int) - year of interest
+#    mode (str) - 'r' for reading, 'r+' for writing
+# OUTPUTS:
+#    cube (dict) - direction and mask memmaps, geometry, and first hour of the cube
+def openCube(cubeFolder,year,mode='r'):
+    prefix = getCubePrefix(cubeFolder,year)
+    if not(os.path.exists(prefix + ".json")):
+        raise FileNotFoundError("no wind cube for %i in %s" %(year,cubeFolder))
+    with open(prefix + ".json") as f:
+        geometry = json.load(f)
+    cube = {
+        'direction':np.load(prefix + ".npy",mmap_mode=mode),
+        'mask':np.load(prefix + "_mask.npy",mmap_mode=mode),
+        'geometry':geometry,
+        'origin':np.datetime64(geometry['origin'],'h')
+    }
+    return(cube)
+
+# write wind directions for a block of hours
+# INPUTS:
+#    cube (dict) - opened with createCube
+#    hourIndexes (numpy array) - hour of year index of each time slice
+#    direction (numpy array) - int16 wind directions organized by (time, row, col)
+def writeHours(cube,hourIndexes,direction):
+    hourIndexes = np.asarray(hourIndexes,dtype=np.int64)
+    if (hourIndexes < 0).any() or (hourIndexes >= cube['geometry']['nHours']).any():
+        raise ValueError("hours fall outside the %i year cube" %(cube['geometry']['year']))
+    if len(hourIndexes) > 0 and (np.diff(hourIndexes) == 1).all():
+        cube['direction'][hourIndexes[0]:hourIndexes[-1]+1] = direction
+    else:
+        cube['direction'][hourIndexes] = direction
+    cube['direction'].flush()
+    cube['mask'][hourIndexes] = True
+    cube['mask'].flush()
+
+# get hours that have not been written to a cube
+# INPUTS:
+#    cube (dict) - opened with openCube
+# OUTPUTS:
+#    numpy datetime64 array of UTC hours
+def getMissingHours(cube):
+    return(cube['origin'] + np.flatnonzero(~np.asarray(cube['mask'])).astype('timedelta64[h]'))
+
+
+
+################ Grib decoding ##############
+
+# read all u- and v- components in a grib file with xarray and cfgrib
+# INPUTS:
+#    gribFile (str) - filepath to a grib file containing one or more hours
+# OUTPUTS:
+#    times (numpy datetime64 array), uArr and vArr (numpy arrays organized by (time, row, col))
+def readComponentsXarray(gribFile):
+    with xarray.open_dataset(gribFile,engine='cfgrib',backend_kwargs={'indexpath':''}) as ds:
+        verifyGrid(ds['latitude'].values,ds['longitude'].values,gribFile)
+        components = []
+        for compName in ['u_comp','v_comp']:
+            varName = [name for name in COMPONENT_NAMES[compName] if name in ds.data_vars][0]
+            components.append(ds[varName].transpose(...,'latitude','longitude').values.reshape(-1,eraGrid.N_ROWS,eraGrid.N_COLS))
+        timeName = 'valid_time' if 'valid_time' in ds.coords else 'time'
+        times = np.atleast_1d(ds[timeName].values).ravel().astype('datetime64[h]')
+    return(times,components[0],components[1])
+
+# read all u- and v- components in a grib file with arcpy.  Each component is subset from the
+# multidimensional raster once for all hours, rather than once per hour
+# INPUTS:
+#    gribFile (str) - filepath to a grib file containing one or more hours
+#    tempFolder (str) - folder for temporary .crf files
+# OUTPUTS:
+#    times (numpy datetime64 array), uArr and vArr (numpy arrays organized by (time, row, col))
+def readComponentsArcpy(gribFile,tempFolder):
+    import arcpy
+    components, times = [], None
+    for compName in ['u_comp','v_comp']:
+        tempFile = os.path.join(tempFolder,"temp_" + compName + "_" + os.path.basename(gribFile) + ".crf")
+        arcpy.md.SubsetMultidimensionalRaster(gribFile,tempFile,ARCPY_COMPONENTS[compName])
+        raster = arcpy.Raster(tempFile,True)
+        times = np.array(raster.getDimensionValues(ARCPY_COMPONENTS[compName],'StdTime'),dtype='datetime64[h]')
+        arr = arcpy.RasterToNumPyArray(raster,nodata_to_value=np.nan).astype(np.float32)
+        components.append(arr.reshape(-1,raster.height,raster.width))
+        lats, lons = getRasterCenters(raster.extent.XMin,raster.extent.YMax,raster.meanCellWidth,
+            raster.meanCellHeight,raster.height,raster.width)
+        verifyGrid(lats,lons,gribFile)
+        del raster
+        arcpy.Delete_management(tempFile)
+    return(times,components[0],components[1])
+
+# read all u- and v- components in a grib file
+# INPUTS:
+#    gribFile (str) - filepath to a grib file containing one or more hours
+#    tempFolder (str) - folder for temporary files (arcpy only)
+# OUTPUTS:
+#    times (numpy datetime64 array), uArr and vArr (numpy arrays organized by (time, row, col))
+def readComponents(gribFile,tempFolder):
+    if XARRAY_AVAILABLE:
+        return(readComponentsXarray(gribFile))
+    return(readComponentsArcpy(gribFile,tempFolder))
+
+
+
+################ Main conversion functions ##############
+
+# convert one grib file (a day or a month of hourly components) and write it to the cube
+# INPUTS:
+#    gribFile (str) - filepath to the grib file
+#    cubeFolder (str) - folder containing the cubes
+#    year (int) - year of the cube
+# OUTPUTS:
+#    number of hours written (int)
+def convertFile(gribFile,cubeFolder,year):
+    times, uArr, vArr = readComponents(gribFile,cubeFolder)
+    cube = openCube(cubeFolder,year,'r+')
+    inYear = (times >= cube['origin']) & (times < cube['origin'] + np.timedelta64(cube['geometry']['nHours'],'h'))
+    writeHours(cube,getHourIndex(cube,times[inYear]),calcWindDirection(uArr[inYear],vArr[inYear]))
+    print("converted %i hours from %s" %(int(inYear.sum()),os.path.basename(gribFile)))
+    return(int(inYear.sum()))
+
+# convert grib files for one year to a wind direction cube.  Files are decoded in parallel processes,
+# each writing a disjoint block of hours to the memory mapped cube
+# INPUTS:
+#    gribFiles (list) - filepaths to the grib files for the year (daily or monthly, named as in getFileHours)
+#    cubeFolder (str) - folder containing the cubes
+#    year (int) - year of interest
+#    nProcesses (int) - number of files decoded in parallel
+# OUTPUTS:
+#    cube (dict) - opened for reading
+def convertYear(gribFiles,cubeFolder,year,nProcesses=N_PROCESSES):
+    cube = createCube(cubeFolder,year)
+
+    # no need to decode files whose hours were converted by an earlier run
+    toConvert = []
+    for gribFile in gribFiles:
+        hourIndexes = getHourIndex(cube,getFileHours(gribFile))
+        hourIndexes = hourIndexes[(hourIndexes >= 0) & (hourIndexes < cube['geometry']['nHours'])]
+        if not(cube['mask'][hourIndexes].all()):
+            toConvert.append(gribFile)
+    del cube
+    if len(toConvert) > 0:
+        with Pool(processes=max(1,min(nProcesses,len(toConvert)))) as pool:
+            pool.starmap(convertFile,[(gribFile,cubeFolder,year) for gribFile in toConvert])
+    cube = openCube(cubeFolder,year)
+    nMissing = int((~np.asarray(cube['mask'])).sum())
+    if nMissing > 0:
+        print("warning: %i hours missing from the %i wind cube" %(nMissing,year))
+    return(cube)
+
+
+
+################ Tif archive import ##############
+
+# list the hourly wind direction .tifs for a year with a single directory listing
+# INPUTS:
+#    tifFolder (str) - folder containing <Y>_<MM>_<DD>_<HH>.tif files for one year
+#    year (int) - year of interest
+# OUTPUTS:
+#    hourIndexes (numpy int64 array) - hour of year index of each file, sorted
+#    tifFiles (list) - filepaths in the same order
+def listTifHours(tifFolder,year):
+    hourIndexes, tifFiles = [], []
+    origin = getOrigin(year)
+    for filename in os.listdir(tifFolder):
+        nameParts = os.path.splitext(filename)[0].split("_")
+        if not(filename.endswith(".tif")) or len(nameParts) != 4 or nameParts[0] != str(year):
+            continue
+        day = np.datetime64("-".join(nameParts[:3]),'D')
+        hourIndexes.append(int((day.astype('datetime64[h]') - origin).astype(np.int64)) + int(nameParts[3]) - 1)
+        tifFiles.append(os.path.join(tifFolder,filename))
+    order = np.argsort(hourIndexes)
+    return(np.array(hourIndexes,dtype=np.int64)[order],[tifFiles[index] for index in order])
+
+# read one wind direction .tif and check its grid
+# INPUTS:
+#    tifFile (str) - filepath to the .tif
+# OUTPUTS:
+#    int16 numpy array organized by (row, col), -999 for nodata cells
+def readTif(tifFile):
+    if RASTERIO_AVAILABLE:
+        with rasterio.open(tifFile) as src:
+            arr = src.read(1,masked=True).astype(np.float64).filled(np.nan)
+            lats, lons = getRasterCenters(src.transform.c,src.transform.f,src.transform.a,-src.transform.e,src.height,src.width)
+    else:
+        import arcpy
+        raster = arcpy.Raster(tifFile)
+        arr = arcpy.RasterToNumPyArray(raster,nodata_to_value=np.nan).astype(np.float64)
+        lats, lons = getRasterCenters(raster.extent.XMin,raster.extent.YMax,raster.meanCellWidth,
+            raster.meanCellHeight,raster.height,raster.width)
+    verifyGrid(lats,lons,tifFile)
+    return(np.where(np.isfinite(arr),arr,MISSING).astype(np.int16))
+
+# read a block of hourly .tifs and write them to the cube
+# INPUTS:
+#    hourIndexes (numpy array) - hour of year index of each file
+#    tifFiles (list) - filepaths in the same order
+#    cubeFolder (str) - folder containing the cubes
+#    year (int) - year of the cube
+def importTifBlock(hourIndexes,tifFiles,cubeFolder,year):
+    direction = np.stack([readTif(tifFile) for tifFile in tifFiles])
+    writeHours(openCube(cubeFolder,year,'r+'),hourIndexes,direction)
+
+# pack an archive of hourly wind direction .tifs into a cube.  Each day of files is read by one of
+# nProcesses parallel processes.  Hours already in the cube's mask are skipped
+# INPUTS:
+#    tifFolder (str) - folder containing <Y>_<MM>_<DD>_<HH>.tif files for one year
+#    cubeFolder (str) - folder containing the cubes
+#    year (int) - year of interest
+#    nProcesses (int) - number of processes reading .tifs
+# OUTPUTS:
+#    cube (dict) - opened for reading
+def importTifYear(tifFolder,cubeFolder,year,nProcesses=N_PROCESSES):
+    cube = createCube(cubeFolder,year)
+    hourIndexes, tifFiles = listTifHours(tifFolder,year)
+    toImport = ~np.asarray(cube['mask'])[hourIndexes]
+    del cube
+    hourIndexes, tifFiles = hourIndexes[toImport], [tifFile for tifFile, isNew in zip(tifFiles,toImport) if isNew]
+    days = hourIndexes//N_HOURS
+    blocks = [(hourIndexes[days == day],[tifFiles[index] for index in np.flatnonzero(days == day)],cubeFolder,year)
+        for day in np.unique(days)]
+    if len(blocks) > 0:
+        with Pool(processes=max(1,min(nProcesses,len(blocks)))) as pool:
+            pool.starmap(importTifBlock,blocks)
+    print("imported %i hourly .tifs for %i" %(len(hourIndexes),year))
+    cube = openCube(cubeFolder,year)
+    nMissing = int((~np.asarray(cube['mask'])).sum())
+    if nMissing > 0:
+        print("warning: %i hours missing from the %i wind cube" %(nMissing,year))
+    return(cube)
+
+
+
+################# Main function ######################
+
+if __name__ == '__main__':
+    import gConst as const
+    parser = argparse.ArgumentParser(description="pack a year of hourly wind direction into a single cube")
+    parser.add_argument('years',type=int,nargs='+',help="years to convert")
+    parser.add_argument('--from-tifs',action='store_true',
+        help="import existing hourly .tifs rather than converting u- and v- components from grib files")
+    parser.add_argument('--processes',type=int,default=N_PROCESSES,help="files read in parallel")
+    args = parser.parse_args()
+    cubeFolder = const.WIND_FOLDER + "wind_surfaces/wind_cubes/"
+    for year in args.years:
+        if args.from_tifs:
+            importTifYear(const.WIND_FOLDER + "wind_surfaces/wind_direction/" + str(year) + "/",cubeFolder,year,args.processes)
+        else:
+            gribFolder = const.WIND_FOLDER + "wind_surfaces/wind_components/" + str(year) + "/"
+            gribFiles = sorted([gribFolder + filename for filename in os.listdir(gribFolder) if filename.endswith(".grib")])
+            convertYear(gribFiles,cubeFolder,year,args.processes)
@@ -0,0 +1,143 @@
+############### windPartitioner.py #############
+# Developed for HEI Transit Study
+# Summary: read long-format hourly wind records (comb_<year> dataset, csv, or a columnar equivalent) in a single
+#          streaming pass and partition them into batches of unique ids for the wind matrix stage
+# Steps include:
+# 1) reading the long table in chunks with compact column types
+# 2) coding unique ids to dense integer indeces (sorted order) with vectorized categorical operations
+# 3) grouping records by batch with one stable sort, rather than filtering the table once per batch
+# 4) emitting per-batch column arrays that can be passed directly to windBackends.calcWindMatrix
+
+
+############### Setup: import libraries and define constants ##############
+import os
+import numpy as np
+import pandas as ps
+from pandas.api.types import union_categoricals
+import longTableStore
+
+CHUNK_ROWS = 5000000 # number of records read from storage at a time
+COLUMNS = ['year','month','day','hour','wnd_dir','master_id']
+CSV_DTYPES = {
+    'year':np.int16,
+    'month':np.uint8,
+    'day':np.uint8,
+    'hour':np.uint8,
+    'wnd_dir':np.float32, # read as float so missing values can be replaced before converting to int16
+    'master_id':str
+}
+MISSING = -999
+
+
+
+################ Readers ##############
+
+# iterate over chunks of a long-format wind table.  Partitioned datasets (see longTableStore.py), CSV,
+# parquet, and feather inputs are supported
+# INPUTS:
+#    filepath (str) - filepath to the long table, or folder containing a partitioned dataset
+#    chunkRows (int) - number of records per chunk
+#    ids (list) - optional unique ids to read.  Filtering is pushed down to the reader for datasets
+# OUTPUTS:
+#    generator of pandas dataframes containing the columns in COLUMNS
+def iterLongTableChunks(filepath,chunkRows=CHUNK_ROWS,ids=None):
+    extension = os.path.splitext(filepath)[1].lower()
+    if os.path.isdir(filepath):
+        for chunk in longTableStore.iterRecords(filepath,ids,chunkRows):
+            yield(chunk)
+        return
+    if ids is not None:
+        for chunk in iterLongTableChunks(filepath,chunkRows):
+            yield(chunk[chunk['master_id'].astype(str).isin([str(curId) for curId in ids])])
+    elif extension == '.csv':
+        for chunk in ps.read_csv(filepath,usecols=COLUMNS,dtype=CSV_DTYPES,chunksize=chunkRows):
+            yield(chunk)
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(filepath).iter_batches(batch_size=chunkRows,columns=COLUMNS):
+            yield(batch.to_pandas())
+    elif extension == '.feather':
+        yield(ps.read_feather(filepath,columns=COLUMNS))
+    else:
+        raise ValueError("unsupported long table format: %s" %(filepath))
+
+# read a long-format wind table into compact column arrays in a single pass.  Unique ids are coded
+# to dense integer indeces so that code order matches the sorted order of the unique ids
+# INPUTS:
+#    filepath (str) - filepath to the long table, or folder containing a partitioned dataset
+#    chunkRows (int) - number of records read at a time
+#    ids (list) - optional unique ids to read
+# OUTPUTS:
+#    table (dict) - 'ids' (sorted unique ids) and column arrays 'code', 'year', 'month', 'day', 'hour', 'wnd_dir'
+def readLongTable(filepath,chunkRows=CHUNK_ROWS,ids=None):
+    idChunks = []
+    columns = {'year':[],'month':[],'day':[],'hour':[],'wnd_dir':[]}
+    for chunk in iterLongTableChunks(filepath,chunkRows,ids):
+        idChunks.append(ps.Categorical(chunk['master_id'].astype(str)))
+        for colName in ['year','month','day','hour']:
+            columns[colName].append(chunk[colName].to_numpy(dtype=CSV_DTYPES[colName]))
+        wndDir = chunk['wnd_dir'].to_numpy(dtype=np.float32,na_value=MISSING)
+        columns['wnd_dir'].append(wndDir.astype(np.int16))
+        print("read %i records" %(sum(len(arr) for arr in columns['hour'])))
+    if len(idChunks) == 0:
+        raise ValueError("no hourly wind records in %s" %(filepath))
+    table = {colName:np.concatenate(arrs) for colName, arrs in columns.items()}
+    allIds = union_categoricals(idChunks,sort_categories=True)
+    table['code'] = allIds.codes.astype(np.int32)
+    table['ids'] = list(allIds.categories)
+    return(table)
+
+
+
+################ Partitioning ##############
+
+# group records by batch.  Month is converted to be relative to the first month of coverage
+# (january of the year before birth), and records outside the two year window are dropped
+# INPUTS:
+#    table (dict) - created by readLongTable
+#    year (int) - birth year
+#    batchBounds (list) - [start, end) unique id indeces for each batch (see batchPlanner.getBatchBounds)
+# OUTPUTS:
+#    partitions (dict) - grouped record order and batch offsets, used by getBatch
+def createPartitions(table,year,batchBounds):
+    relativeMonth = table['month'].astype(np.int16) + (table['year'] - year + 1)*12
+    isValid = (relativeMonth >= 1) & (relativeMonth <= 24)
+    if not isValid.all():
+        print("warning: dropping %i records outside of %i-%i" %(int((~isValid).sum()),year-1,year))
+    starts = np.array([start for start, end in batchBounds],np.int64)
+    batchIndex = (np.searchsorted(starts,table['code'],side='right') - 1).astype(np.int16 if len(starts) < 32767 else np.int32)
+    batchIndex[~isValid] = len(starts) # invalid records are grouped after the last batch and never read
+
+    # stable sort on small integers is a radix sort in numpy, so grouping is linear in the number of records
+    order = np.argsort(batchIndex,kind='stable')
+    counts = np.bincount(batchIndex,minlength=len(starts)+1)
+    offsets = np.concatenate([[0],np.cumsum(counts)])
+    partitions = {
+        'table':table,
+        'relativeMonth':relativeMonth.astype(np.uint8),
+        'order':order,
+        'offsets':offsets,
+        'bounds':list(batchBounds)
+    }
+    return(partitions)
+
+# get column arrays for one batch of unique ids, ready for windBackends.calcWindMatrix
+# INPUTS:
+#    partitions (dict) - created by createPartitions
+#    batchIndex (int) - index of the batch
+# OUTPUTS:
+#    batch (dict) - 'ids' (sorted unique ids in the batch), and column arrays 'idIndex' (index of the
+#                   unique id within the batch), 'hour', 'day', 'month' (relative), and 'wnd_dir'
+def getBatch(partitions,batchIndex):
+    table = partitions['table']
+    start, end = partitions['bounds'][batchIndex]
+    rows = partitions['order'][partitions['offsets'][batchIndex]:partitions['offsets'][batchIndex+1]]
+    batch = {
+        'ids':table['ids'][start:end],
+        'idIndex':table['code'][rows] - start,
+        'hour':table['hour'][rows],
+        'day':table['day'][rows],
+        'month':partitions['relativeMonth'][rows],
+        'wnd_dir':table['wnd_dir'][rows]
+    }
+    return(batch)
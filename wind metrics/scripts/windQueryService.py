@@ -0,0 +1,258 @@
+############### windQueryService.py #############
+# Developed for HEI Transit Study
+# Summary: wind roses for arbitrary coordinates and date windows, read directly from the wind direction
+#          cubes (see windCube.py) without running createWindMatrix.py and residentialWindParallel.py
+#          for a whole year.  Used for address corrections and new cohort members
+# Steps to answer a query include:
+# 1) mapping each coordinate to its ERA5 cell (see eraGrid.py)
+# 2) reading the hourly wind directions of each queried cell over the queried UTC days from the
+#    memory mapped cubes, so only the pages holding those cells are read
+# 3) building roses with hourlyWindStore.buildRoses, so results match hourly wind partitions exactly:
+#    days with a missing hour are dropped and a radial degree is downwind if it is within the
+#    angular window of the wind direction (windBackends.histogramToDownwind)
+# Results are kept in a least recently used cache keyed by cell and date window, so nearby addresses
+# share cached roses.  Queries can be made from python (queryRose, queryRoses) or over http
+# (startService):
+#    GET  /rose?lat=<lat>&lon=<lon>&start=<YYYY-MM-DD>&end=<YYYY-MM-DD>
+#    POST /roses with {"queries":[{"lat":..,"lon":..,"start":..,"end":..},...]}
+
+
+############### Setup: import libraries and define constants ##############
+import argparse
+import http.server
+import json
+import threading
+import urllib.parse
+from collections import OrderedDict
+import numpy as np
+import eraGrid
+import hourlyWindStore
+import windBackends
+import windCube
+
+CACHE_SIZE = 65536 # roses kept in memory.  Each rose is 360 int32 values
+QUERY_CHUNK = hourlyWindStore.QUERY_CHUNK
+SERVICE_PORT = 8766
+
+
+
+################ Helper functions ##############
+
+# open a query service over a folder of wind direction cubes.  Cubes are opened on first use
+# INPUTS:
+#    cubeFolder (str) - folder containing the cubes
+#    maxDiff (float) - angular window in degrees (see windBackends.getHalfWindow)
+#    cacheSize (int) - number of roses kept in the cache
+# OUTPUTS:
+#    service (dict) - cube folder, open cubes, rose cache, and a lock shared by http threads
+def openService(cubeFolder,maxDiff=windBackends.DOWNWIND_WINDOW,cacheSize=CACHE_SIZE):
+    service = {
+        'cubeFolder':cubeFolder,
+        'cubes':{},
+        'halfWindow':windBackends.getHalfWindow(maxDiff),
+        'cache':OrderedDict(),
+        'cacheSize':cacheSize,
+        'lock':threading.Lock()
+    }
+    return(service)
+
+# get the cube for a year, opening it the first time it is needed
+# INPUTS:
+#    service (dict) - created by openService
+#    year (int) - year of interest
+# OUTPUTS:
+#    cube (dict) - see windCube.openCube
+def getCube(service,year):
+    with service['lock']:
+        if year not in service['cubes']:
+            service['cubes'][year] = windCube.openCube(service['cubeFolder'],year)
+        return(service['cubes'][year])
+
+# read hourly wind directions for a set of cells over consecutive UTC days
+# INPUTS:
+#    service (dict) - created by openService
+#    cellIds (numpy array) - cell ids created by eraGrid.getCellIds
+#    firstDay, lastDay (numpy datetime64) - first and last day (inclusive)
+# OUTPUTS:
+#    int16 numpy array organized by (cell, day, hour), -999 for hours missing from the cubes
+def readCellHours(service,cellIds,firstDay,lastDay):
+    rows, cols = np.divmod(np.asarray(cellIds,dtype=np.int64),eraGrid.N_COLS)
+    firstHour = np.datetime64(firstDay,'D').astype('datetime64[h]')
+    endHour = (np.datetime64(lastDay,'D') + 1).astype('datetime64[h]')
+    blocks = []
+    for year in range(firstHour.astype(object).year,(endHour - 1).astype(object).year + 1):
+        cube = getCube(service,year)
+        start = max(int(windCube.getHourIndex(cube,firstHour)),0)
+        end = min(int(windCube.getHourIndex(cube,endHour)),cube['geometry']['nHours'])
+        block = np.array(cube['direction'][start:end][:,rows,cols]) # (hour, cell)
+        block[~np.asarray(cube['mask'][start:end])] = windCube.MISSING
+        blocks.append(block)
+    hourly = np.concatenate(blocks)
+    return(np.ascontiguousarray(hourly.T.reshape(len(rows),-1,windCube.N_HOURS)))
+
+
+
+################ Queries ##############
+
+# get wind roses for arrays of coordinates and inclusive [start, end] UTC date windows
+# INPUTS:
+#    service (dict) - created by openService
+#    lats, lons (array-like) - coordinates in degrees
+#    starts (array-like) - first day of each window
+#    ends (array-like) - last day of each window (inclusive)
+#    hourMask (array-like) - optional, 24 booleans marking the UTC hours that are counted
+#                            (see windBackends.localHourMask)
+# OUTPUTS:
+#    roses (numpy array) - int32 hours downwind organized by (query, angle)
+#    cellIds (numpy array) - ERA5 cell of each query
+def queryRoses(service,lats,lons,starts,ends,hourMask=None):
+    cellIds = eraGrid.getCellIds(np.atleast_1d(lats),np.atleast_1d(lons)).astype(np.int64)
+    if (cellIds < 0).any():
+        raise ValueError("coordinates fall outside the ERA5 grid")
+    starts = np.atleast_1d(np.asarray(starts,dtype='datetime64[D]'))
+    ends = np.atleast_1d(np.asarray(ends,dtype='datetime64[D]'))
+    if len(starts) != len(cellIds) or len(ends) != len(cellIds):
+        raise ValueError("each query needs a coordinate, start date, and end date")
+    if (ends < starts).any():
+        raise ValueError("end dates must not be before start dates")
+    if hourMask is not None:
+        hourMask = np.asarray(hourMask,bool)
+    maskKey = None if hourMask is None else hourMask.tobytes()
+    keys = list(zip(cellIds.tolist(),starts.astype(np.int64).tolist(),ends.astype(np.int64).tolist(),
+        [service['halfWindow']]*len(cellIds),[maskKey]*len(cellIds)))
+    roses = np.zeros((len(cellIds),windBackends.N_ANGLES),np.int32)
+
+    # reuse cached roses, and build each remaining key once
+    toBuild = OrderedDict()
+    with service['lock']:
+        for queryIndex, key in enumerate(keys):
+            if key in service['cache']:
+                service['cache'].move_to_end(key)
+                roses[queryIndex] = service['cache'][key]
+            else:
+                toBuild.setdefault(key,[]).append(queryIndex)
+    if len(toBuild) == 0:
+        return(roses,cellIds)
+
+    # read the union of the missing windows once per cell
+    firstIndexes = np.array([indexes[0] for indexes in toBuild.values()],dtype=np.int64)
+    buildCells, rows = np.unique(cellIds[firstIndexes],return_inverse=True)
+    firstDay, lastDay = starts[firstIndexes].min(), ends[firstIndexes].max()
+    hourly = readCellHours(service,buildCells,firstDay,lastDay)
+    startOffsets = (starts[firstIndexes] - firstDay).astype(np.int64)
+    endOffsets = (ends[firstIndexes] - firstDay).astype(np.int64) + 1
+    built = np.zeros((len(firstIndexes),windBackends.N_ANGLES),np.int32)
+    for chunkStart in range(0,len(firstIndexes),QUERY_CHUNK):
+        chunk = slice(chunkStart,chunkStart+QUERY_CHUNK)
+        built[chunk] = hourlyWindStore.buildRoses(hourly,rows[chunk],startOffsets[chunk],endOffsets[chunk],
+            service['halfWindow'],hourMask)
+
+    with service['lock']:
+        for builtIndex, (key, indexes) in enumerate(toBuild.items()):
+            roses[indexes] = built[builtIndex]
+            service['cache'][key] = built[builtIndex].copy()
+            if len(service['cache']) > service['cacheSize']:
+                service['cache'].popitem(last=False)
+    return(roses,cellIds)
+
+# get the wind rose for one coordinate and inclusive [start, end] UTC date window
+# INPUTS:
+#    service (dict) - created by openService
+#    lat, lon (float) - coordinate in degrees
+#    start, end (str or datetime64) - first and last day (inclusive)
+#    hourMask (array-like) - optional, 24 booleans marking the UTC hours that are counted
+# OUTPUTS:
+#    rose (numpy array) - int32 hours downwind for each radial degree
+def queryRose(service,lat,lon,start,end,hourMask=None):
+    return(queryRoses(service,[lat],[lon],[start],[end],hourMask)[0][0])
+
+
+
+################ HTTP service ##############
+
+# convert query results to a json serializable list
+# INPUTS:
+#    roses, cellIds (numpy arrays) - created by queryRoses
+#    starts, ends (array-like) - date windows of the queries
+# OUTPUTS:
+#    list of dicts
+def formatResults(roses,cellIds,starts,ends):
+    return([{'cellId':int(cellId),'start':str(np.datetime64(start,'D')),'end':str(np.datetime64(end,'D')),
+        'rose':rose.tolist()} for rose, cellId, start, end in zip(roses,cellIds,starts,ends)])
+
+# create an http server for a query service.  Invalid queries return status 400, and queries for
+# years without a cube return status 404
+# INPUTS:
+#    service (dict) - created by openService
+#    port (int) - port to listen on.  0 chooses a free port
+# OUTPUTS:
+#    server (ThreadingHTTPServer) - not yet serving, see startService
+def createServer(service,port=SERVICE_PORT):
+    class QueryHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != "/rose":
+                self.send_error(404,"unknown path " + url.path)
+                return
+            params = urllib.parse.parse_qs(url.query)
+            self.respond(lambda: [params[name][0] for name in ['lat','lon','start','end']],single=True)
+
+        def do_POST(self):
+            if self.path != "/roses":
+                self.send_error(404,"unknown path " + self.path)
+                return
+            def parseBody():
+                queries = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['queries']
+                return([[query[name] for query in queries] for name in ['lat','lon','start','end']])
+            self.respond(parseBody,single=False)
+
+        def respond(self,parseQuery,single):
+            try:
+                lats, lons, starts, ends = parseQuery()
+                lats, lons = np.asarray(lats,dtype=np.float64), np.asarray(lons,dtype=np.float64)
+                roses, cellIds = queryRoses(service,lats,lons,starts,ends)
+            except FileNotFoundError as e:
+                self.send_error(404,str(e))
+                return
+            except (KeyError,TypeError,ValueError) as e:
+                self.send_error(400,str(e))
+                return
+            results = formatResults(roses,cellIds,np.atleast_1d(starts),np.atleast_1d(ends))
+            data = json.dumps(results[0] if single else {'results':results}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self,format,*args):
+            pass
+
+    return(http.server.ThreadingHTTPServer(('localhost',port),QueryHandler))
+
+# start an http server for a query service on a daemon thread
+# INPUTS:
+#    service (dict) - created by openService
+#    port (int) - port to listen on.  0 chooses a free port
+# OUTPUTS:
+#    server (ThreadingHTTPServer) - the url is http://localhost:<server.server_address[1]>, stop with
+#                                   server.shutdown()
+def startService(service,port=SERVICE_PORT):
+    server = createServer(service,port)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return(server)
+
+
+
+################# Main function ######################
+
+if __name__ == '__main__':
+    import gConst as const
+    parser = argparse.ArgumentParser(description="serve wind roses for coordinates and date windows")
+    parser.add_argument('--folder',default=const.WIND_FOLDER + "wind_surfaces/wind_cubes/",help="folder containing the wind cubes")
+    parser.add_argument('--port',type=int,default=SERVICE_PORT,help="port to listen on")
+    parser.add_argument('--window',type=float,default=windBackends.DOWNWIND_WINDOW,help="angular window in degrees")
+    args = parser.parse_args()
+    server = createServer(openService(args.folder,args.window),args.port)
+    print("serving wind roses at http://localhost:%i" %(server.server_address[1]))
+    server.serve_forever()
@@ -0,0 +1,249 @@
+############### windRoseStore.py #############
+# Developed for HEI Transit Study
+# Summary: compact storage format for daily wind matrices created by createWindMatrix.py
+# Daily hours downwind are integers from 0 to 24, so each value is stored as a uint8 rather than float64,
+# reducing disk and RAM for each partition by 8x.  Any negative value (days with a missing hour) is
+# stored as a single missing code.  Downstream calculations treat missing days as 0 hours downwind,
+# so this is lossless for residentialWindParallel.py
+# File layout (.wrt):
+# 1) 8 byte magic string
+# 2) 4 byte little-endian header length
+# 3) json header with unique ids, birth year, calendar, array shape, and compression details.
+#    Padded so the body starts on a 64 byte boundary
+# 4) body - uint8 array organized by (id, month, day, angle), stored raw or as zlib compressed chunks
+# Uncompressed files are read with np.memmap so partitions are never loaded as a whole
+
+
+############### Setup: import libraries and define constants ##############
+import calendar
+import json
+import os
+import struct
+import zlib
+from collections import OrderedDict
+import numpy as np
+
+MAGIC = b"HEIWRT01"
+ALIGNMENT = 64 # body offset is a multiple of this many bytes
+MISSING_CODE = 255 # uint8 code for days with a missing hour (-999 in the float64 format)
+MAX_HOURS = 24
+CHUNK_BIRTHS = 64 # maternal residences per compressed chunk
+CHUNK_CACHE_SIZE = 4 # decompressed chunks kept in memory per open tensor
+FILE_EXTENSION = ".wrt"
+
+
+
+################ Helper functions ##############
+
+# get the number of days in each of the 24 months covered by a wind matrix (january of the year
+# before birth through december of the birth year)
+# INPUTS:
+#    year (int) - birth year
+# OUTPUTS:
+#    list of 24 ints
+def getDaysInMonths(year):
+    return([calendar.monthrange(curYear,month)[1] for curYear in (year-1,year) for month in range(1,13)])
+
+# convert daily hours downwind to uint8 codes
+# INPUTS:
+#    windMatrix (numpy array) - hours downwind, negative values represent missing days
+# OUTPUTS:
+#    uint8 numpy array of the same shape
+def encodeHours(windMatrix):
+    windMatrix = np.asarray(windMatrix)
+    if windMatrix.size > 0 and windMatrix.max() > MAX_HOURS:
+        raise ValueError("hours downwind cannot exceed %i: found %s" %(MAX_HOURS,str(windMatrix.max())))
+    return(np.where(windMatrix < 0,MISSING_CODE,windMatrix).astype(np.uint8))
+
+# convert uint8 codes back to hours downwind, with -999 for missing days
+# INPUTS:
+#    codes (numpy array) - uint8 codes
+# OUTPUTS:
+#    int16 numpy array of the same shape
+def decodeHours(codes):
+    hours = np.asarray(codes).astype(np.int16)
+    hours[hours == MISSING_CODE] = -999
+    return(hours)
+
+# get hours downwind with missing days set to 0, the quantity summed for wind roses.
+# Accepts both uint8 codes and the original float64 format
+# INPUTS:
+#    windData (numpy array) - uint8 codes or float64 hours downwind
+# OUTPUTS:
+#    float64 numpy array of the same shape
+def getValidHours(windData):
+    if windData.dtype == np.uint8:
+        return(np.where(windData == MISSING_CODE,0,windData).astype(np.float64))
+    return(np.maximum(windData,0))
+
+# round a byte offset up to the body alignment
+def alignOffset(offset):
+    return(((offset + ALIGNMENT - 1)//ALIGNMENT)*ALIGNMENT)
+
+
+
+################ Writer ##############
+
+# write a daily wind matrix to the compact format.  Written to a temporary file and renamed so an
+# interrupted write never leaves a partial partition behind
+# INPUTS:
+#    filepath (str) - output filepath, normally ending in .wrt
+#    windMatrix (numpy array) - hours downwind organized by (id, month, day, angle)
+#    ids (list) - unique ids, sorted in the same order as windMatrix
+#    year (int) - birth year
+#    compress (bool) - if True, store the body as zlib compressed chunks of CHUNK_BIRTHS residences
+#    compressLevel (int) - zlib compression level
+def writeWindRoseTensor(filepath,windMatrix,ids,year,compress=False,compressLevel=1):
+    codes = encodeHours(windMatrix)
+    if codes.shape[0] != len(ids):
+        raise ValueError("wind matrix has %i residences but %i ids were provided" %(codes.shape[0],len(ids)))
+    header = {
+        'shape':list(codes.shape),
+        'dtype':'uint8',
+        'missingCode':MISSING_CODE,
+        'year':int(year),
+        'firstMonth':"%i-01" %(year-1),
+        'daysInMonth':getDaysInMonths(year),
+        'ids':[str(curId) for curId in ids],
+        'compression':None,
+        'chunkBirths':None,
+        'chunks':None
+    }
+    chunkData = []
+    if compress:
+        chunkOffset = 0
+        header['compression'] = 'zlib'
+        header['chunkBirths'] = CHUNK_BIRTHS
+        header['chunks'] = []
+        for start in range(0,codes.shape[0],CHUNK_BIRTHS):
+            compressed = zlib.compress(np.ascontiguousarray(codes[start:start+CHUNK_BIRTHS]).tobytes(),compressLevel)
+            header['chunks'].append([chunkOffset,len(compressed)])
+            chunkData.append(compressed)
+            chunkOffset += len(compressed)
+
+    headerBytes = json.dumps(header).encode('utf-8')
+    bodyOffset = alignOffset(len(MAGIC) + 4 + len(headerBytes))
+    headerBytes += b" "*(bodyOffset - len(MAGIC) - 4 - len(headerBytes))
+    tempFile = filepath + ".tmp"
+    with open(tempFile,'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I',len(headerBytes)))
+        f.write(headerBytes)
+        if compress:
+            for compressed in chunkData:
+                f.write(compressed)
+        else:
+            f.write(np.ascontiguousarray(codes).tobytes())
+    os.replace(tempFile,filepath)
+
+
+
+################ Readers ##############
+
+# open a compact wind matrix without loading the body into memory
+# INPUTS:
+#    filepath (str) - filepath to a .wrt file
+# OUTPUTS:
+#    tensor (dict) - header values plus 'data', a read-only np.memmap of the body for uncompressed files
+def openWindRoseTensor(filepath):
+    with open(filepath,'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a wind rose tensor file: %s" %(filepath))
+        headerLength = struct.unpack('<I',f.read(4))[0]
+        header = json.loads(f.read(headerLength).decode('utf-8'))
+    tensor = dict(header)
+    tensor['shape'] = tuple(header['shape'])
+    tensor['filepath'] = filepath
+    tensor['bodyOffset'] = len(MAGIC) + 4 + headerLength
+    tensor['chunkCache'] = OrderedDict()
+    tensor['data'] = None
+    if header['compression'] is None and tensor['shape'][0] > 0:
+        tensor['data'] = np.memmap(filepath,dtype=np.uint8,mode='r',offset=tensor['bodyOffset'],shape=tensor['shape'])
+    return(tensor)
+
+# read and decompress one chunk of a compressed tensor.  Recently used chunks are cached
+# INPUTS:
+#    tensor (dict) - opened with openWindRoseTensor
+#    chunkIndex (int) - index of the chunk to read
+# OUTPUTS:
+#    uint8 numpy array organized by (id, month, day, angle)
+def readChunk(tensor,chunkIndex):
+    cache = tensor['chunkCache']
+    if chunkIndex in cache:
+        cache.move_to_end(chunkIndex)
+        return(cache[chunkIndex])
+    chunkOffset, chunkLength = tensor['chunks'][chunkIndex]
+    with open(tensor['filepath'],'rb') as f:
+        f.seek(tensor['bodyOffset'] + chunkOffset)
+        raw = zlib.decompress(f.read(chunkLength))
+    chunk = np.frombuffer(raw,dtype=np.uint8).reshape((-1,) + tensor['shape'][1:])
+    cache[chunkIndex] = chunk
+    if len(cache) > CHUNK_CACHE_SIZE:
+        cache.popitem(last=False)
+    return(chunk)
+
+# read the daily wind matrix for one maternal residence.  Zero-copy for uncompressed files
+# INPUTS:
+#    tensor (dict) - opened with openWindRoseTensor
+#    birthIndex (int) - row of the maternal residence in the tensor
+# OUTPUTS:
+#    uint8 numpy array organized by (month, day, angle)
+def readBirth(tensor,birthIndex):
+    if tensor['data'] is not None:
+        return(tensor['data'][birthIndex])
+    chunkBirths = tensor['chunkBirths']
+    return(readChunk(tensor,birthIndex//chunkBirths)[birthIndex % chunkBirths])
+
+# read the daily wind matrix for all maternal residences in a tensor.  For uncompressed files the
+# result is a memmap, so pages are only read from disk when accessed
+# INPUTS:
+#    tensor (dict) - opened with openWindRoseTensor
+# OUTPUTS:
+#    uint8 numpy array organized by (id, month, day, angle)
+def readAllBirths(tensor):
+    if tensor['data'] is not None or tensor['shape'][0] == 0:
+        return(tensor['data'] if tensor['data'] is not None else np.zeros(tensor['shape'],np.uint8))
+    return(np.concatenate([readChunk(tensor,index) for index in range(len(tensor['chunks']))]))
+
+
+
+################ Conversion of existing partitions ##############
+
+# convert one float64 .npy partition and its id csv to the compact format
+# INPUTS:
+#    npyFile (str) - filepath to a w_ <n>.npy partition
+#    idFile (str) - filepath to the matching id_<n>.csv file
+#    year (int) - birth year
+#    outputFile (str) - filepath of the .wrt file to create
+#    compress (bool) - if True, store the body as zlib compressed chunks
+def convertPartition(npyFile,idFile,year,outputFile,compress=False):
+    import pandas as ps
+    windMatrix = np.load(npyFile,mmap_mode='r')
+    ids = list(ps.read_csv(idFile)['masterIds'])
+    writeWindRoseTensor(outputFile,windMatrix,ids,year,compress)
+
+# convert all .npy partitions for a birth year to the compact format
+# INPUTS:
+#    windFolder (str) - parent folder containing windPartitions/ and masterIds/
+#    year (int) - birth year
+#    compress (bool) - if True, store the body as zlib compressed chunks
+def convertYear(windFolder,year,compress=False):
+    partitionFolder = windFolder + "windPartitions/" + str(year) + "/"
+    idFolder = windFolder + "masterIds/" + str(year) + "/"
+    index = 0
+    while os.path.exists(partitionFolder + "w_ " + str(index) + ".npy"):
+        outputFile = partitionFolder + "w_ " + str(index) + FILE_EXTENSION
+        if not(os.path.exists(outputFile)):
+            convertPartition(partitionFolder + "w_ " + str(index) + ".npy",idFolder + "id_" + str(index) + ".csv",year,outputFile,compress)
+            print("converted partition %i" %(index))
+        index += 1
+
+
+if __name__ == '__main__':
+    import argparse
+    import gConst as const
+    parser = argparse.ArgumentParser(description="convert float64 wind matrix partitions to the compact uint8 format")
+    parser.add_argument('year',type=int,help="birth year to convert")
+    parser.add_argument('--compress',action='store_true',help="store zlib compressed chunks")
+    args = parser.parse_args()
+    convertYear(const.WIND_FOLDER,args.year,args.compress)
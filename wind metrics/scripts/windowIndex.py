@@ -0,0 +1,208 @@
+############### windowIndex.py #############
+# Developed for HEI Transit Study
+# Summary: prefix-sum index for wind roses over arbitrary date windows (e.g. pregnancy, trimesters,
+#          gestational weeks).  For each maternal residence, daily hours downwind are stored as a cumulative
+#          sum over a calendar-true day axis (no 31 day padding), so the wind rose for any [start, end]
+#          window is two lookups and one subtraction
+# Steps include:
+# 1) gathering calendar days from a wind matrix partition (id, month, day, angle)
+# 2) setting missing days to 0 hours downwind, the same as residentialWindParallel.processAnnualVals
+# 3) storing the cumulative sum (uint16) next to the partition, with a json sidecar of ids and dates
+# 4) answering vectorized queries for arrays of unique ids and date pairs
+
+
+############### Setup: import libraries and define constants ##############
+import json
+import os
+import numpy as np
+import pandas as ps
+import windRoseStore
+
+INDEX_PREFIX = "windIndex_" # windIndex_<n>.npy and windIndex_<n>.json are stored with w_ <n> partitions
+CHUNK_BIRTHS = 64 # residences converted at a time when building an index
+
+
+
+################ Helper functions ##############
+
+# get all calendar days covered by the wind matrix for a birth year (january 1st of the year before
+# birth through december 31st of the birth year)
+# INPUTS:
+#    year (int) - birth year
+# OUTPUTS:
+#    numpy datetime64[D] array
+def getCalendarDays(year):
+    return(np.arange(np.datetime64(str(year-1) + '-01-01'),np.datetime64(str(year+1) + '-01-01'),dtype='datetime64[D]'))
+
+# get the month and day indeces in the padded wind matrix for each calendar day
+# INPUTS:
+#    year (int) - birth year
+# OUTPUTS:
+#    monthIndex, dayIndex (numpy arrays)
+def getMatrixIndexes(year):
+    days = getCalendarDays(year)
+    months = days.astype('datetime64[M]')
+    monthIndex = months.astype(np.int64) - np.datetime64(str(year-1) + '-01','M').astype(np.int64)
+    dayIndex = (days - months.astype('datetime64[D]')).astype(np.int64)
+    return(monthIndex,dayIndex)
+
+# convert dates to day offsets relative to the first day covered by an index
+# INPUTS:
+#    dates (array-like) - dates as Y-m-d strings, datetimes, or datetime64 values
+#    origin (numpy datetime64) - first day covered by the index
+# OUTPUTS:
+#    numpy int64 array of day offsets
+def toDayOffsets(dates,origin):
+    days = np.asarray(ps.to_datetime(np.asarray(dates)).values.astype('datetime64[D]'))
+    return((days - origin).astype(np.int64))
+
+
+
+################ Building an index ##############
+
+# create the cumulative sum of daily hours downwind for a wind matrix partition
+# INPUTS:
+#    windMatrix (numpy array) - hours downwind organized by (id, month, day, angle).  float64 or uint8 codes
+#    year (int) - birth year
+#    outputFile (str) - optional .npy filepath.  If provided, the index is written to a memory mapped file
+# OUTPUTS:
+#    cumulative (numpy array) - uint16 array organized by (id, calendar day + 1, angle).  cumulative[:,0] is 0
+def buildCumulative(windMatrix,year,outputFile=None):
+    monthIndex, dayIndex = getMatrixIndexes(year)
+    shape = (windMatrix.shape[0],len(monthIndex)+1,windMatrix.shape[3])
+    if outputFile is None:
+        cumulative = np.zeros(shape,np.uint16)
+    else:
+        cumulative = np.lib.format.open_memmap(outputFile,mode='w+',dtype=np.uint16,shape=shape)
+        cumulative[:,0] = 0
+    for start in range(0,shape[0],CHUNK_BIRTHS):
+        daily = windRoseStore.getValidHours(np.asarray(windMatrix[start:start+CHUNK_BIRTHS])[:,monthIndex,dayIndex])
+        np.cumsum(daily.astype(np.uint16),axis=1,out=cumulative[start:start+CHUNK_BIRTHS,1:])
+    return(cumulative)
+
+# build and save the window index for one wind matrix partition
+# INPUTS:
+#    windMatrix (numpy array) - hours downwind organized by (id, month, day, angle)
+#    ids (list) - unique ids, sorted in the same order as windMatrix
+#    year (int) - birth year
+#    partitionFolder (str) - folder containing the w_ <n> partitions
+#    index (int) - partition index
+def writeWindowIndex(windMatrix,ids,year,partitionFolder,index):
+    prefix = os.path.join(partitionFolder,INDEX_PREFIX + str(index))
+    buildCumulative(windMatrix,year,prefix + ".npy.tmp")
+    os.replace(prefix + ".npy.tmp",prefix + ".npy")
+    sidecar = {
+        'year':int(year),
+        'origin':str(getCalendarDays(year)[0]),
+        'nDays':len(getCalendarDays(year)),
+        'ids':[str(curId) for curId in ids]
+    }
+    with open(prefix + ".json",'w') as f:
+        json.dump(sidecar,f)
+
+# build window indeces for all partitions of a birth year that do not have one yet
+# INPUTS:
+#    windFolder (str) - parent folder containing windPartitions/ and masterIds/
+#    year (int) - birth year
+def buildYear(windFolder,year):
+    partitionFolder = windFolder + "windPartitions/" + str(year) + "/"
+    idFolder = windFolder + "masterIds/" + str(year) + "/"
+    index = 0
+    while True:
+        compactFile = partitionFolder + "w_ " + str(index) + windRoseStore.FILE_EXTENSION
+        npyFile = partitionFolder + "w_ " + str(index) + ".npy"
+        if os.path.exists(compactFile):
+            tensor = windRoseStore.openWindRoseTensor(compactFile)
+            windMatrix, ids = windRoseStore.readAllBirths(tensor), tensor['ids']
+        elif os.path.exists(npyFile):
+            windMatrix, ids = np.load(npyFile,mmap_mode='r'), list(ps.read_csv(idFolder + "id_" + str(index) + ".csv")['masterIds'])
+        else:
+            break
+        if not(os.path.exists(partitionFolder + INDEX_PREFIX + str(index) + ".json")):
+            writeWindowIndex(windMatrix,ids,year,partitionFolder,index)
+            print("created window index for partition %i" %(index))
+        index += 1
+
+
+
+################ Querying an index ##############
+
+# open all window indeces for a birth year.  Cumulative sums are memory mapped
+# INPUTS:
+#    partitionFolder (str) - folder containing the windIndex_<n> files
+# OUTPUTS:
+#    windowIndex (dict) - memory mapped cumulative sums, origin date, and an id lookup
+def openWindowIndex(partitionFolder):
+    cumulatives, idList, partitionList, rowList = [], [], [], []
+    origin, nDays = None, None
+    index = 0
+    while os.path.exists(os.path.join(partitionFolder,INDEX_PREFIX + str(index) + ".json")):
+        prefix = os.path.join(partitionFolder,INDEX_PREFIX + str(index))
+        with open(prefix + ".json") as f:
+            sidecar = json.load(f)
+        origin, nDays = np.datetime64(sidecar['origin'],'D'), sidecar['nDays']
+        cumulatives.append(np.load(prefix + ".npy",mmap_mode='r'))
+        idList += sidecar['ids']
+        partitionList.append(np.full(len(sidecar['ids']),index,np.int32))
+        rowList.append(np.arange(len(sidecar['ids']),dtype=np.int64))
+        index += 1
+    if index == 0:
+        raise FileNotFoundError("no window index found in %s" %(partitionFolder))
+    windowIndex = {
+        'cumulatives':cumulatives,
+        'origin':origin,
+        'nDays':nDays,
+        'ids':ps.Index(idList),
+        'partition':np.concatenate(partitionList),
+        'row':np.concatenate(rowList)
+    }
+    return(windowIndex)
+
+# get wind roses for arrays of unique ids and inclusive [start, end] date windows
+# INPUTS:
+#    windowIndex (dict) - opened with openWindowIndex
+#    ids (array-like) - unique ids
+#    starts (array-like) - first day of each window
+#    ends (array-like) - last day of each window (inclusive)
+# OUTPUTS:
+#    roses (numpy array) - int32 hours downwind organized by (query, angle)
+def getWindowRoses(windowIndex,ids,starts,ends):
+    lookup = windowIndex['ids'].get_indexer(ps.Index(np.asarray(ids).astype(str)))
+    if (lookup < 0).any():
+        raise KeyError("ids not found in window index: %s" %(str(list(np.asarray(ids)[lookup < 0][:5]))))
+    startOffsets = toDayOffsets(starts,windowIndex['origin'])
+    endOffsets = toDayOffsets(ends,windowIndex['origin']) + 1
+    if (startOffsets < 0).any() or (endOffsets > windowIndex['nDays']).any() or (endOffsets < startOffsets).any():
+        raise ValueError("date windows must fall within the %i days covered by the index" %(windowIndex['nDays']))
+    partitions, rows = windowIndex['partition'][lookup], windowIndex['row'][lookup]
+    roses = np.zeros((len(lookup),windowIndex['cumulatives'][0].shape[2]),np.int32)
+
+    # one fancy-index read per partition, two rows of 360 values per query
+    for partition in np.unique(partitions):
+        isCurrent = partitions == partition
+        cumulative = windowIndex['cumulatives'][partition]
+        endVals = cumulative[rows[isCurrent],endOffsets[isCurrent]].astype(np.int32)
+        roses[isCurrent] = endVals - cumulative[rows[isCurrent],startOffsets[isCurrent]]
+    return(roses)
+
+# get wind roses for pregnancy periods.  Matches residentialWindParallel.processAnnualVals, which sums
+# from the conception date up to, but not including, the birth date
+# INPUTS:
+#    windowIndex (dict) - opened with openWindowIndex
+#    ids (array-like) - unique ids
+#    cdates (array-like) - conception dates
+#    bdates (array-like) - birth dates
+# OUTPUTS:
+#    roses (numpy array) - int32 hours downwind organized by (birth, angle)
+def getPregnancyRoses(windowIndex,ids,cdates,bdates):
+    lastDays = ps.to_datetime(np.asarray(bdates)) - ps.Timedelta(days=1)
+    return(getWindowRoses(windowIndex,ids,cdates,lastDays))
+
+
+if __name__ == '__main__':
+    import argparse
+    import gConst as const
+    parser = argparse.ArgumentParser(description="build prefix-sum window indeces for wind matrix partitions")
+    parser.add_argument('year',type=int,help="birth year")
+    args = parser.parse_args()
+    buildYear(const.WIND_FOLDER,args.year)